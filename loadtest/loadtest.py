@@ -0,0 +1,332 @@
+import argparse
+import csv
+import http.client
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, List, Dict, NamedTuple, Tuple
+from urllib.parse import urlsplit
+
+import numpy as np
+# Adjust sys.path to allow access to ltss module in parent directory
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ltss.recorder import read_request_log  # noqa: E402
+
+# Endpoints driven by the default traffic mix, with their relative weights
+DEFAULT_MIX = dict(forecast=8, record=2, records=1)
+
+
+class Request(NamedTuple):
+    """A single request to replay"""
+    method: str
+    path: str
+    query: str
+    content_type: Optional[str]
+    body: Optional[bytes]
+
+
+class Result(NamedTuple):
+    """Outcome of a single replayed request"""
+    endpoint: str
+    latency: float
+    ok: bool
+
+
+def endpoint_label(path: str) -> str:
+    """Group request paths by endpoint, e.g. all `/api/record/:id` requests together"""
+    parts = path.rstrip('/').split('/')
+    if len(parts) == 4 and parts[2] == 'record':
+        return '/api/record/:id'
+    return path
+
+
+def requests_from_csv(path: str, mix: Dict[str, int], number_of_records: int, count: int,
+                      seed: Optional[int] = None) -> List[Request]:
+    """
+    Build a traffic mix of forecast and record requests, posting the records in a CSV file (e.g. the output of
+    `generate_fake_data.py`) to the forecast endpoint
+    :param path: Path to the CSV file of records
+    :param mix: Relative weights of `forecast`, `record` and `records` requests
+    :param number_of_records: Number of records served by the API, to choose `/api/record/:id` requests from
+    :param count: Number of requests to build (they are replayed in a loop if the test runs longer)
+    :param seed: Optional seed for a reproducible mix
+    :return: List of requests
+    """
+    with open(path, newline='') as fp:
+        forecasts = [json.dumps(row, separators=(',', ':')).encode() for row in csv.DictReader(fp)]
+    if not forecasts and mix.get('forecast'):
+        raise ValueError(f'No records found in {path}')
+    rng = random.Random(seed)
+    kinds = rng.choices(list(mix.keys()), weights=list(mix.values()), k=count)
+    requests = []
+    for kind in kinds:
+        if kind == 'forecast':
+            requests.append(Request('POST', '/api/forecast', '', 'application/json', rng.choice(forecasts)))
+        elif kind == 'record':
+            requests.append(Request('GET', f'/api/record/{rng.randrange(number_of_records)}', '', None, None))
+        elif kind == 'records':
+            requests.append(Request('GET', '/api/records', '', None, None))
+        else:
+            raise ValueError(f'Unknown request type in mix: {kind}')
+    return requests
+
+
+def requests_from_log(path: str) -> List[Request]:
+    """
+    Load the requests captured by the app's request recorder
+    :param path: Path to the request log
+    :return: List of requests, in the order they were recorded
+    """
+    return [Request(*entry) for entry in read_request_log(path)]
+
+
+class AppTarget:
+    """Send requests to an in-process app built by `create_app()`, with a test client per thread"""
+
+    def __init__(self, records_file: Optional[str] = None):
+        """
+        :param records_file: Optional records file for the app to serve, in place of its default
+        """
+        import ltss
+        if records_file is not None:
+            ltss.RECORDS_DIR, ltss.RECORDS_FILE = os.path.split(os.path.abspath(records_file))
+        self.app = ltss.create_app()
+        self._local = threading.local()
+
+    def send(self, request: Request) -> int:
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = self.app.test_client()
+        response = client.open(request.path, method=request.method, query_string=request.query,
+                               data=request.body, content_type=request.content_type)
+        # Read the whole body, as a real client would
+        response.get_data()
+        return response.status_code
+
+
+class UrlTarget:
+    """Send requests to a running server (e.g. under uwsgi), with a keep-alive connection per thread"""
+
+    def __init__(self, url: str, timeout: float = 30):
+        parts = urlsplit(url)
+        self.connection_class = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+        self.host = parts.netloc
+        self.prefix = parts.path.rstrip('/')
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def send(self, request: Request) -> int:
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._local.connection = self.connection_class(self.host, timeout=self.timeout)
+        url = self.prefix + request.path + (f'?{request.query}' if request.query else '')
+        headers = {'Content-Type': request.content_type} if request.content_type else {}
+        try:
+            connection.request(request.method, url, body=request.body, headers=headers)
+            response = connection.getresponse()
+            response.read()
+            return response.status
+        except Exception:
+            # Reconnect on the next request
+            connection.close()
+            self._local.connection = None
+            raise
+
+
+def timed_send(target, request: Request, start: float) -> Result:
+    """
+    Send a request, timing it from the given start time
+    :param target: AppTarget or UrlTarget
+    :param request: Request to send
+    :param start: Time the request is counted from, by `time.perf_counter()`
+    :return: Result of the request
+    """
+    try:
+        ok = target.send(request) < 400
+    except Exception:
+        ok = False
+    return Result(endpoint_label(request.path), time.perf_counter() - start, ok)
+
+
+def run_closed_loop(target, requests: List[Request], concurrency: int, duration: Optional[float] = None,
+                    total: Optional[int] = None) -> Tuple[List[Result], float]:
+    """
+    Replay requests from a fixed number of clients, each sending its next request as soon as the last completes
+    :param target: AppTarget or UrlTarget
+    :param requests: Requests to replay, in a loop
+    :param concurrency: Number of concurrent clients
+    :param duration: Stop after this many seconds
+    :param total: Stop after this many requests (by default, one pass over the requests)
+    :return: Results, and the elapsed time in seconds
+    """
+    if duration is None and total is None:
+        total = len(requests)
+    results = []
+    lock = threading.Lock()
+    counter = iter(range(total if total is not None else sys.maxsize))
+    start = time.perf_counter()
+
+    def client():
+        while duration is None or time.perf_counter() - start < duration:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                return
+            result = timed_send(target, requests[i % len(requests)], time.perf_counter())
+            with lock:
+                results.append(result)
+
+    threads = [threading.Thread(target=client, daemon=True) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, time.perf_counter() - start
+
+
+def run_open_loop(target, requests: List[Request], rate: float, duration: Optional[float] = None,
+                  total: Optional[int] = None, max_workers: int = 64, poisson: bool = False,
+                  seed: Optional[int] = None) -> Tuple[List[Result], float]:
+    """
+    Replay requests at a fixed arrival rate, regardless of how quickly they are answered. Latency is measured from
+    each request's scheduled start, so queueing behind slow requests is counted rather than hidden.
+    :param target: AppTarget or UrlTarget
+    :param requests: Requests to replay, in a loop
+    :param rate: Arrival rate in requests per second
+    :param duration: Stop scheduling requests after this many seconds
+    :param total: Stop after this many requests (by default, one pass over the requests)
+    :param max_workers: Maximum number of requests in flight
+    :param poisson: Use exponentially distributed gaps between arrivals, rather than even spacing
+    :param seed: Optional seed for the arrival times
+    :return: Results, and the elapsed time in seconds
+    """
+    if duration is None and total is None:
+        total = len(requests)
+    rng = random.Random(seed)
+    futures = []
+    start = time.perf_counter()
+    scheduled = start
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        i = 0
+        while (total is None or i < total) and (duration is None or scheduled - start < duration):
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            futures.append(pool.submit(timed_send, target, requests[i % len(requests)], scheduled))
+            scheduled += rng.expovariate(rate) if poisson else 1 / rate
+            i += 1
+        results = [future.result() for future in futures]
+    return results, time.perf_counter() - start
+
+
+def summarise(results: List[Result], elapsed: float) -> Dict:
+    """
+    Summarise latency, throughput and errors, overall and per endpoint
+    :param results: Results of the replayed requests
+    :param elapsed: Elapsed time of the test in seconds
+    :return: Dict of summary statistics, with latencies in milliseconds
+    """
+    def stats(group: List[Result]) -> Dict:
+        latencies = np.array([r.latency for r in group]) * 1000
+        errors = sum(not r.ok for r in group)
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) if len(group) else (np.nan, np.nan, np.nan)
+        return dict(
+            requests=len(group),
+            errors=errors,
+            error_rate=errors / len(group) if group else 0.0,
+            throughput=len(group) / elapsed if elapsed > 0 else 0.0,
+            p50_ms=float(p50),
+            p95_ms=float(p95),
+            p99_ms=float(p99),
+            max_ms=float(latencies.max()) if len(group) else np.nan,
+        )
+
+    endpoints = sorted({r.endpoint for r in results})
+    return dict(
+        elapsed_seconds=elapsed,
+        overall=stats(results),
+        endpoints={endpoint: stats([r for r in results if r.endpoint == endpoint]) for endpoint in endpoints},
+    )
+
+
+def print_report(summary: Dict):
+    """Print a load test summary as a table"""
+    print(f'{"Endpoint":<24}{"Requests":>10}{"Errors":>8}{"Req/s":>10}'
+          f'{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}{"Max ms":>10}')
+    rows = list(summary['endpoints'].items()) + [('Overall', summary['overall'])]
+    for name, s in rows:
+        print(f'{name:<24}{s["requests"]:>10}{s["error_rate"]:>8.1%}{s["throughput"]:>10.1f}'
+              f'{s["p50_ms"]:>10.1f}{s["p95_ms"]:>10.1f}{s["p99_ms"]:>10.1f}{s["max_ms"]:>10.1f}')
+    print(f'Elapsed: {summary["elapsed_seconds"]:.1f} s')
+
+
+def parse_mix(value: str) -> Dict[str, int]:
+    """Parse a traffic mix argument, e.g. `forecast=8,record=2,records=1`"""
+    mix = {}
+    for item in value.split(','):
+        kind, weight = item.split('=')
+        mix[kind.strip()] = int(weight)
+    return mix
+
+
+def parse_args(override_args: Optional[List[str]] = None) -> argparse.Namespace:
+    """
+    Parse command-line arguments. By default, parses sys.argv - if supplied, uses `args` as an override
+    :param override_args: Optional override for command-line arguments
+    :return: An argparse.Namespace containing the parsed argument set
+    """
+    parser = argparse.ArgumentParser(description='Replay forecast and record traffic against the LTSS API')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--data', '-d', type=str, help='CSV file of records to post for forecasts')
+    source.add_argument('--request-log', '-l', type=str, help='Request log captured by the app to replay')
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument('--app', action='store_true', help='Load test an in-process app built by create_app()')
+    target.add_argument('--url', '-u', type=str, help='Base URL of a running server, e.g. http://localhost:5000')
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--concurrency', '-c', type=int, help='Number of concurrent clients (closed loop)', default=4)
+    mode.add_argument('--rate', '-r', type=float, help='Arrival rate in requests per second (open loop)')
+    parser.add_argument('--poisson', action='store_true', help='Use random (Poisson) rather than even arrivals')
+    parser.add_argument('--max-in-flight', type=int, help='Maximum open loop requests in flight', default=64)
+    parser.add_argument('--duration', '-t', type=float, help='Test duration in seconds')
+    parser.add_argument('--requests', '-n', type=int, help='Number of requests to send')
+    parser.add_argument('--warmup', type=int, help='Number of requests to send before measuring', default=10)
+    parser.add_argument('--mix', type=parse_mix, help='Relative weights of forecast, record and records requests',
+                        default=DEFAULT_MIX)
+    parser.add_argument('--number-of-records', type=int, help='Number of records served, for record requests',
+                        default=100)
+    parser.add_argument('--records-file', type=str, help='Records file for an in-process app to serve')
+    parser.add_argument('--timeout', type=float, help='Request timeout in seconds, for URL targets', default=30)
+    parser.add_argument('--seed', type=int, help='Optionally seed the PRNG for a reproducible test')
+    parser.add_argument('--output', '-o', type=str, help='Optional path to write the JSON summary to')
+    return parser.parse_args(args=override_args)
+
+
+if __name__ == '__main__':
+    # Parse command-line arguments
+    args = parse_args()
+    if args.data is not None:
+        replay = requests_from_csv(args.data, args.mix, args.number_of_records, args.requests or 1000,
+                                   seed=args.seed)
+    else:
+        replay = requests_from_log(args.request_log)
+    print(f'Loaded {len(replay)} requests')
+    load_target = AppTarget(args.records_file) if args.app else UrlTarget(args.url, timeout=args.timeout)
+    # Warm up caches and connections, so one-off costs are not measured
+    run_closed_loop(load_target, replay, min(args.concurrency, args.warmup) or 1, total=args.warmup)
+    if args.rate is not None:
+        test_results, test_elapsed = run_open_loop(load_target, replay, args.rate, duration=args.duration,
+                                                   total=args.requests, max_workers=args.max_in_flight,
+                                                   poisson=args.poisson, seed=args.seed)
+    else:
+        test_results, test_elapsed = run_closed_loop(load_target, replay, args.concurrency, duration=args.duration,
+                                                     total=args.requests)
+    test_summary = summarise(test_results, test_elapsed)
+    print_report(test_summary)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(test_summary, f, indent=2)
+        print(f'Saved summary to {args.output}')
@@ -0,0 +1,140 @@
+import argparse
+import json
+import multiprocessing
+import os
+import time
+from typing import Optional, List, Dict, Tuple
+
+import numpy as np
+# Adjust sys.path to allow access to ltss module in parent directory
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ltss import resources  # noqa: E402
+
+
+def run_worker(model_file: str, workers: int, worker_index: int, threads: Optional[int], affinity: bool,
+               batch_size: int, duration: float, barrier, results):
+    """
+    Score batches of random records against the LoS model for a fixed time, under a thread plan
+
+    :param model_file: Path to the LoS model state file
+    :param workers: Number of workers sharing the cores
+    :param worker_index: Index of this worker
+    :param threads: Threads for this worker (None for torch's default of every core)
+    :param affinity: Pin the worker to its own share of the CPUs
+    :param batch_size: Number of records scored per forward pass
+    :param duration: Seconds to score for
+    :param barrier: Barrier to start every worker together
+    :param results: Queue to put the worker's latencies on, in seconds
+    """
+    if threads is not None:
+        resources.configure(workers, worker_index, threads=threads, affinity=affinity)
+    from ltss import los_model
+    predictor = los_model.init_model(model_file=model_file)
+    batch = np.random.rand(batch_size, 1, 8, 8).astype(np.float32)
+    # Warm up, so one-off costs are not measured
+    for _ in range(10):
+        los_model.predict_batch(predictor, batch)
+    barrier.wait()
+    latencies = []
+    end = time.perf_counter() + duration
+    while time.perf_counter() < end:
+        start = time.perf_counter()
+        los_model.predict_batch(predictor, batch)
+        latencies.append(time.perf_counter() - start)
+    results.put(latencies)
+
+
+def run_config(model_file: str, workers: int, threads: Optional[int], affinity: bool, batch_size: int,
+               duration: float) -> Dict:
+    """
+    Measure the throughput and latency of a number of worker processes scoring at once
+
+    :param model_file: Path to the LoS model state file
+    :param workers: Number of worker processes
+    :param threads: Threads per worker (None for torch's default of every core)
+    :param affinity: Pin each worker to its own share of the CPUs
+    :param batch_size: Number of records scored per forward pass
+    :param duration: Seconds to score for
+    :return: Summary of the configuration's throughput and latency
+    """
+    # Spawn rather than fork workers, as forking a process that has already started torch threads can deadlock
+    context = multiprocessing.get_context('spawn')
+    barrier = context.Barrier(workers)
+    results = context.Queue()
+    processes = [context.Process(target=run_worker, args=(model_file, workers, i, threads, affinity, batch_size,
+                                                          duration, barrier, results))
+                 for i in range(workers)]
+    for process in processes:
+        process.start()
+    latencies = np.array([latency for _ in processes for latency in results.get()])
+    for process in processes:
+        process.join()
+    return dict(
+        workers=workers,
+        threads=threads if threads is not None else 'default',
+        affinity=affinity,
+        records_per_second=len(latencies) * batch_size / duration,
+        p50_ms=float(np.percentile(latencies, 50) * 1000),
+        p99_ms=float(np.percentile(latencies, 99) * 1000),
+    )
+
+
+def default_configs(cores: int) -> List[Tuple[int, Optional[int]]]:
+    """
+    Configurations to compare: the available cores divided between 1, 2, 4, ... workers, and the same numbers of
+    workers with torch's default thread pools (oversubscribing the cores)
+
+    :param cores: Number of available cores
+    :return: List of (workers, threads) tuples, where threads is None for torch's default
+    """
+    configs = []
+    workers = 1
+    while workers <= cores:
+        configs.append((workers, None))
+        configs.append((workers, cores // workers))
+        workers *= 2
+    return configs
+
+
+def parse_config(value: str) -> Tuple[int, Optional[int]]:
+    """Parse a `<workers>x<threads>` configuration, where threads may be `default`"""
+    workers, _, threads = value.partition('x')
+    return int(workers), None if threads in ('', 'default') else int(threads)
+
+
+def parse_args(override_args: Optional[List[str]] = None) -> argparse.Namespace:
+    """
+    Parse command-line arguments. By default, parses sys.argv - if supplied, uses `args` as an override
+    :param override_args: Optional override for command-line arguments
+    :return: An argparse.Namespace containing the parsed argument set
+    """
+    parser = argparse.ArgumentParser(description='Benchmark LoS model throughput under CPU thread budgets')
+    parser.add_argument('--model', '-m', type=str, help='LoS model state file', default='config/los_model.state')
+    parser.add_argument('--config', type=parse_config, nargs='+',
+                        help='Configurations to benchmark as <workers>x<threads> (threads may be `default`), '
+                             'by default the available cores divided between 1, 2, 4, ... workers')
+    parser.add_argument('--affinity', action='store_true', help='Pin each worker to its own share of the CPUs')
+    parser.add_argument('--batch-size', '-s', type=int, help='Records scored per forward pass', default=1)
+    parser.add_argument('--duration', type=float, help='Seconds to run each configuration for', default=10)
+    parser.add_argument('--output', '-o', type=str, help='Optional path to write the JSON results to')
+    return parser.parse_args(args=override_args)
+
+
+if __name__ == '__main__':
+    # Parse command-line arguments
+    args = parse_args()
+    available, _ = resources.available_cores()
+    print(f'{available} cores available')
+    summaries = []
+    print(f'{"Workers":>7} {"Threads":>8} {"Records/s":>10} {"p50 ms":>9} {"p99 ms":>9}')
+    for config_workers, config_threads in args.config or default_configs(available):
+        summary = run_config(args.model, config_workers, config_threads, args.affinity, args.batch_size,
+                             args.duration)
+        print(f'{summary["workers"]:>7} {summary["threads"]:>8} {summary["records_per_second"]:>10.1f} '
+              f'{summary["p50_ms"]:>9.2f} {summary["p99_ms"]:>9.2f}')
+        summaries.append(summary)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(summaries, f, indent=2)
+        print(f'Saved results to {args.output}')
@@ -1,13 +1,16 @@
 """Flask app serving record and model prediction endpoints"""
+import hmac
 import logging
 import os
-from typing import Optional
+from typing import Optional, List, Tuple
 
-from flask import Flask, jsonify, request
+from flask import Flask, jsonify, request, make_response, g
 
-from ltss.vectorise import vectorise_record
-from ltss.utils import format_record_for_frontend, read_records_csv
-from ltss import los_model, risk_model
+from ltss.vectorise import vectorise_record, IncrementalVector, CONFIG_DIR
+from ltss import los_model, risk_model, records, registry, wire, census, recorder, record_store, admission, spells, \
+    whatif, resources, drift, model_server
+from ltss.records import FileVersion
+from ltss.utils import format_record_for_frontend
 
 # Configuration for flask app
 CONFIG = dict(
@@ -16,25 +19,130 @@ CONFIG = dict(
     SECRET_KEY=b'',
     # Pretty-print JSON even in production, for human readability
     JSONIFY_PRETTYPRINT_REGULAR=True,
+    # Optional int8 quantised LoS model, produced by `training/quantise_los.py`. It is served in place of the float
+    # model only if its validation MSE is no more than LOS_QUANTISED_TOLERANCE (days squared) above the float model.
+    LOS_QUANTISED_MODEL_FILE='config/los_model.int8.state',
+    LOS_QUANTISED_TOLERANCE=0.5,
+    # Optional list of LoS model checkpoints (e.g. `mod_ep_*` files written by `training/train_los.py`) served as an
+    # ensemble in place of the LoS models above. Members run in a single forward pass of one grouped network, and
+    # forecasts give the mean of the members' predictions as PREDICTED_LOS, with their standard deviation as
+    # PREDICTED_LOS_STD.
+    LOS_ENSEMBLE_FILES=None,
+    # Model artifacts loaded at startup, and reloaded without restarting when they are replaced
+    LOS_MODEL_FILE='config/los_model.state',
+    RISK_MODEL_FILE='config/risk_model.pickle',
+    VECTOR_MAPPING_FILE=os.path.join(CONFIG_DIR, 'model_vector_mappings.json'),
+    # Poll the model artifacts for changes every N seconds and hot reload them (None to disable). Under uwsgi this
+    # requires `enable-threads`, and is the way to reload every worker process.
+    MODEL_WATCH_INTERVAL=None,
+    # Token required in the X-Admin-Token header of admin endpoint requests (admin endpoints are disabled if empty)
+    ADMIN_TOKEN='',
+    # Accept pre-vectorised forecast inputs (`/api/forecast?input=vector`) from internal services, skipping
+    # vectorisation of the raw record fields
+    ACCEPT_VECTOR_INPUT=False,
+    # Record a random sample of API requests to a compact log, for replay by the load-test harness (`loadtest/`).
+    # Recording is disabled unless both the file and a sample rate (between 0 and 1) are set. The log contains patient
+    # records, so must be stored and handled as patient data.
+    REQUEST_LOG_FILE=None,
+    REQUEST_LOG_SAMPLE_RATE=0.0,
+    REQUEST_LOG_MAX_BYTES=100 * 1024 * 1024,
+    # Optional SQLite file to load the records file into, indexed on the UI fields. When set, records are served from
+    # the store, and `/api/records` supports server-side filtering, sorting and pagination.
+    RECORD_STORE_FILE=None,
+    # Optional models for each of several sites, keyed on site ID and selected per request by the X-LTSS-Site header
+    # or `site` query parameter (requests naming no site are served by the models above). Each site is a dict of any
+    # of LOS_MODEL_FILE, LOS_QUANTISED_MODEL_FILE, LOS_QUANTISED_TOLERANCE, LOS_ENSEMBLE_FILES, RISK_MODEL_FILE and
+    # VECTOR_MAPPING_FILE, with missing entries taken from the settings above, e.g.
+    # `dict(trust_a=dict(LOS_MODEL_FILE='config/a.state'))`.
+    # Site models are loaded on first use, identical artifacts are shared between sites, and the least recently used
+    # sites are evicted when the estimated memory of the resident site models exceeds MODEL_MEMORY_BUDGET bytes.
+    MODEL_SITES={},
+    MODEL_MEMORY_BUDGET=1024 * 1024 * 1024,
+    # Admission control for the forecast and census endpoints, per worker process (None to disable). At most
+    # ADMISSION_MAX_CONCURRENT requests are served at once and ADMISSION_MAX_QUEUE wait for a slot. Requests that
+    # cannot be served within ADMISSION_DEADLINE seconds (or the client's X-Request-Deadline in milliseconds, if
+    # sooner, and measured from the proxy's X-Request-Start if given) fail fast with 503 and a Retry-After header. Each
+    # uwsgi worker needs at least ADMISSION_MAX_CONCURRENT + ADMISSION_MAX_QUEUE threads (see deploy/uwsgi.ini).
+    ADMISSION_MAX_CONCURRENT=None,
+    ADMISSION_MAX_QUEUE=6,
+    ADMISSION_DEADLINE=5.0,
+    # Under pressure (at least this many requests waiting, or too little time left before the deadline), serve
+    # degraded forecasts from the risk model alone, skipping the LoS model (None to never degrade)
+    ADMISSION_DEGRADE_QUEUE_DEPTH=None,
+    # Maximum number of spells in progress to hold vectorised records of, per worker process, for field-level updates
+    # through the `/api/spell/:id` endpoints
+    SPELL_CACHE_SIZE=10000,
+    # Maximum number of variants of a record scored by a single `/api/forecast/whatif` request
+    WHATIF_MAX_VARIANTS=256,
+    # Divide the cores available to the host or container (including cgroup CPU limits) between the worker processes,
+    # and size each worker's torch, OpenMP and BLAS thread pools to its share. The number of workers is read from uwsgi
+    # unless WORKER_COUNT is set, and WORKER_THREADS overrides each worker's share. WORKER_CPU_AFFINITY pins each worker
+    # to its own cores. Set WORKER_THREAD_PLAN to False to leave the thread pools at torch's defaults.
+    WORKER_THREAD_PLAN=True,
+    WORKER_COUNT=None,
+    WORKER_THREADS=None,
+    WORKER_CPU_AFFINITY=False,
+    # Count the vectorised records scored by the forecast endpoints against each model version, to monitor drift of the
+    # incoming case mix from the training data (served by `/api/admin/drift`). Requests only queue their records, and
+    # each worker folds them into its counts every DRIFT_INTERVAL seconds (or once DRIFT_MAX_PENDING are queued). Set
+    # DRIFT_SNAPSHOT_DIR to a directory shared by the workers of a host to merge their counts; snapshots of workers that
+    # have exited, or that have not been refreshed for DRIFT_SNAPSHOT_MAX_AGE seconds, are not merged.
+    DRIFT_MONITOR=True,
+    DRIFT_INTERVAL=1.0,
+    DRIFT_MAX_PENDING=1024,
+    DRIFT_SNAPSHOT_DIR=None,
+    DRIFT_SNAPSHOT_MAX_AGE=60.0,
+    # Optional Unix socket of a model server shared by the workers of a host (`python -m ltss.model_daemon`), which
+    # scores the default models' forecasts for every worker in batches. Workers fall back to their own models if the
+    # server cannot be reached within MODEL_SERVER_TIMEOUT seconds, and still use them for per-site models, what-if
+    # forecasts and the census. Workers only load the default LoS model when they first need it.
+    MODEL_SERVER_SOCKET=None,
+    MODEL_SERVER_TIMEOUT=5.0,
 )
 
 # Initialise logging and directory paths
 LOG = logging.getLogger('ltss.flask')
 APP_DIR = os.path.dirname(os.path.abspath(__file__))
 RECORDS_DIR = os.path.join(os.path.dirname(APP_DIR), 'records')
+# Records may alternatively be supplied as a Parquet or Arrow IPC file, e.g. 'example_records.parquet'
 RECORDS_FILE = 'example_records.csv'
 
-# Global model instances to be instantiated on server startup and eliminate
-# model load overheads at prediction-time.
-LOS_MODEL: Optional[los_model.LoSPredictor] = None
-RISK_MODEL: Optional[risk_model.RiskCDFModel] = None
+# Global model holder to be instantiated on server startup and eliminate model load overheads at prediction-time.
+# The active bundle of models is swapped out when the model artifacts are reloaded.
+MODELS: Optional[registry.ModelReloader] = None
+# Per-site models, loaded on demand (None if no sites are configured)
+SITES: Optional[registry.ModelRegistry] = None
 
+# Settings that may be given per site
+SITE_SETTINGS = ['LOS_MODEL_FILE', 'LOS_QUANTISED_MODEL_FILE', 'LOS_QUANTISED_TOLERANCE', 'LOS_ENSEMBLE_FILES',
+                 'RISK_MODEL_FILE', 'VECTOR_MAPPING_FILE']
 
-def initialise_models():
-    """Initialise both predictive models and persist to a global instance variable"""
-    global LOS_MODEL, RISK_MODEL
-    LOS_MODEL = los_model.init_model()
-    RISK_MODEL = risk_model.init_model()
+
+def initialise_models(defer_los: bool = False):
+    """
+    Initialise both predictive models and the vector mapping, and persist to a global instance variable
+
+    :param defer_los: Load the default LoS model on first use rather than now, for workers whose forecasts are scored
+    by a model server
+    """
+    global MODELS, SITES
+    paths = [CONFIG['LOS_MODEL_FILE'], CONFIG['LOS_QUANTISED_MODEL_FILE'], CONFIG['RISK_MODEL_FILE'],
+             CONFIG['VECTOR_MAPPING_FILE'], *(CONFIG['LOS_ENSEMBLE_FILES'] or [])]
+
+    def load():
+        return registry.load_bundle(CONFIG['LOS_MODEL_FILE'], CONFIG['RISK_MODEL_FILE'], CONFIG['VECTOR_MAPPING_FILE'],
+                                    quantised_model_file=CONFIG['LOS_QUANTISED_MODEL_FILE'],
+                                    quantised_tolerance=CONFIG['LOS_QUANTISED_TOLERANCE'],
+                                    ensemble_files=CONFIG['LOS_ENSEMBLE_FILES'], defer_los=defer_los)
+    MODELS = registry.ModelReloader(load, paths)
+    if CONFIG['MODEL_WATCH_INTERVAL']:
+        MODELS.watch(CONFIG['MODEL_WATCH_INTERVAL'])
+    if CONFIG['MODEL_SITES']:
+        sites = {site: {key: settings.get(key, CONFIG[key]) for key in SITE_SETTINGS}
+                 for site, settings in CONFIG['MODEL_SITES'].items()}
+        SITES = registry.ModelRegistry(sites, memory_budget=CONFIG['MODEL_MEMORY_BUDGET'])
+    else:
+        SITES = None
 
 
 def create_app():
@@ -43,89 +151,525 @@ def create_app():
     app = Flask('LTSS')
     # Configure app using global configuration
     app.config.from_mapping(CONFIG)
-    # Initialise the predictive models
-    initialise_models()
+    # Size the thread pools to this worker's share of the cores, before the models are loaded and warmed up
+    thread_plan = resources.from_config(app.config)
+    # Initialise the predictive models. With a model server, the LoS model is only loaded if this worker has to score
+    # in-process, so workers do not each hold a copy
+    initialise_models(defer_los=bool(app.config.get('MODEL_SERVER_SOCKET')))
+    # Optionally limit the forecast endpoints' concurrency, shedding load that cannot be served in time
+    admission_controller = admission.from_config(app.config)
+    # Vectorised records of spells in progress, for field-level updates
+    spell_cache = spells.SpellCache(app.config['SPELL_CACHE_SIZE'])
+    # Optionally count scored records, to monitor input drift
+    drift_monitor = drift.from_config(app.config)
+    # Optionally score forecasts against a model server shared by the workers of the host
+    model_client = model_server.from_config(app.config)
+    # Optionally record a sample of requests for replay
+    request_recorder = recorder.from_config(app.config)
+    if request_recorder is not None:
+        @app.after_request
+        def record_request(response):
+            request_recorder.record(request, response.status_code)
+            return response
+
+    def serialise(obj) -> bytes:
+        """Serialise an object to JSON bytes using the app's JSON configuration"""
+        return jsonify(obj).get_data()
+
+    def conditional_response(body: bytes, version: FileVersion, etag: Optional[str] = None):
+        """
+        Build a JSON response tagged with the records file version (or the given ETag, for responses that also depend
+        on other state), answering conditional requests from clients holding the same version with `304 Not Modified`
+        """
+        response = make_response(body)
+        response.mimetype = 'application/json'
+        response.set_etag(etag if etag is not None else version.etag)
+        response.last_modified = version.last_modified
+        # Allow clients to cache responses, but revalidate them on every use
+        response.cache_control.no_cache = True
+        return response.make_conditional(request)
+
+    def get_record_store() -> Optional[record_store.RecordStore]:
+        """Get the record store for the records file, or None if the record store is not enabled"""
+        if not app.config['RECORD_STORE_FILE']:
+            return None
+        return record_store.get_record_store(os.path.join(RECORDS_DIR, RECORDS_FILE), app.config['RECORD_STORE_FILE'])
+
+    def request_site() -> Optional[str]:
+        """Get the site named by the request's X-LTSS-Site header or `site` query parameter, if any"""
+        return request.headers.get('X-LTSS-Site') or request.args.get('site') or None
+
+    def select_models() -> registry.ModelBundle:
+        """
+        Get the models for the site named by the request, or the active default models if no site is named. The whole
+        request is served by the returned models, even if a reload completes part way through.
+
+        :raises registry.UnknownSite: If the named site is not configured
+        """
+        site = request_site()
+        if site is None:
+            return MODELS.active
+        if SITES is None:
+            raise registry.UnknownSite(site)
+        return SITES.get(site)
 
     @app.route('/api/records')
     def get_records():
         """
-        Read records from csv file and serve as json object
+        Read records from the records file and serve as json object.
+        Parsed records and the serialised response are cached in-process until the records file changes.
+        If the record store is enabled, records may be filtered, sorted and paged with query parameters (see
+        `record_store.parse_query`).
 
         :return: JSON serialised object of patient records
         """
+        # Query parameters are only interpreted by the record store, and are otherwise ignored
+        query = {}
+        if app.config['RECORD_STORE_FILE']:
+            try:
+                query = record_store.parse_query(request.args)
+            except ValueError as e:
+                return jsonify(str(e)), 400
         try:
-            records = {}
-            for i, record in enumerate(read_records_csv(os.path.join(RECORDS_DIR, RECORDS_FILE))):
-                # Add parsed record row to dict keyed on row index
-                records[i] = record
+            store = get_record_store()
+            if store is None:
+                version = records.get_records(os.path.join(RECORDS_DIR, RECORDS_FILE))
+                body = version.records_json(serialise)
+            elif query:
+                version = store.current()
+                total, rows = store.query(**query)
+                body = serialise(dict(
+                    records=[dict(RECORD_ID=record_id, **record) for record_id, record in rows],
+                    count=len(rows),
+                    total=total,
+                    offset=query.get('offset', 0),
+                ))
+            else:
+                version = store.current()
+                body = store.records_json(version, serialise)
         except Exception as e:
             # Log exception and return error code
             LOG.exception(e)
             return jsonify('Error reading records from file'), 500
         # Return success response with json records object
-        return jsonify(records)
+        return conditional_response(body, version)
 
     @app.route('/api/record/<uuid>')
     def get_record(uuid):
-        """Read patient record from csv file at specified row index offset
+        """Read patient record from the records file at specified row index offset
 
         :param uuid: ID of record in file to return
         :return: JSON serialised patient record matching uuid
         """
         try:
-            for i, record in enumerate(read_records_csv(os.path.join(RECORDS_DIR, RECORDS_FILE))):
-                if i == int(uuid):
-                    # Parse retrieved record and serve json response
-                    record = format_record_for_frontend(record)
-                    return jsonify(record)
+            store = get_record_store()
+            if store is None:
+                version = records.get_records(os.path.join(RECORDS_DIR, RECORDS_FILE))
+                # Parse retrieved record and serve json response
+                body = version.record_json(int(uuid), serialise)
+            else:
+                version = store.current()
+                # Look up the record by primary key
+                record = store.get(int(uuid))
+                body = serialise(format_record_for_frontend(record)) if record is not None else None
         except Exception as e:
             # Log exception and return error code
             LOG.exception(e)
             return jsonify(f'Error reading record at row index {uuid}'), 500
-        # Return default 404 error if record index not found in file
-        return jsonify(f'Unable to find record {uuid}'), 404
+        if body is None:
+            # Return default 404 error if record index not found in file
+            return jsonify(f'Unable to find record {uuid}'), 404
+        return conditional_response(body, version)
+
+    def decode_body():
+        """
+        Decode the request body, as JSON or msgpack, and choose the response format
+
+        :return: Decoded body, response media type, and an error response (None if the body was decoded)
+        """
+        try:
+            payload = wire.decode_request(request)
+            media_type = wire.response_type(request)
+        except wire.UnsupportedMediaType as e:
+            return None, None, (jsonify(str(e)), 415)
+        except Exception as e:
+            app.logger.exception(e)
+            return None, None, (jsonify('Error decoding request body'), 400)
+        # Check for request body object
+        if not payload:
+            return None, None, (jsonify('Request body missing'), 400)
+        return payload, media_type, None
+
+    def forecast_options() -> Tuple[List[float], int]:
+        """
+        Parse the forecast query parameters
+
+        :return: Confidence levels for a discharge-confidence curve, and days the patient has already stayed
+        :raises ValueError: If a parameter is invalid, with a message for the client
+        """
+        # Optional confidence levels for a discharge-confidence curve, e.g. `?confidence=0.5&confidence=0.9` or
+        # `?confidence=0.5,0.9`
+        try:
+            confidences = [float(c) for arg in request.args.getlist('confidence') for c in arg.split(',') if c]
+        except ValueError:
+            raise ValueError('Confidence levels must be numbers')
+        if not all(0 < c < 1 for c in confidences):
+            raise ValueError('Confidence levels must be between 0 and 1')
+        # Optional number of days the patient has already stayed, to forecast from today rather than from admission
+        try:
+            days_in_hospital = int(request.args.get('days_in_hospital', 0))
+        except ValueError:
+            days_in_hospital = -1
+        if days_in_hospital < 0:
+            raise ValueError('Days in hospital must be a whole number of days, from 0')
+        return confidences, days_in_hospital
+
+    def forecast_response(models: registry.ModelBundle, vector: dict, media_type: str, confidences: List[float],
+                          days_in_hospital: int, observe: bool = True):
+        """
+        Score a vectorised record against the models and build the forecast response
+
+        :param models: Models to score with
+        :param vector: Vectorised patient record
+        :param media_type: Response media type
+        :param confidences: Confidence levels for a discharge-confidence curve
+        :param days_in_hospital: Number of days the patient has already stayed
+        :param observe: Count the record in the drift monitor
+        :return: Forecast response
+        """
+        # Check for non-major cases and return a no-forecast success response if the case is not identified as major
+        if vector.get('IS_MAJOR', 1) == 0:
+            return wire.encode_response(dict(
+                forecast=False,
+                msg='Proof of concept system does not issue predictions for non-major cases',
+                model_version=models.version,
+            ), media_type)
+        # Under pressure, serve the risk model alone, skipping the LoS model
+        ticket = g.get('admission')
+        degraded = ticket is not None and ticket.degraded
+        version = models.version
+        forecast = None
+        if model_client is not None and not degraded and models is MODELS.active:
+            # Score against the shared model server, falling back to this worker's models if it cannot be reached
+            try:
+                version, forecast = model_client.forecast(vector, days_in_hospital)
+            except model_server.ServerUnavailable as e:
+                app.logger.warning(f'Model server unavailable, scoring in-process: {e}')
+            except model_server.ScoringError as e:
+                app.logger.error(str(e))
+                return jsonify(f'Error predicting against {e.model} model'), 500
+            if forecast is not None and version != models.version:
+                # The server and this worker reload independently, so during a rollout they may hold different
+                # versions. Score in-process, so the confidence curve and drift counts come from the same models.
+                app.logger.info(f'Model server scored with version {version} rather than {models.version}, '
+                                f'scoring in-process')
+                version, forecast = models.version, None
+        if forecast is None:
+            try:
+                # Generate length of stay prediction from univariate GAN model
+                forecast = los_model.get_prediction(models.los_model, vector) if not degraded else {}
+            except Exception as e:
+                app.logger.exception(e)
+                return jsonify('Error predicting against length of stay model'), 500
+            try:
+                # Generate risk stratification prediction from CDF risk model
+                risk_predictions = risk_model.get_prediction(models.risk_model, vector,
+                                                             ai_day_prediction=forecast.get('PREDICTED_LOS'),
+                                                             days_in_hospital=days_in_hospital)
+            except Exception as e:
+                app.logger.exception(e)
+                return jsonify('Error predicting against risk model'), 500
+            # Fuse model prediction dicts to a single forecast dict
+            forecast = dict(forecast, **risk_predictions)
+        if drift_monitor is not None and observe:
+            # Drift monitoring must never fail a forecast that has been scored
+            try:
+                drift_monitor.observe(models, vector, forecast.get('PREDICTED_LOS'), forecast['RISK_STRATIFICATION'])
+            except Exception as e:
+                app.logger.exception(e)
+        try:
+            if confidences:
+                forecast['CONFIDENCE_CURVE'] = risk_model.get_confidence_curve(
+                    models.risk_model, vector, confidences, ai_day_prediction=forecast.get('PREDICTED_LOS'),
+                    days_in_hospital=days_in_hospital)
+        except Exception as e:
+            app.logger.exception(e)
+            return jsonify('Error predicting against risk model'), 500
+        # Return success response containing forecast flag and dict of predicted values
+        response = dict(forecast=True, results=forecast, model_version=version)
+        if degraded:
+            response['degraded'] = True
+        return wire.encode_response(response, media_type)
 
     @app.route('/api/forecast', methods=['POST'])
+    @admission.limit(admission_controller)
     def get_forecast():
         """Generate forecast from the predictive models using the posted record object fields as input
 
         :return: JSON serialised object of LoS and risk prediction values
         """
-        # Check for json request body object
-        if not request.json:
-            return jsonify('Request body missing'), 400
-        # Flatten and vectorise the record
+        payload, media_type, error = decode_body()
+        if error is not None:
+            return error
+        try:
+            confidences, days_in_hospital = forecast_options()
+        except ValueError as e:
+            return jsonify(str(e)), 400
+        try:
+            models = select_models()
+        except registry.UnknownSite as e:
+            return jsonify(f'Unknown site: {e.args[0]}'), 404
+        except Exception as e:
+            app.logger.exception(e)
+            return jsonify('Error loading models'), 500
+        if request.args.get('input') == 'vector':
+            # Internal callers may post an already vectorised record
+            if not app.config['ACCEPT_VECTOR_INPUT']:
+                return jsonify('Pre-vectorised input is not enabled'), 400
+            try:
+                vector = wire.vector_from_payload(payload)
+            except ValueError as e:
+                return jsonify(str(e)), 400
+        else:
+            # Flatten and vectorise the record
+            try:
+                vector = vectorise_record(wire.flatten_record(payload), models.mapping)
+            except Exception as e:
+                app.logger.exception(e)
+                return jsonify('Error processing record'), 500
+        return forecast_response(models, vector, media_type, confidences, days_in_hospital)
+
+    @app.route('/api/spell/<spell_id>', methods=['PUT', 'PATCH'])
+    @admission.limit(admission_controller)
+    def update_spell(spell_id):
+        """Store (PUT) the full record of a spell in progress, or update changed fields of a stored spell's record
+        (PATCH), and re-score the spell's forecast. Updates only re-vectorise the changed fields.
+
+        :param spell_id: ID of the spell
+        :return: JSON serialised object of LoS and risk prediction values, as for the forecast endpoint
+        """
+        payload, media_type, error = decode_body()
+        if error is not None:
+            return error
+        try:
+            confidences, days_in_hospital = forecast_options()
+        except ValueError as e:
+            return jsonify(str(e)), 400
         try:
-            if isinstance(request.json, list):
-                flattened = {k: v for d in request.json for k, v in d.items()}
+            models = select_models()
+        except registry.UnknownSite as e:
+            return jsonify(f'Unknown site: {e.args[0]}'), 404
+        except Exception as e:
+            app.logger.exception(e)
+            return jsonify('Error loading models'), 500
+        # Spells are stored per site, as each site may vectorise records differently
+        key = (request_site(), spell_id)
+        try:
+            record = wire.flatten_record(payload)
+            if request.method == 'PUT':
+                vector = spell_cache.put(key, record, models.mapping)
             else:
-                flattened = request.json
-            vector = vectorise_record(flattened)
+                vector = spell_cache.patch(key, record, models.mapping)
         except Exception as e:
             app.logger.exception(e)
             return jsonify('Error processing record'), 500
-        # Check for non-major cases and return a no-forecast success response if the case is not identified as major
-        if vector.get('IS_MAJOR', 1) == 0:
-            return jsonify(dict(
-                forecast=False,
-                msg='Proof of concept system does not issue predictions for non-major cases',
-            ))
+        if vector is None:
+            # Spells are held per worker process, and may have been dropped from a full cache
+            return jsonify(f'Spell {spell_id} is not stored, PUT the full record'), 404
+        # Count each spell once, when it is first stored, rather than on every update
+        return forecast_response(models, vector, media_type, confidences, days_in_hospital,
+                                 observe=request.method == 'PUT')
+
+    @app.route('/api/spell/<spell_id>', methods=['DELETE'])
+    def delete_spell(spell_id):
+        """Drop a stored spell, e.g. on discharge
+
+        :param spell_id: ID of the spell
+        :return: Empty response
+        """
+        if not spell_cache.delete((request_site(), spell_id)):
+            return jsonify(f'Spell {spell_id} is not stored'), 404
+        return '', 204
+
+    @app.route('/api/forecast/whatif', methods=['POST'])
+    @admission.limit(admission_controller, kind='whatif')
+    def get_whatif_forecast():
+        """Forecast a base record and variations of its fields (e.g. every option of a categorised field, or toggling
+        comorbidity flags) in a single batched pass of the models, reusing the base record's vectorisation
+
+        :return: JSON serialised object of the base record's and each variant's forecast
+        """
+        payload, media_type, error = decode_body()
+        if error is not None:
+            return error
+        if not isinstance(payload, dict) or not payload.get('record'):
+            return jsonify('Request body must contain a record'), 400
         try:
-            # Generate length of stay prediction from univariate GAN model
-            forecast = los_model.get_prediction(LOS_MODEL, vector)
+            confidences, days_in_hospital = forecast_options()
+        except ValueError as e:
+            return jsonify(str(e)), 400
+        try:
+            models = select_models()
+        except registry.UnknownSite as e:
+            return jsonify(f'Unknown site: {e.args[0]}'), 404
         except Exception as e:
             app.logger.exception(e)
-            return jsonify('Error predicting against length of stay model'), 500
+            return jsonify('Error loading models'), 500
         try:
-            # Generate risk stratification prediction from CDF risk model
-            risk_predictions = risk_model.get_prediction(RISK_MODEL, vector,
-                                                         ai_day_prediction=forecast.get('PREDICTED_LOS'))
-            # Fuse model prediction dicts to a single forecast dict
-            forecast = dict(forecast, **risk_predictions)
+            base = IncrementalVector(models.mapping)
+            base.update(wire.flatten_record(payload['record']))
         except Exception as e:
             app.logger.exception(e)
-            return jsonify('Error predicting against risk model'), 500
-        # Return success response containing forecast flag and dict of predicted values
-        return jsonify(dict(forecast=True, results=forecast))
+            return jsonify('Error processing record'), 500
+        try:
+            variations = whatif.expand_variations(base, variations=payload.get('variations'),
+                                                  options=payload.get('options'), toggle=payload.get('toggle'))
+        except (ValueError, TypeError) as e:
+            return jsonify(str(e)), 400
+        if len(variations) > app.config['WHATIF_MAX_VARIANTS']:
+            return jsonify(f'Too many variants, at most {app.config["WHATIF_MAX_VARIANTS"]} may be scored'), 400
+        # Under pressure, serve the risk model alone, skipping the LoS model
+        ticket = g.get('admission')
+        degraded = ticket is not None and ticket.degraded
+        try:
+            forecast, variants = whatif.score_variants(models, base, variations, skip_los=degraded,
+                                                        confidences=confidences, days_in_hospital=days_in_hospital)
+        except Exception as e:
+            app.logger.exception(e)
+            return jsonify('Error predicting against models'), 500
+        response = dict(base=forecast, variants=variants, model_version=models.version)
+        if degraded:
+            response['degraded'] = True
+        return wire.encode_response(response, media_type)
+
+    @app.route('/api/forecast/fields')
+    def get_forecast_fields():
+        """Get the positional field orders of pre-vectorised inputs and compact forecast responses
+
+        :return: JSON serialised object of field name lists
+        """
+        return jsonify(wire.wire_fields())
+
+    @app.route('/api/census')
+    @admission.limit(admission_controller, kind='census')
+    def get_census():
+        """Score every record in the records file, re-scoring only records that are new or have changed since the
+        last request, and serve the predictions sorted and filtered by risk
+
+        :return: JSON serialised census object
+        """
+        # Parse explicitly, as `request.args.get(..., type=int)` silently ignores values that are not integers
+        try:
+            min_risk, max_risk, limit = [int(request.args[name]) if name in request.args else None
+                                         for name in ('min_risk', 'max_risk', 'limit')]
+        except ValueError:
+            return jsonify('Invalid census parameters'), 400
+        if limit is not None and limit < 0:
+            return jsonify('Invalid census parameters'), 400
+        sort = request.args.get('sort', 'risk')
+        ward = request.args.get('ward')
+        # Take a reference to the models, so the whole census is scored by one version
+        try:
+            models = select_models()
+        except registry.UnknownSite as e:
+            return jsonify(f'Unknown site: {e.args[0]}'), 404
+        except Exception as e:
+            LOG.exception(e)
+            return jsonify('Error loading models'), 500
+        path = os.path.join(RECORDS_DIR, RECORDS_FILE)
+        try:
+            version = records.get_records(path)
+            # Each site has its own census, scored by its own models
+            patient_census = census.get_census(path, site=request_site())
+            entries, rescored = patient_census.current(version, models)
+        except Exception as e:
+            LOG.exception(e)
+            return jsonify('Error scoring census'), 500
+        try:
+            filtered = census.filter_census(entries, min_risk=min_risk, max_risk=max_risk, ward=ward, sort=sort,
+                                            limit=limit)
+        except ValueError as e:
+            return jsonify(str(e)), 400
+        body = serialise(dict(
+            records=filtered,
+            count=len(filtered),
+            total=len(entries),
+            rescored=rescored,
+            model_version=models.version,
+        ))
+        # The census changes with both the records file and the models
+        return conditional_response(body, version, etag=f'{version.etag}-{models.version}')
+
+    def check_admin_token() -> bool:
+        """Check the request carries the configured admin token"""
+        token = app.config['ADMIN_TOKEN']
+        return bool(token) and hmac.compare_digest(request.headers.get('X-Admin-Token', ''), token)
+
+    @app.route('/api/admin/models')
+    def get_model_status():
+        """Report the active model version and reload state
+
+        :return: JSON serialised model status object
+        """
+        if not check_admin_token():
+            return jsonify('Forbidden'), 403
+        status = MODELS.status()
+        status['los_model_loaded'] = MODELS.active.los_loaded
+        if SITES is not None:
+            status['sites'] = SITES.status()
+        if admission_controller is not None:
+            status['admission'] = admission_controller.status()
+        if thread_plan is not None:
+            status['threads'] = thread_plan._asdict()
+        if model_client is not None:
+            status['model_server'] = model_client.status()
+        return jsonify(status)
+
+    @app.route('/api/admin/drift')
+    def get_drift():
+        """Report the counts of the records scored against the active models, merged across worker processes
+
+        :return: JSON serialised drift summary object
+        """
+        if not check_admin_token():
+            return jsonify('Forbidden'), 403
+        if drift_monitor is None:
+            return jsonify('Drift monitoring is not enabled'), 404
+        try:
+            models = select_models()
+        except registry.UnknownSite as e:
+            return jsonify(f'Unknown site: {e.args[0]}'), 404
+        except Exception as e:
+            LOG.exception(e)
+            return jsonify('Error loading models'), 500
+        summary = drift_monitor.merged(models.version)
+        if summary is None:
+            summary = dict(model_version=models.version, requests=0, workers=0)
+        return jsonify(summary)
+
+    @app.route('/api/admin/reload', methods=['POST'])
+    def reload_models():
+        """Reload the model artifacts in the background, swapping them in once loaded and validated.
+        Pass `?wait=true` to block until the reload completes, or `?site=<id>` to evict a site's models so they are
+        reloaded on the site's next request.
+
+        :return: JSON serialised model status object
+        """
+        if not check_admin_token():
+            return jsonify('Forbidden'), 403
+        site = request.args.get('site')
+        if site:
+            if SITES is None or site not in SITES.sites:
+                return jsonify(f'Unknown site: {site}'), 404
+            SITES.evict(site)
+            return jsonify(SITES.status())
+        wait = request.args.get('wait', 'false').lower() == 'true'
+        started = MODELS.reload(background=not wait)
+        if not started:
+            return jsonify(dict(MODELS.status(), msg='Reload already in progress')), 409
+        if not wait:
+            return jsonify(MODELS.status()), 202
+        # Report a failed reload, in which case the previous models remain active
+        return jsonify(MODELS.status()), 500 if MODELS.last_error is not None else 200
     # Return constructed flask app
     return app
@@ -0,0 +1,272 @@
+"""Admission control for the forecast endpoints: a concurrency limit with a bounded queue and per-request deadlines
+
+When demand spikes, requests that cannot be served before their deadline are rejected immediately with
+`503 Service Unavailable` and a `Retry-After` header, rather than queueing until they time out. Under pressure,
+requests may optionally be served in a degraded mode, in which forecasts skip the LoS model and are produced by the
+cheap CDF risk model alone.
+
+Limits apply per worker process, and need a worker with more threads than ADMISSION_MAX_CONCURRENT (see
+`deploy/uwsgi.ini`) for requests to queue in the controller rather than in uwsgi's listen queue. Deadlines are
+measured from the request's arrival at the front-end proxy, when it sets an `X-Request-Start` header, so time spent
+in the listen queue counts towards them. Service times are averaged separately for each kind of request (e.g. single
+forecasts, what-if batches and census rescores), so an expensive census does not make ordinary forecasts look too slow
+to serve.
+"""
+import functools
+import logging
+import math
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+from flask import g, jsonify, request
+
+# Constants to initialise logging
+LOG = logging.getLogger('ltss.admission')
+
+# Header in which clients may give a deadline for their request, in milliseconds
+DEADLINE_HEADER = 'X-Request-Deadline'
+# Header in which the front-end proxy gives the time the request arrived, as `t=<seconds since the epoch>`
+REQUEST_START_HEADER = 'X-Request-Start'
+# Weight of each new request in the moving average service time
+SERVICE_TIME_WEIGHT = 0.2
+# Kind of request whose service time is averaged, if not given
+DEFAULT_KIND = 'forecast'
+
+
+class Overloaded(Exception):
+    """
+    Raised when a request cannot be admitted before its deadline
+
+    :param reason: Why the request was rejected
+    :param retry_after: Suggested number of seconds before retrying
+    """
+
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class Ticket:
+    """
+    An admitted request, which holds one of the controller's slots until released
+
+    :param controller: Controller the request was admitted by
+    :param expires: Monotonic time of the request's deadline
+    :param waited: Time spent waiting for a slot since the request arrived, in seconds
+    :param degraded: Whether the request should be served in degraded mode
+    :param kind: Kind of request, whose service time it counts towards
+    """
+
+    def __init__(self, controller: 'AdmissionController', expires: float, waited: float, degraded: bool,
+                 kind: str = DEFAULT_KIND):
+        self.controller = controller
+        self.expires = expires
+        self.waited = waited
+        self.degraded = degraded
+        self.kind = kind
+        self.admitted = time.monotonic()
+
+    def remaining(self) -> float:
+        """Time remaining before the request's deadline, in seconds"""
+        return self.expires - time.monotonic()
+
+    def __enter__(self) -> 'Ticket':
+        return self
+
+    def __exit__(self, *exc):
+        self.controller.release(self)
+
+
+class AdmissionController:
+    """
+    Limit the number of requests served at once, queueing a bounded number of requests for a slot. Requests are
+    rejected on arrival if the queue is full or the expected wait would exceed their deadline, and rejected while
+    queued if their deadline passes.
+
+    :param max_concurrent: Maximum number of requests served at once
+    :param max_queue: Maximum number of requests waiting for a slot
+    :param deadline: Maximum time a request may wait and be served in, in seconds
+    :param degrade_queue_depth: Serve requests in degraded mode when at least this many requests are waiting (None to
+    never degrade)
+    """
+
+    def __init__(self, max_concurrent: int, max_queue: int, deadline: float,
+                 degrade_queue_depth: Optional[int] = None):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.deadline = deadline
+        self.degrade_queue_depth = degrade_queue_depth
+        self._condition = threading.Condition()
+        self.in_flight = 0
+        self.waiting = 0
+        # Moving average time to serve a full (not degraded) request of each kind, in seconds
+        self.service_times: Dict[str, float] = {}
+        self.admitted = 0
+        self.rejected = 0
+        self.degraded = 0
+
+    def expected_wait(self, position: int, kind: str = DEFAULT_KIND) -> float:
+        """
+        Estimate how long a request would wait for a slot, assuming every slot is busy with requests of its kind
+
+        :param position: Number of requests already waiting ahead of it
+        :param kind: Kind of request
+        :return: Expected wait in seconds
+        """
+        service_time = self.service_times.get(kind)
+        if service_time is None:
+            return 0.0
+        return (position // self.max_concurrent + 1) * service_time
+
+    def _reject(self, reason: str, position: int, kind: str):
+        """Count and raise a rejection, suggesting a retry once the current queue has drained"""
+        self.rejected += 1
+        raise Overloaded(reason, max(1, math.ceil(self.expected_wait(position, kind))))
+
+    def admit(self, deadline: Optional[float] = None, queued: float = 0.0, kind: str = DEFAULT_KIND) -> Ticket:
+        """
+        Wait for a slot, up to the request's deadline
+
+        :param deadline: Client's deadline for the request in seconds, if sooner than the controller's deadline
+        :param queued: Time the request spent queued before reaching the app (e.g. in uwsgi's listen queue), in
+        seconds, which counts towards its deadline
+        :param kind: Kind of request, whose recent service time estimates its wait and cost
+        :return: Ticket holding the slot, to be released once the request is served
+        :raises Overloaded: If the request cannot be admitted before its deadline
+        """
+        budget = (self.deadline if deadline is None else min(deadline, self.deadline)) - queued
+        start = time.monotonic()
+        expires = start + budget
+        with self._condition:
+            if budget <= 0:
+                self._reject('deadline passed before arrival', self.waiting, kind)
+            # Queue behind any waiting requests, so a newly freed slot goes to a request that has already waited
+            if self.in_flight >= self.max_concurrent or self.waiting > 0:
+                if self.waiting >= self.max_queue:
+                    self._reject('queue full', self.waiting, kind)
+                if self.expected_wait(self.waiting, kind) > budget:
+                    self._reject('deadline would be missed', self.waiting, kind)
+                self.waiting += 1
+                try:
+                    while self.in_flight >= self.max_concurrent:
+                        remaining = expires - time.monotonic()
+                        if remaining <= 0:
+                            self._reject('deadline passed while queued', self.waiting - 1, kind)
+                        self._condition.wait(remaining)
+                finally:
+                    self.waiting -= 1
+            self.in_flight += 1
+            self.admitted += 1
+            degraded = self.degrade_queue_depth is not None and self.waiting >= self.degrade_queue_depth
+            # Also degrade if a full request of its kind would not finish before the deadline
+            service_time = self.service_times.get(kind)
+            if self.degrade_queue_depth is not None and service_time is not None and \
+                    expires - time.monotonic() < service_time:
+                degraded = True
+            if degraded:
+                self.degraded += 1
+        return Ticket(self, expires, queued + time.monotonic() - start, degraded, kind)
+
+    def release(self, ticket: Ticket):
+        """
+        Release a request's slot to the next waiting request
+
+        :param ticket: Ticket of the served request
+        """
+        duration = time.monotonic() - ticket.admitted
+        with self._condition:
+            self.in_flight -= 1
+            # Only full requests measure the cost of a full request
+            if not ticket.degraded:
+                service_time = self.service_times.get(ticket.kind)
+                self.service_times[ticket.kind] = duration if service_time is None else \
+                    (1 - SERVICE_TIME_WEIGHT) * service_time + SERVICE_TIME_WEIGHT * duration
+            self._condition.notify()
+
+    def status(self) -> Dict:
+        """Summary of the controller's load and counters"""
+        return dict(
+            max_concurrent=self.max_concurrent,
+            max_queue=self.max_queue,
+            in_flight=self.in_flight,
+            waiting=self.waiting,
+            service_times=dict(self.service_times),
+            admitted=self.admitted,
+            rejected=self.rejected,
+            degraded=self.degraded,
+        )
+
+
+def parse_deadline(value: Optional[str]) -> Optional[float]:
+    """Parse a client deadline header in milliseconds to seconds, ignoring missing or invalid values"""
+    try:
+        deadline = float(value) / 1000
+    except (TypeError, ValueError):
+        return None
+    return deadline if deadline > 0 else None
+
+
+def parse_request_start(value: Optional[str]) -> float:
+    """
+    Parse a proxy's request start header (`t=<seconds since the epoch>`, as set from nginx's `$msec`) to the time since
+    the request arrived, ignoring missing or invalid values and clock skew between the proxy and the app
+
+    :param value: Header value
+    :return: Seconds since the request arrived (0 if unknown)
+    """
+    if value is None:
+        return 0.0
+    try:
+        started = float(value[2:] if value.startswith('t=') else value)
+    except ValueError:
+        return 0.0
+    return max(0.0, time.time() - started)
+
+
+def limit(controller: Optional[AdmissionController], kind: str = DEFAULT_KIND) -> Callable:
+    """
+    Decorate a Flask view to admit requests through a controller, responding `503 Service Unavailable` with a
+    `Retry-After` header if a request cannot be admitted. The admitted request's ticket is available to the view as
+    `flask.g.admission`.
+
+    :param controller: Admission controller (None to admit every request)
+    :param kind: Kind of request the view serves, for requests of different costs to keep separate service times
+    :return: View decorator
+    """
+    def decorator(view: Callable) -> Callable:
+        if controller is None:
+            return view
+
+        @functools.wraps(view)
+        def admitted_view(*args, **kwargs):
+            try:
+                ticket = controller.admit(parse_deadline(request.headers.get(DEADLINE_HEADER)),
+                                          queued=parse_request_start(request.headers.get(REQUEST_START_HEADER)),
+                                          kind=kind)
+            except Overloaded as e:
+                LOG.warning(f'Rejected request to {request.path}: {e.reason}')
+                response = jsonify(f'Server is busy ({e.reason}), please retry')
+                response.status_code = 503
+                response.headers['Retry-After'] = str(e.retry_after)
+                return response
+            g.admission = ticket
+            with ticket:
+                return view(*args, **kwargs)
+        return admitted_view
+    return decorator
+
+
+def from_config(config: Dict) -> Optional[AdmissionController]:
+    """
+    Create the admission controller configured for the app
+
+    :param config: App configuration
+    :return: Admission controller, or None if admission control is disabled
+    """
+    if not config.get('ADMISSION_MAX_CONCURRENT'):
+        return None
+    return AdmissionController(config['ADMISSION_MAX_CONCURRENT'], config['ADMISSION_MAX_QUEUE'],
+                               config['ADMISSION_DEADLINE'],
+                               degrade_queue_depth=config.get('ADMISSION_DEGRADE_QUEUE_DEPTH'))
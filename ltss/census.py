@@ -0,0 +1,162 @@
+"""Risk census of every record in the records file, re-scoring only records that have changed"""
+import logging
+import threading
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from ltss import los_model, risk_model
+from ltss.records import RecordsVersion, record_hash
+from ltss.registry import ModelBundle
+from ltss.utils import flatten_vector
+from ltss.vectorise import vectorise_record
+
+# Constants to initialise logging
+LOG = logging.getLogger('ltss.census')
+
+# Record fields copied into each census entry, to identify the patient and ward
+CENSUS_RECORD_FIELDS = [
+    'LOCAL_PATIENT_IDENTIFIER',
+    'FIRST_WARD_STAY_IDENTIFIER',
+    'MAIN_SPECIALTY_CODE_AT_ADMISSION_DESCRIPTION',
+    'START_DATE_HOSPITAL_PROVIDER_SPELL',
+]
+
+# Prediction fields included in each census entry
+CENSUS_PREDICTION_FIELDS = [
+    'PREDICTED_LOS',
+    'RISK_STRATIFICATION',
+    'PERCENTAGE_RISK_CAT',
+    'MOT_DAYS',
+]
+
+
+def score_records(models: ModelBundle, records: List[Dict[str, str]]) -> List[Dict]:
+    """
+    Vectorise and score a list of records, running each model over all major records in a single batch
+
+    :param models: Models to score with
+    :param records: Parsed records
+    :return: List of census predictions, one per record, with a STATUS of ok, non_major or error
+    """
+    scored = [dict(STATUS='non_major') for _ in records]
+    to_predict = []
+    for entry, record in zip(scored, records):
+        try:
+            vector = vectorise_record(record, models.mapping)
+        except Exception as e:
+            LOG.exception(e)
+            entry['STATUS'] = 'error'
+            continue
+        # Non-major cases are out of scope for the models, as in the forecast endpoint
+        if vector.get('IS_MAJOR', 1) != 0:
+            to_predict.append((entry, flatten_vector(vector)))
+    if not to_predict:
+        return scored
+    matrix = np.vstack([vector for _, vector in to_predict])
+    predicted_los = los_model.predict_matrix(models.los_model, matrix)
+    risk_predictions, known = risk_model.get_predictions(models.risk_model, matrix, ai_day_predictions=predicted_los)
+    for i, (entry, _) in enumerate(to_predict):
+        # Records with no factors known to the risk model cannot be stratified
+        if not known[i]:
+            entry['STATUS'] = 'error'
+            continue
+        entry.update({k: v[i].item() for k, v in risk_predictions.items() if k in CENSUS_PREDICTION_FIELDS})
+        entry['PREDICTED_LOS'] = predicted_los[i].item()
+        entry['STATUS'] = 'ok'
+    return scored
+
+
+class Census:
+    """
+    Scored census of every record in a records file, for a single model version.
+
+    Predictions are cached against a hash of each record's content, so when the records file changes only new or
+    changed records are vectorised and scored. A change of model version re-scores every record.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._key: Optional[Tuple] = None
+        self._entries: List[Dict] = []
+        self._scores: Dict[bytes, Dict] = {}
+        self._model_version: Optional[str] = None
+
+    def current(self, version: RecordsVersion, models: ModelBundle) -> Tuple[List[Dict], int]:
+        """
+        Get the census for a version of the records file, scoring any records not already scored by the models
+
+        :param version: Current version of the records file
+        :param models: Models to score with
+        :return: List of census entries, in records file order, and the number of records scored to produce them (0
+        if the census was already current)
+        """
+        key = (version.stamp, models.version)
+        with self._lock:
+            if self._key == key:
+                return self._entries, 0
+            # Cached scores are only valid for the model version that produced them
+            scores = self._scores if self._model_version == models.version else {}
+            hashes = [record_hash(record) for record in version.records]
+            changed = {h: record for h, record in zip(hashes, version.records) if h not in scores}
+            if changed:
+                LOG.debug(f'Scoring {len(changed)} new or changed records of {len(hashes)}')
+                scores = dict(scores)
+                scores.update(zip(changed.keys(), score_records(models, list(changed.values()))))
+            entries = []
+            for index, (h, record) in enumerate(zip(hashes, version.records)):
+                entry = dict(RECORD_ID=index, **{field: record.get(field) for field in CENSUS_RECORD_FIELDS})
+                entry.update(scores[h])
+                entries.append(entry)
+            # Drop scores for records no longer in the file, so the cache is bounded by the size of the file
+            self._scores = {h: scores[h] for h in hashes}
+            self._model_version = models.version
+            self._entries = entries
+            self._key = key
+        return entries, len(changed)
+
+
+def filter_census(entries: List[Dict], min_risk: Optional[int] = None, max_risk: Optional[int] = None,
+                  ward: Optional[str] = None, sort: str = 'risk', limit: Optional[int] = None) -> List[Dict]:
+    """
+    Filter and sort census entries
+
+    :param entries: Census entries
+    :param min_risk: Only include scored records with at least this risk stratification
+    :param max_risk: Only include scored records with at most this risk stratification
+    :param ward: Only include records with this ward identifier
+    :param sort: Sort order: `risk` (highest first), `los` (longest predicted stay first), or `record` (file order)
+    :param limit: Maximum number of entries to return
+    :return: Filtered and sorted census entries
+    """
+    if min_risk is not None or max_risk is not None:
+        low = min_risk if min_risk is not None else 1
+        high = max_risk if max_risk is not None else 5
+        entries = [e for e in entries if e['STATUS'] == 'ok' and low <= e['RISK_STRATIFICATION'] <= high]
+    if ward is not None:
+        entries = [e for e in entries if e.get('FIRST_WARD_STAY_IDENTIFIER') == ward.lower()]
+    if sort == 'risk':
+        entries = sorted(entries, key=lambda e: (-e.get('RISK_STRATIFICATION', 0), -e.get('PREDICTED_LOS', 0)))
+    elif sort == 'los':
+        entries = sorted(entries, key=lambda e: -e.get('PREDICTED_LOS', 0))
+    elif sort != 'record':
+        raise ValueError(f'Unknown census sort order: {sort}')
+    return entries[:limit] if limit is not None else entries
+
+
+# Census for each records file and site served, keyed on path and site ID
+_CENSUSES: Dict[Tuple[str, Optional[str]], Census] = {}
+
+
+def get_census(path: str, site: Optional[str] = None) -> Census:
+    """
+    Get the in-process census for a records file
+
+    :param path: Path to the records file
+    :param site: Site whose models score the census (None for the default models)
+    :return: Census of the records file
+    """
+    census = _CENSUSES.get((path, site))
+    if census is None:
+        census = _CENSUSES.setdefault((path, site), Census())
+    return census
@@ -0,0 +1,353 @@
+"""Streaming input-drift summaries of the records scored on the forecast path
+
+Each worker process keeps constant-memory counts of the vectorised records it scores against each model version: the
+count of each category known to the risk model for every selector, the number of values each selector sees that the
+risk model has no distribution for (which then contribute nothing to the forecast), the number of records with no
+known values at all (forecast from the risk model's base distribution alone), and histograms of `PREDICTED_LOS` and
+`RISK_STRATIFICATION`.
+
+Requests only queue a reference to the scored record, and records are folded into the counts in batches by a
+background thread, so the cost on the forecast path is well under a microsecond. Snapshots of the counts are plain
+objects that merge by addition, and workers may write their snapshots to a shared directory to be merged by whichever
+worker serves the drift endpoint. Workers remove their snapshot file on exit, and files of workers that have died
+without doing so (e.g. killed on a uwsgi respawn) are skipped, as are files that have not been refreshed recently.
+"""
+import atexit
+import glob
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from ltss.registry import ModelBundle
+from ltss.risk_model import RiskCDFModel
+from ltss.utils import MODEL_SELECTORS
+
+# Constants to initialise logging
+LOG = logging.getLogger('ltss.drift')
+
+# Spacing between the codes of each selector's categories, so every selector's categories can be looked up at once
+CODE_STRIDE = 2 ** 24
+# Number of whole-day PREDICTED_LOS bins, the last holding every prediction of at least LOS_BINS - 1 days
+LOS_BINS = 31
+# Number of model versions to keep counts for, per worker process
+MAX_SKETCHES = 16
+# Default value of each selector missing from a vector
+_MISSING = [-1] * len(MODEL_SELECTORS)
+
+
+def _category_label(key: float) -> str:
+    """Format a category value as a snapshot key"""
+    return str(int(key)) if float(key).is_integer() else str(float(key))
+
+
+class DriftSketch:
+    """
+    Constant-memory counts of the records scored against one version of the models
+
+    :param predictor: Risk model of the model version, defining the known categories of each selector
+    :param version: Model version
+    """
+
+    def __init__(self, predictor: RiskCDFModel, version: str):
+        self.version = version
+        # Selectors the risk model has category distributions for, as columns of the flattened vectors
+        self.columns = [column for column, selector in enumerate(MODEL_SELECTORS)
+                        if predictor.distributions.get(selector)]
+        codes, selectors, labels = [], [], []
+        for column in self.columns:
+            for key in sorted(set(float(k) for k in predictor.distributions[MODEL_SELECTORS[column]])):
+                codes.append(column * CODE_STRIDE + key)
+                selectors.append(column)
+                labels.append(_category_label(key))
+        # Sorted codes of every known category, each offset by its selector's column
+        self._codes = np.array(codes, dtype=float)
+        self._selectors = np.array(selectors, dtype=int)
+        self._labels = labels
+        self._offsets = np.array(self.columns, dtype=float) * CODE_STRIDE
+        self.requests = 0
+        self.base_fallback = 0
+        self.category_counts = np.zeros(len(codes), dtype=np.int64)
+        self.unseen_counts = np.zeros(len(self.columns), dtype=np.int64)
+        self.los_counts = np.zeros(LOS_BINS, dtype=np.int64)
+        self.los_missing = 0
+        self.risk_counts = np.zeros(5, dtype=np.int64)
+
+    def update(self, matrix: np.ndarray, predicted_los: np.ndarray, risk: np.ndarray):
+        """
+        Count a batch of scored records
+
+        :param matrix: N x len(MODEL_SELECTORS) array of flattened vectors
+        :param predicted_los: Array of N predicted lengths of stay (NaN where the LoS model was skipped)
+        :param risk: Array of N risk bands
+        """
+        self.requests += len(matrix)
+        if len(self._codes):
+            # Clip values into their selector's code range, so unknown values never match another selector's codes
+            values = np.clip(matrix[:, self.columns], 1 - CODE_STRIDE / 2, CODE_STRIDE / 2 - 1)
+            codes = values + self._offsets
+            index = np.minimum(np.searchsorted(self._codes, codes), len(self._codes) - 1)
+            matched = self._codes[index] == codes
+            self.category_counts += np.bincount(index[matched], minlength=len(self._codes))
+            self.unseen_counts += np.sum(~matched, axis=0)
+            self.base_fallback += int(np.sum(~matched.any(axis=1)))
+        else:
+            self.base_fallback += len(matrix)
+        known_los = ~np.isnan(predicted_los)
+        self.los_missing += int(np.sum(~known_los))
+        days = np.clip(np.floor(predicted_los[known_los]), 0, LOS_BINS - 1).astype(int)
+        self.los_counts += np.bincount(days, minlength=LOS_BINS)
+        self.risk_counts += np.bincount(np.clip(risk, 1, 5).astype(int) - 1, minlength=5)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """
+        Get the counts as a plain object, which merges with other snapshots of the same model version by addition
+
+        :return: Snapshot object
+        """
+        selectors = {MODEL_SELECTORS[column]: dict(categories={}, unseen=int(unseen))
+                     for column, unseen in zip(self.columns, self.unseen_counts)}
+        for column, label, count in zip(self._selectors, self._labels, self.category_counts):
+            selectors[MODEL_SELECTORS[column]]['categories'][label] = int(count)
+        return dict(
+            model_version=self.version,
+            requests=self.requests,
+            base_fallback=self.base_fallback,
+            selectors=selectors,
+            predicted_los=dict(days=self.los_counts.tolist(), missing=self.los_missing),
+            risk_stratification={str(band): int(count) for band, count in enumerate(self.risk_counts, 1)},
+        )
+
+
+def merge_snapshots(snapshots: List[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """
+    Merge snapshots of the same model version, e.g. from several worker processes
+
+    :param snapshots: Snapshots to merge
+    :return: Merged snapshot, or None if there are no snapshots
+    """
+    if not snapshots:
+        return None
+    merged = json.loads(json.dumps(snapshots[0]))
+    for snapshot in snapshots[1:]:
+        merged['requests'] += snapshot['requests']
+        merged['base_fallback'] += snapshot['base_fallback']
+        for selector, counts in snapshot['selectors'].items():
+            target = merged['selectors'].setdefault(selector, dict(categories={}, unseen=0))
+            target['unseen'] += counts['unseen']
+            for label, count in counts['categories'].items():
+                target['categories'][label] = target['categories'].get(label, 0) + count
+        merged['predicted_los']['days'] = [a + b for a, b in zip(merged['predicted_los']['days'],
+                                                                  snapshot['predicted_los']['days'])]
+        merged['predicted_los']['missing'] += snapshot['predicted_los']['missing']
+        for band, count in snapshot['risk_stratification'].items():
+            merged['risk_stratification'][band] = merged['risk_stratification'].get(band, 0) + count
+    return merged
+
+
+def summarise(snapshot: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Add the rate of unseen values of each selector, and of records forecast from the base distribution, to a snapshot
+
+    :param snapshot: Snapshot (or merged snapshot)
+    :return: Snapshot with rates
+    """
+    requests = snapshot['requests']
+    summary = dict(snapshot, base_fallback_rate=snapshot['base_fallback'] / requests if requests else 0.0)
+    summary['selectors'] = {selector: dict(counts, unseen_rate=counts['unseen'] / requests if requests else 0.0)
+                            for selector, counts in snapshot['selectors'].items()}
+    return summary
+
+
+class DriftMonitor:
+    """
+    Queue scored records for counting, folding them into per-model-version sketches in the background
+
+    :param max_pending: Maximum number of records to queue, beyond which a request folds the queue itself
+    :param interval: Seconds between background folds (and snapshot writes)
+    :param snapshot_dir: Optional directory shared by the worker processes to write snapshots to
+    :param max_age: Seconds after which another worker's snapshot file is considered stale and skipped. Each worker
+    rewrites its file at least every max_age / 2 seconds while it runs.
+    """
+
+    def __init__(self, max_pending: int = 1024, interval: float = 1.0, snapshot_dir: Optional[str] = None,
+                 max_age: float = 60.0):
+        self.max_pending = max_pending
+        self.interval = interval
+        self.snapshot_dir = snapshot_dir
+        self.max_age = max_age
+        self._written: Optional[float] = None
+        self._pending: List[Tuple[ModelBundle, Dict, Optional[float], int]] = []
+        self._pending_lock = threading.Lock()
+        self._fold_lock = threading.Lock()
+        self._sketches: 'OrderedDict[str, DriftSketch]' = OrderedDict()
+        self._thread: Optional[threading.Thread] = None
+        self._dirty = False
+
+    def observe(self, models: ModelBundle, vector: Dict[str, Any], predicted_los: Optional[float], risk: int):
+        """
+        Queue a scored record for counting
+
+        :param models: Models the record was scored against
+        :param vector: Vectorised record
+        :param predicted_los: Predicted length of stay (None if the LoS model was skipped)
+        :param risk: Risk band
+        """
+        with self._pending_lock:
+            self._pending.append((models, vector, predicted_los, risk))
+            full = len(self._pending) >= self.max_pending
+        if self._thread is None:
+            self._start()
+        if full:
+            # The background thread has fallen behind (or is not running), so keep the queue bounded
+            self.fold()
+
+    def _start(self):
+        """Start the background fold thread, once per process"""
+        with self._fold_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='ltss-drift', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        """Fold queued records, and write snapshots, every interval"""
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.fold()
+                # Rewrite unchanged snapshots too, often enough that other workers do not consider them stale
+                if self.snapshot_dir is not None and (self._dirty or self._written is not None and
+                                                      time.monotonic() - self._written >= self.max_age / 2):
+                    self.write_snapshots()
+            except Exception as e:
+                LOG.exception(e)
+
+    def fold(self):
+        """Fold the queued records into the sketches of their model versions"""
+        with self._pending_lock:
+            pending, self._pending = self._pending, []
+        if not pending:
+            return
+        batches: Dict[str, List] = {}
+        for entry in pending:
+            batches.setdefault(entry[0].version, []).append(entry)
+        with self._fold_lock:
+            for version, entries in batches.items():
+                sketch = self._sketches.get(version)
+                if sketch is None:
+                    sketch = self._sketches[version] = DriftSketch(entries[0][0].risk_model, version)
+                    while len(self._sketches) > MAX_SKETCHES:
+                        self._sketches.popitem(last=False)
+                self._sketches.move_to_end(version)
+                # Flatten the whole batch at once, filling in -1 for missing values as `flatten_vector` does
+                values = itertools.chain.from_iterable(map(vector.get, MODEL_SELECTORS, _MISSING)
+                                                       for _, vector, _, _ in entries)
+                matrix = np.fromiter(values, dtype=float, count=len(entries) * len(MODEL_SELECTORS)).reshape(
+                    len(entries), len(MODEL_SELECTORS))
+                predicted_los = np.array([los if los is not None else np.nan for _, _, los, _ in entries],
+                                         dtype=float)
+                risk = np.array([risk for _, _, _, risk in entries], dtype=int)
+                sketch.update(matrix, predicted_los, risk)
+            self._dirty = True
+
+    def snapshot(self, version: str) -> Optional[Dict[str, Any]]:
+        """
+        Get this worker's snapshot of a model version, including any queued records
+
+        :param version: Model version
+        :return: Snapshot, or None if no records have been scored against the version
+        """
+        self.fold()
+        with self._fold_lock:
+            sketch = self._sketches.get(version)
+            return sketch.snapshot() if sketch is not None else None
+
+    def _snapshot_file(self, pid: int) -> str:
+        """Path of a worker's snapshot file"""
+        return os.path.join(self.snapshot_dir, f'drift-{pid}.json')
+
+    def write_snapshots(self):
+        """Write this worker's snapshots of every model version to the shared snapshot directory"""
+        with self._fold_lock:
+            snapshots = [sketch.snapshot() for sketch in self._sketches.values()]
+            self._dirty = False
+        os.makedirs(self.snapshot_dir, exist_ok=True)
+        path = self._snapshot_file(os.getpid())
+        # Write then rename, so other workers never read a partial file
+        with open(path + '.tmp', 'w') as fp:
+            json.dump(snapshots, fp, separators=(',', ':'))
+        os.replace(path + '.tmp', path)
+        if self._written is None:
+            atexit.register(self.remove_snapshots)
+        self._written = time.monotonic()
+
+    def remove_snapshots(self):
+        """Remove this worker's snapshot file, so its counts are no longer merged once it exits"""
+        try:
+            os.unlink(self._snapshot_file(os.getpid()))
+        except OSError:
+            pass
+
+    def _is_live(self, path: str) -> bool:
+        """Whether a snapshot file belongs to a running worker, and has been refreshed within max_age seconds"""
+        try:
+            pid = int(os.path.basename(path)[len('drift-'):-len('.json')])
+            if time.time() - os.path.getmtime(path) > self.max_age:
+                return False
+            # Signal 0 only checks that the process exists
+            os.kill(pid, 0)
+        except PermissionError:
+            # The process exists, but belongs to another user
+            return True
+        except (OSError, ValueError):
+            return False
+        return True
+
+    def merged(self, version: str) -> Optional[Dict[str, Any]]:
+        """
+        Get the snapshot of a model version merged across every worker process sharing the snapshot directory
+
+        :param version: Model version
+        :return: Merged snapshot with rates, and the number of workers merged, or None if no records have been scored
+        against the version
+        """
+        snapshots = []
+        local = self.snapshot(version)
+        if local is not None:
+            snapshots.append(local)
+        if self.snapshot_dir is not None:
+            own = self._snapshot_file(os.getpid())
+            for path in glob.glob(os.path.join(self.snapshot_dir, 'drift-*.json')):
+                if path == own or not self._is_live(path):
+                    continue
+                try:
+                    with open(path, 'r') as fp:
+                        snapshots.extend(s for s in json.load(fp) if s['model_version'] == version)
+                except (OSError, ValueError) as e:
+                    LOG.warning(f'Skipping unreadable drift snapshot {path}: {e}')
+        merged = merge_snapshots(snapshots)
+        if merged is None:
+            return None
+        summary = summarise(merged)
+        summary['workers'] = len(snapshots)
+        return summary
+
+
+def from_config(config: Dict) -> Optional[DriftMonitor]:
+    """
+    Create the drift monitor configured for the app
+
+    :param config: App configuration
+    :return: Drift monitor, or None if drift monitoring is disabled
+    """
+    if not config.get('DRIFT_MONITOR'):
+        return None
+    return DriftMonitor(max_pending=config.get('DRIFT_MAX_PENDING', 1024), interval=config.get('DRIFT_INTERVAL', 1.0),
+                        snapshot_dir=config.get('DRIFT_SNAPSHOT_DIR'),
+                        max_age=config.get('DRIFT_SNAPSHOT_MAX_AGE', 60.0))
@@ -1,10 +1,17 @@
 """Length of stay AI model"""
-from typing import Dict, Tuple, Any
+import copy
+import logging
+import os
+from typing import Dict, Tuple, Any, Optional, Union, List
 
+import numpy as np
 import torch
 import torch.nn as nn
 
-from .utils import reshape_vector
+from .utils import reshape_vector, reshape_matrix
+
+# Constants to initialise logging
+LOG = logging.getLogger('ltss.los_model')
 
 
 class LoSPredictor(nn.Module):
@@ -80,35 +87,369 @@ class LoSPredictor(nn.Module):
         return self.pred(x)
 
 
+class QuantisedLoSPredictor(nn.Module):
+    """
+    Int8 post-training quantised copy of a trained LoSPredictor, for cheaper CPU inference at serving time.
+
+    Convolution and batch normalisation layers are fused before quantisation, and quant/dequant stubs are placed
+    around the network so the model accepts and returns the same float tensors as the original predictor.
+
+    :param predictor: Trained LoSPredictor to copy the network from
+    """
+    def __init__(self, predictor: LoSPredictor):
+        super(QuantisedLoSPredictor, self).__init__()
+        self.quant = torch.quantization.QuantStub()
+        self.pred = copy.deepcopy(predictor.pred)
+        self.dequant = torch.quantization.DeQuantStub()
+
+    def fuse_model(self):
+        """Fuse each conv/batch norm pair, and the final conv/ReLU pair, in place ahead of quantisation"""
+        for index in ['2', '3', '4']:
+            torch.quantization.fuse_modules(self.pred[int(index)], ['0', '1'], inplace=True)
+        torch.quantization.fuse_modules(self.pred, ['5', '6'], inplace=True)
+
+    def forward(self, x):
+        return self.dequant(self.pred(self.quant(x)))
+
+
+class EnsembleLoSPredictor(nn.Module):
+    """
+    Ensemble of K trained LoSPredictor checkpoints stacked into a single wider network, so that every member is run in
+    one forward pass at close to the cost of a single model.
+
+    The first convolution's filters are concatenated, as every member reads the same input. Each later convolution is
+    grouped, with group k holding member k's weights, and batch normalisation statistics are concatenated in the same
+    order, so members never mix. The network returns one prediction per member.
+
+    :param members: Trained LoSPredictor instances, with the same dimensions
+    """
+    def __init__(self, members: List[LoSPredictor]):
+        super(EnsembleLoSPredictor, self).__init__()
+        if not all(type(member) is LoSPredictor for member in members):
+            raise ValueError('Only LoSPredictor checkpoints can be served as an ensemble')
+        self.members = len(members)
+        first = self._stacked_conv([member.pred[0] for member in members], groups=1)
+        blocks = [
+            nn.Sequential(
+                self._stacked_conv([member.pred[index][0] for member in members], groups=self.members),
+                self._stacked_norm([member.pred[index][1] for member in members]),
+                nn.LeakyReLU(0.2),
+            )
+            for index in (2, 3, 4)
+        ]
+        final = self._stacked_conv([member.pred[5] for member in members], groups=self.members)
+        # Input Shape: N x F x 8 x 8, Output Shape: N x K x 1 x 1
+        self.pred = nn.Sequential(first, nn.LeakyReLU(0.2), *blocks, final, nn.ReLU())
+
+    @staticmethod
+    def _stacked_conv(convs: List[nn.Conv2d], groups: int) -> nn.Conv2d:
+        """Stack the members' convolutions into one convolution, grouped by member if the input is per member"""
+        conv = convs[0]
+        stacked = nn.Conv2d(conv.in_channels * groups, conv.out_channels * len(convs), kernel_size=conv.kernel_size,
+                            stride=conv.stride, padding=conv.padding, groups=groups, bias=conv.bias is not None)
+        with torch.no_grad():
+            stacked.weight.copy_(torch.cat([c.weight for c in convs]))
+            if conv.bias is not None:
+                stacked.bias.copy_(torch.cat([c.bias for c in convs]))
+        return stacked
+
+    @staticmethod
+    def _stacked_norm(norms: List[nn.BatchNorm2d]) -> nn.BatchNorm2d:
+        """Stack the members' batch normalisation parameters and running statistics into one layer"""
+        stacked = nn.BatchNorm2d(norms[0].num_features * len(norms), eps=norms[0].eps, momentum=norms[0].momentum)
+        with torch.no_grad():
+            for name in ('weight', 'bias', 'running_mean', 'running_var'):
+                getattr(stacked, name).copy_(torch.cat([getattr(norm, name) for norm in norms]))
+        return stacked
+
+    def forward(self, x):
+        return self.pred(x)
+
+
+class StudentLoSPredictor(nn.Module):
+    """
+    Compact LoS model distilled from a trained LoSPredictor (the teacher) by `training/distill_los.py`, and served in
+    its place. It takes the same N x 1 x 8 x 8 input as the LoSPredictor, and returns one prediction per record.
+
+    The `mlp` architecture reads each record as the flat (zero padded) vector from `flatten_vector`, through `layers`
+    fully connected layers of `width` units. The `cnn` architecture is a narrow two layer version of the
+    LoSPredictor's convolutions, with `width` filters in the first layer. Inputs are standardised with the mean and
+    standard deviation of the training data, held as buffers so they are saved with the weights.
+
+    :param arch: Student architecture, 'mlp' or 'cnn'
+    :param width: Number of units in each hidden layer of the MLP, or of filters in the first layer of the CNN
+    :param layers: Number of hidden layers of the MLP
+    """
+    def __init__(self, arch: str = 'mlp', width: int = 64, layers: int = 2):
+        super(StudentLoSPredictor, self).__init__()
+        # Saved with the weights, so `init_model` can rebuild the network
+        self.config = dict(arch=arch, width=width, layers=layers)
+        self.register_buffer('input_mean', torch.zeros(1, 1, 8, 8))
+        self.register_buffer('input_std', torch.ones(1, 1, 8, 8))
+        if arch == 'mlp':
+            modules = [nn.Flatten()]
+            inputs = 64
+            for _ in range(layers):
+                modules += [nn.Linear(inputs, width), nn.ReLU()]
+                inputs = width
+            modules.append(nn.Linear(inputs, 1))
+        elif arch == 'cnn':
+            modules = [
+                # Input Shape: N x 1 x 8 x 8, Output: N x W x 7 x 7
+                nn.Conv2d(1, width, kernel_size=4, stride=1, padding=1),
+                nn.LeakyReLU(0.2),
+                # Output: N x 2W x 6 x 6
+                nn.Conv2d(width, width * 2, kernel_size=4, stride=1, padding=1),
+                nn.LeakyReLU(0.2),
+                # Output: N x 1 x 1 x 1
+                nn.Conv2d(width * 2, 1, kernel_size=6),
+                nn.Flatten(),
+            ]
+        else:
+            raise ValueError(f'Unknown student architecture: {arch}')
+        # predictions from 0 - n only, as for the LoSPredictor
+        modules.append(nn.ReLU())
+        self.pred = nn.Sequential(*modules)
+
+    def set_normalisation(self, data: torch.Tensor):
+        """
+        Standardise inputs with the statistics of a sample of the training data
+
+        :param data: Tensor of reshaped record vectors (N x 1 x 8 x 8)
+        """
+        with torch.no_grad():
+            std = data.std(dim=0, keepdim=True)
+            # Padding, and fields with a single value, are left unscaled
+            std[std == 0] = 1.0
+            self.input_mean.copy_(data.mean(dim=0, keepdim=True))
+            self.input_std.copy_(std)
+
+    def forward(self, x):
+        return self.pred((x - self.input_mean) / self.input_std)
+
+
+def _prepare_quantised_model(predictor: LoSPredictor, backend: str) -> QuantisedLoSPredictor:
+    """Build a fused QuantisedLoSPredictor instrumented with observers for the given quantisation backend"""
+    torch.backends.quantized.engine = backend
+    quantised = QuantisedLoSPredictor(predictor)
+    quantised.eval()
+    quantised.fuse_model()
+    quantised.qconfig = torch.quantization.get_default_qconfig(backend)
+    torch.quantization.prepare(quantised, inplace=True)
+    return quantised
+
+
+def quantise_model(predictor: LoSPredictor, calibration_data: torch.Tensor,
+                   backend: str = 'fbgemm', batch_size: int = 512) -> QuantisedLoSPredictor:
+    """
+    Apply static int8 post-training quantisation to a trained LoSPredictor
+
+    :param predictor: Trained LoSPredictor instance
+    :param calibration_data: Tensor of reshaped record vectors (N x 1 x 8 x 8) used to calibrate activation ranges
+    :param backend: Quantisation engine to target ('fbgemm' for x86, 'qnnpack' for ARM)
+    :param batch_size: Number of calibration records to pass through the model at once
+    :return: Quantised predictor in eval mode
+    """
+    quantised = _prepare_quantised_model(predictor, backend)
+    # Observe activation ranges over the calibration data
+    with torch.no_grad():
+        for start in range(0, len(calibration_data), batch_size):
+            quantised(calibration_data[start:start + batch_size])
+    torch.quantization.convert(quantised, inplace=True)
+    return quantised
+
+
+def save_quantised_model(quantised: QuantisedLoSPredictor, model_file: str, backend: str, metrics: Dict[str, float]):
+    """
+    Save a quantised model alongside the validation metrics used to decide whether it is fit to serve
+
+    :param quantised: Quantised predictor to save
+    :param model_file: Path to write the quantised model state to
+    :param backend: Quantisation engine the model was built for
+    :param metrics: Dict of validation metrics for the float and quantised models
+    """
+    torch.save(dict(state_dict=quantised.state_dict(), backend=backend, metrics=metrics), model_file)
+
+
+def save_student_model(student: StudentLoSPredictor, model_file: str, metrics: Dict[str, float]):
+    """
+    Save a distilled student model with its architecture, so `init_model` can load it in place of a LoSPredictor
+
+    :param student: Trained student predictor to save
+    :param model_file: Path to write the student model state to
+    :param metrics: Dict of validation and latency metrics for the student and its teacher
+    """
+    torch.save(dict(arch=student.config, state_dict=student.state_dict(), metrics=metrics), model_file)
+
+
+def init_quantised_model(vector_dims: int = 1, feature_dims: int = 64,
+                         model_file: str = 'config/los_model.int8.state',
+                         tolerance: float = 0.5) -> Optional[QuantisedLoSPredictor]:
+    """
+    Initialise a quantised LoSPredictor from file, if it stays within tolerance of the float model it was built from
+
+    :param vector_dims: Dimensionality of the patient record vectors
+    :param feature_dims: Dimensionality (number of features) in the model input vector
+    :param model_file: Path to quantised model state file
+    :param tolerance: Maximum increase in validation MSE (days squared) over the float model
+    :return: Quantised predictor, or None if no quantised model is available or it is out of tolerance
+    """
+    if model_file is None or not os.path.exists(model_file):
+        return
+    saved = torch.load(model_file, map_location=torch.device('cpu'))
+    metrics = saved.get('metrics', {})
+    mse_increase = metrics.get('quantised_mse', float('inf')) - metrics.get('float_mse', 0.0)
+    if mse_increase > tolerance:
+        LOG.warning(f'Quantised model validation MSE is {mse_increase:.3f} above the float model, exceeding the '
+                    f'tolerance of {tolerance}; serving the float model')
+        return
+    if saved.get('backend') not in torch.backends.quantized.supported_engines:
+        LOG.warning(f'Quantisation backend {saved.get("backend")} is not supported on this host; '
+                    f'serving the float model')
+        return
+    # Rebuild the quantised module structure before loading the saved int8 weights and scales
+    quantised = _prepare_quantised_model(LoSPredictor(vector_dims, features_d=feature_dims), saved['backend'])
+    torch.quantization.convert(quantised, inplace=True)
+    quantised.load_state_dict(saved['state_dict'])
+    return quantised
+
+
+def is_student_model(model_file: str) -> bool:
+    """
+    Check whether a LoS model state file holds a distilled student model, rather than a LoSPredictor
+
+    :param model_file: Path to model state file
+    :return: True if the file was saved by `save_student_model`
+    """
+    state = torch.load(model_file, map_location=torch.device('cpu'))
+    return 'arch' in state
+
+
 def init_model(vector_dims: int = 1, feature_dims: int = 64,
-               model_file: str = 'config/los_model.state') -> LoSPredictor:
+               model_file: str = 'config/los_model.state') -> Union[LoSPredictor, StudentLoSPredictor]:
     """
-    Initialise the LoSPredictor model and load saved state from model file
+    Initialise the LoSPredictor model and load saved state from model file. A distilled student model (saved by
+    `training/distill_los.py`) is detected from its saved architecture, and loaded in place of the LoSPredictor.
 
     :param vector_dims: Dimensionality of the patient record vectors
     :param feature_dims: Dimensionality (number of features) in the model input vector
     :param model_file: Path to model state file
-    :return: Constructed LoSPredictor instance
+    :return: Constructed LoSPredictor (or StudentLoSPredictor) instance
     """
-    # Setup the model and load the checkpoint
-    predictor = LoSPredictor(vector_dims, features_d=feature_dims)
-    predictor.load_state_dict(torch.load(model_file, map_location=torch.device('cpu')))
+    state = torch.load(model_file, map_location=torch.device('cpu'))
+    if 'arch' in state:
+        # Student models are saved with their architecture, rather than as a bare state dict
+        predictor = StudentLoSPredictor(**state['arch'])
+        predictor.load_state_dict(state['state_dict'])
+    else:
+        # Setup the model and load the checkpoint
+        predictor = LoSPredictor(vector_dims, features_d=feature_dims)
+        predictor.load_state_dict(state)
     predictor.eval()
     return predictor
 
 
-def get_prediction(predictor: LoSPredictor, vector: Dict[str, Any]) -> Dict:
+def init_ensemble_model(model_files: List[str], vector_dims: int = 1,
+                        feature_dims: int = 64) -> EnsembleLoSPredictor:
+    """
+    Initialise an ensemble of LoSPredictor checkpoints (e.g. several `mod_ep_*` files written by `train_los.py`),
+    served as a single network
+
+    :param model_files: Paths to LoSPredictor model state files, one per member
+    :param vector_dims: Dimensionality of the patient record vectors
+    :param feature_dims: Dimensionality (number of features) in the model input vector
+    :return: Constructed EnsembleLoSPredictor instance
+    """
+    members = [init_model(vector_dims, feature_dims, model_file=model_file) for model_file in model_files]
+    ensemble = EnsembleLoSPredictor(members)
+    ensemble.eval()
+    return ensemble
+
+
+def get_prediction(predictor: Union[LoSPredictor, QuantisedLoSPredictor, EnsembleLoSPredictor,
+                                    StudentLoSPredictor],
+                   vector: Dict[str, Any]) -> Dict:
     """
     Interrogate the LoSPredictor model for a length of stay prediction
 
-    :param predictor: Initialised LoSPredictor instance
+    :param predictor: Initialised LoSPredictor (or Quantised, Ensemble or Student LoSPredictor) instance
     :param vector: Vectorised patient record
-    :return: Dict containing predicted length of stay result
+    :return: Dict containing predicted length of stay result (and the standard deviation of an ensemble's members)
     """
     # Convert numpy array into Torch tensor
     tensor = torch.Tensor(reshape_vector(vector))
     # Return tensor containing predicted value
     prediction = predictor(tensor)
+    if isinstance(predictor, EnsembleLoSPredictor):
+        # Serve the mean of the members' predictions, with their spread
+        members = prediction.reshape(-1)
+        return {'PREDICTED_LOS': float(members.mean().item()),
+                'PREDICTED_LOS_STD': float(members.std(unbiased=False).item())}
     # Extract numerical prediction from tensor and return it
     reshaped = float(prediction.reshape(-1).item())
     return {'PREDICTED_LOS': reshaped}
+
+
+def get_predictions(predictor: Union[LoSPredictor, QuantisedLoSPredictor, EnsembleLoSPredictor,
+                                     StudentLoSPredictor],
+                    vectors: List[Dict[str, Any]]) -> List[Dict]:
+    """
+    Interrogate the LoSPredictor model for length of stay predictions for a batch of records in one forward pass
+
+    :param predictor: Initialised LoSPredictor (or Quantised, Ensemble or Student LoSPredictor) instance
+    :param vectors: List of vectorised patient records
+    :return: List of dicts containing predicted length of stay results, in the same order as `vectors`
+    """
+    if len(vectors) == 0:
+        return []
+    # Stack the reshaped vectors into a single N x 1 x 8 x 8 batch
+    predictions, spread = predict_batch_spread(predictor, np.vstack([reshape_vector(vector) for vector in vectors]))
+    if isinstance(predictor, EnsembleLoSPredictor):
+        return [{'PREDICTED_LOS': float(prediction), 'PREDICTED_LOS_STD': float(std)}
+                for prediction, std in zip(predictions, spread)]
+    return [{'PREDICTED_LOS': float(prediction)} for prediction in predictions]
+
+
+def predict_matrix(predictor: Union[LoSPredictor, QuantisedLoSPredictor, EnsembleLoSPredictor,
+                                    StudentLoSPredictor],
+                   matrix: np.ndarray) -> np.ndarray:
+    """
+    Interrogate the LoSPredictor model for length of stay predictions for a matrix of flattened vectors
+
+    :param predictor: Initialised LoSPredictor (or Quantised, Ensemble or Student LoSPredictor) instance
+    :param matrix: N x len(MODEL_SELECTORS) array of flattened vectors, as produced by `flatten_columns`
+    :return: Array of N predicted lengths of stay
+    """
+    return predict_batch(predictor, reshape_matrix(matrix))
+
+
+def predict_batch(predictor: Union[LoSPredictor, QuantisedLoSPredictor, EnsembleLoSPredictor,
+                                   StudentLoSPredictor],
+                  batch: np.ndarray) -> np.ndarray:
+    """
+    Run a single forward pass of the LoSPredictor model over a batch of reshaped vectors
+
+    :param predictor: Initialised LoSPredictor (or Quantised, Ensemble or Student LoSPredictor) instance
+    :param batch: N x 1 x 8 x 8 array of reshaped vectors
+    :return: Array of N predicted lengths of stay (the mean of an ensemble's members)
+    """
+    return predict_batch_spread(predictor, batch)[0]
+
+
+def predict_batch_spread(predictor: Union[LoSPredictor, QuantisedLoSPredictor, EnsembleLoSPredictor,
+                                          StudentLoSPredictor],
+                         batch: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Run a single forward pass of the LoSPredictor model over a batch of reshaped vectors, giving the mean and standard
+    deviation of an ensemble's members (a single model has a standard deviation of zero)
+
+    :param predictor: Initialised LoSPredictor (or Quantised, Ensemble or Student LoSPredictor) instance
+    :param batch: N x 1 x 8 x 8 array of reshaped vectors
+    :return: Arrays of N predicted lengths of stay, and N standard deviations
+    """
+    if len(batch) == 0:
+        return np.zeros(0), np.zeros(0)
+    with torch.no_grad():
+        # One column per ensemble member
+        predictions = predictor(torch.Tensor(batch)).reshape(len(batch), -1)
+        return predictions.mean(dim=1).numpy(), predictions.std(dim=1, unbiased=False).numpy()
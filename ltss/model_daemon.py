@@ -0,0 +1,44 @@
+"""Command-line entry point of the model server shared by the web workers of a host (see `ltss.model_server`)"""
+import argparse
+import logging
+import signal
+from typing import List, Optional
+
+import ltss
+from ltss import resources
+from ltss.model_server import ModelServer
+
+
+def parse_args(override_args: Optional[List[str]] = None) -> argparse.Namespace:
+    """
+    Parse command-line arguments. By default, parses sys.argv - if supplied, uses `args` as an override
+    :param override_args: Optional override for command-line arguments
+    :return: An argparse.Namespace containing the parsed argument set
+    """
+    parser = argparse.ArgumentParser(description='Serve the LTSS models to the web workers of a host')
+    parser.add_argument('--socket', '-s', type=str, help='Path of the Unix socket to listen on',
+                        default='/tmp/ltss-models.sock')
+    parser.add_argument('--max-batch', type=int, help='Maximum number of records scored in one batch', default=256)
+    parser.add_argument('--max-wait', type=float, help='Maximum milliseconds to wait for more requests before scoring '
+                                                       'a batch', default=2.0)
+    parser.add_argument('--threads', type=int, help='Threads for the models (by default, every available core)')
+    return parser.parse_args(args=override_args)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    args = parse_args()
+    # The server scores for every worker, so may use every available core
+    resources.configure(threads=args.threads)
+    # Load the models configured for the app, reloading them when they change if the app is configured to
+    ltss.initialise_models()
+    server = ModelServer(args.socket, lambda: ltss.MODELS.active, max_batch=args.max_batch,
+                         max_wait=args.max_wait / 1000)
+    # Remove the socket file when stopped by the process manager
+    signal.signal(signal.SIGTERM, lambda *_: server.close())
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
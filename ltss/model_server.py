@@ -0,0 +1,414 @@
+"""Local inference daemon shared by the web workers of a host, with a client and an in-process fallback
+
+Each web worker otherwise runs every forecast through its own copy of the models, one record at a time. The model server
+owns a single copy of the LoS and risk models, and scores the records of every worker together: requests that arrive
+within a short window are stacked into one batch, and the LoS and risk models each run once over the batch. Workers send
+pre-vectorised records over a Unix socket as raw float64 arrays, and receive forecasts back in a fixed column layout.
+
+Run the server with `python -m ltss.model_daemon --socket /run/ltss/models.sock`, and set MODEL_SERVER_SOCKET in
+the app's CONFIG to the same path. `LocalScorer` scores in the calling process with the same interface as
+`ModelClient`, so either may be used wherever a scorer is expected (e.g. in tests).
+
+Frames are sent little-endian. A request is a header (magic, number of rows) followed by rows x (len(MODEL_SELECTORS)
++ 1) float64 values: each flattened vector followed by the patient's days in hospital. A response is a header (magic,
+status, flags, number of rows, model version) followed by rows x len(RESULT_COLUMNS) float64 values, or on error a UTF-8
+message of the given length.
+"""
+import abc
+import logging
+import os
+import queue
+import socket
+import struct
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from ltss import los_model, risk_model, registry
+from ltss.utils import MODEL_SELECTORS, reshape_matrix
+
+# Constants to initialise logging
+LOG = logging.getLogger('ltss.model_server')
+
+# Frame headers
+MAGIC = b'LTSS'
+REQUEST_HEADER = struct.Struct('<4sI')
+RESPONSE_HEADER = struct.Struct('<4sBBxxI16s')
+# Response statuses
+STATUS_OK = 0
+STATUS_ERROR = 1
+# Response flags
+FLAG_ENSEMBLE = 1
+# Forecast fields of each response row, followed by the risk of each of MODEL_SELECTORS (RISK_BY_CATEGORY, NaN where
+# the risk model has no distribution for the value). BIGGEST_RISK_FACTOR is given as an index into MODEL_SELECTORS (-1
+# for none), and a row whose risk prediction failed has a RISK_STRATIFICATION of NaN.
+RESULT_FIELDS = ['PREDICTED_LOS', 'PREDICTED_LOS_STD', 'RISK_STRATIFICATION', 'RISK_CAT_PROB_GENERAL_1',
+                 'RISK_CAT_PROB_GENERAL_2', 'RISK_CAT_PROB_GENERAL_3', 'RISK_CAT_PROB_GENERAL_4',
+                 'RISK_CAT_PROB_GENERAL_5', 'PERCENTAGE_RISK_CAT', 'MOT_DAYS', 'BIGGEST_RISK_FACTOR']
+RESULT_COLUMNS = RESULT_FIELDS + [f'RISK_BY_CATEGORY.{selector}' for selector in MODEL_SELECTORS]
+# Columns of each request row
+REQUEST_COLUMNS = len(MODEL_SELECTORS) + 1
+_FIELD = {field: i for i, field in enumerate(RESULT_FIELDS)}
+_RISK_PROBS = [_FIELD[f'RISK_CAT_PROB_GENERAL_{band}'] for band in range(1, 6)]
+
+
+class ServerUnavailable(Exception):
+    """Raised when the model server cannot be reached"""
+
+
+class ScoringError(Exception):
+    """
+    Raised when a model fails to score a record
+
+    :param model: Name of the model that failed, e.g. 'risk'
+    """
+
+    def __init__(self, model: str, message: str = ''):
+        super().__init__(message or f'Error predicting against {model} model')
+        self.model = model
+
+
+def score_matrix(models: registry.ModelBundle, matrix: np.ndarray, days_in_hospital: np.ndarray) -> np.ndarray:
+    """
+    Score a matrix of flattened vectors against the LoS model and the risk model, each in a single batch
+
+    :param models: ModelBundle to score with
+    :param matrix: N x len(MODEL_SELECTORS) array of flattened vectors
+    :param days_in_hospital: Array of N numbers of days each patient has already stayed
+    :return: N x len(RESULT_COLUMNS) array of forecasts
+    :raises ScoringError: If the LoS model fails
+    """
+    results = np.full((len(matrix), len(RESULT_COLUMNS)), np.nan)
+    try:
+        predictions, spread = los_model.predict_batch_spread(models.los_model, reshape_matrix(matrix))
+    except Exception as e:
+        LOG.exception(e)
+        raise ScoringError('length of stay')
+    results[:, _FIELD['PREDICTED_LOS']] = predictions
+    results[:, _FIELD['PREDICTED_LOS_STD']] = spread
+    try:
+        # Score exactly as the forecast endpoint does, from the LoS predictions of the same batch
+        prediction, known = risk_model.get_predictions(models.risk_model, matrix, ai_day_predictions=predictions,
+                                                       days_in_hospital=days_in_hospital)
+    except Exception as e:
+        # Rows without a risk prediction are reported as failed
+        LOG.exception(e)
+        return results
+    for field in ['RISK_STRATIFICATION', 'PERCENTAGE_RISK_CAT', 'MOT_DAYS', 'BIGGEST_RISK_FACTOR']:
+        results[known, _FIELD[field]] = prediction[field][known]
+    for band, i in enumerate(_RISK_PROBS, start=1):
+        results[known, i] = prediction[f'RISK_CAT_PROB_GENERAL_{band}'][known]
+    results[known, len(RESULT_FIELDS):] = prediction['RISK_BY_CATEGORY'][known]
+    return results
+
+
+def forecast_from_row(row: np.ndarray, ensemble: bool) -> Dict:
+    """
+    Convert a row of forecast columns back to the forecast dict given by the LoS and risk models
+
+    :param row: Array of len(RESULT_COLUMNS) forecast values
+    :param ensemble: Whether the LoS model is an ensemble, which also gives PREDICTED_LOS_STD
+    :return: Dict of forecast fields
+    :raises ScoringError: If the risk prediction failed
+    """
+    if np.isnan(row[_FIELD['RISK_STRATIFICATION']]):
+        raise ScoringError('risk')
+    forecast = {'PREDICTED_LOS': float(row[_FIELD['PREDICTED_LOS']])}
+    if ensemble:
+        forecast['PREDICTED_LOS_STD'] = float(row[_FIELD['PREDICTED_LOS_STD']])
+    biggest = int(row[_FIELD['BIGGEST_RISK_FACTOR']])
+    risks = row[len(RESULT_FIELDS):]
+    forecast.update(
+        RISK_STRATIFICATION=int(row[_FIELD['RISK_STRATIFICATION']]),
+        **{f'RISK_CAT_PROB_GENERAL_{band}': float(row[i]) for band, i in enumerate(_RISK_PROBS, start=1)},
+        BIGGEST_RISK_FACTOR=MODEL_SELECTORS[biggest] if biggest >= 0 else None,
+        RISK_BY_CATEGORY={selector: int(risk) for selector, risk in zip(MODEL_SELECTORS, risks) if not np.isnan(risk)},
+        PERCENTAGE_RISK_CAT=int(row[_FIELD['PERCENTAGE_RISK_CAT']]),
+        MOT_DAYS=int(row[_FIELD['MOT_DAYS']]),
+    )
+    return forecast
+
+
+class Scorer(abc.ABC):
+    """Scores flattened vectors against a set of models, in this process or another"""
+
+    @abc.abstractmethod
+    def score(self, matrix: np.ndarray, days_in_hospital: np.ndarray) -> Tuple[str, bool, np.ndarray]:
+        """
+        Score a matrix of flattened vectors
+
+        :param matrix: N x len(MODEL_SELECTORS) array of flattened vectors
+        :param days_in_hospital: Array of N numbers of days each patient has already stayed
+        :return: Model version, whether the LoS model is an ensemble, and N x len(RESULT_COLUMNS) array of forecasts
+        """
+
+    def forecast(self, vector: Dict, days_in_hospital: int = 0) -> Tuple[str, Dict]:
+        """
+        Score a single vectorised record, as the forecast endpoint does
+
+        :param vector: Vectorised patient record
+        :param days_in_hospital: Number of days the patient has already stayed
+        :return: Model version, and dict of forecast fields
+        """
+        matrix = np.array([[vector.get(key, -1) for key in MODEL_SELECTORS]], dtype=np.float64)
+        version, ensemble, results = self.score(matrix, np.array([days_in_hospital], dtype=np.float64))
+        return version, forecast_from_row(results[0], ensemble)
+
+
+class LocalScorer(Scorer):
+    """
+    Scores in the calling process, with the same interface as `ModelClient`
+
+    :param models: Function returning the ModelBundle to score with
+    """
+
+    def __init__(self, models: Callable[[], registry.ModelBundle]):
+        self._models = models
+
+    def score(self, matrix: np.ndarray, days_in_hospital: np.ndarray) -> Tuple[str, bool, np.ndarray]:
+        models = self._models()
+        ensemble = isinstance(models.los_model, los_model.EnsembleLoSPredictor)
+        return models.version, ensemble, score_matrix(models, matrix, days_in_hospital)
+
+
+def _recv_exactly(sock: socket.socket, size: int) -> Optional[bytes]:
+    """Read exactly `size` bytes from a socket, or None if it is closed before any are read"""
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        n = sock.recv_into(view[received:])
+        if n == 0:
+            if received == 0:
+                return None
+            raise ConnectionError('Connection closed mid-frame')
+        received += n
+    return bytes(buffer)
+
+
+class ModelClient(Scorer):
+    """
+    Scores against a model server over its Unix socket. Each thread holds its own connection, opened on first use and
+    reopened after a failure.
+
+    :param socket_path: Path of the server's Unix socket
+    :param timeout: Seconds to wait for the server to respond
+    """
+
+    def __init__(self, socket_path: str, timeout: float = 5.0):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self._local = threading.local()
+        self.requests = 0
+        self.failures = 0
+
+    def _connection(self) -> socket.socket:
+        """Get this thread's connection to the server, connecting if needed"""
+        sock = getattr(self._local, 'sock', None)
+        if sock is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            try:
+                sock.connect(self.socket_path)
+            except OSError:
+                sock.close()
+                raise
+            self._local.sock = sock
+        return sock
+
+    def _close(self):
+        """Close this thread's connection, so the next request reconnects"""
+        sock = getattr(self._local, 'sock', None)
+        self._local.sock = None
+        if sock is not None:
+            sock.close()
+
+    def score(self, matrix: np.ndarray, days_in_hospital: np.ndarray) -> Tuple[str, bool, np.ndarray]:
+        self.requests += 1
+        rows = np.hstack([matrix, np.reshape(days_in_hospital, (-1, 1))]).astype('<f8')
+        try:
+            sock = self._connection()
+            sock.sendall(REQUEST_HEADER.pack(MAGIC, len(rows)) + rows.tobytes())
+            header = _recv_exactly(sock, RESPONSE_HEADER.size)
+            if header is None:
+                raise ConnectionError('Model server closed the connection')
+            magic, status, flags, size, version = RESPONSE_HEADER.unpack(header)
+            if magic != MAGIC:
+                raise ConnectionError('Unexpected response from model server')
+            body = _recv_exactly(sock, size if status != STATUS_OK else size * len(RESULT_COLUMNS) * 8) or b''
+        except OSError as e:
+            # Covers timeouts and dropped connections, after which the stream cannot be trusted
+            self.failures += 1
+            self._close()
+            raise ServerUnavailable(str(e))
+        if status != STATUS_OK:
+            raise ScoringError('length of stay', body.decode('utf-8'))
+        results = np.frombuffer(body, dtype='<f8').reshape(size, len(RESULT_COLUMNS))
+        return version.rstrip(b'\0').decode('ascii'), bool(flags & FLAG_ENSEMBLE), results
+
+    def status(self) -> Dict:
+        """Summary of the client's connection and counters"""
+        return dict(socket=self.socket_path, requests=self.requests, failures=self.failures)
+
+
+class _Pending:
+    """A request waiting for its rows to be scored in a batch"""
+    __slots__ = ['rows', 'done', 'version', 'ensemble', 'results', 'error']
+
+    def __init__(self, rows: np.ndarray):
+        self.rows = rows
+        self.done = threading.Event()
+        self.version = ''
+        self.ensemble = False
+        self.results: Optional[np.ndarray] = None
+        self.error: Optional[str] = None
+
+
+class ModelServer:
+    """
+    Serves forecasts over a Unix socket to every web worker of a host, batching the records of concurrent requests.
+    Each connection is served by its own thread, and a single batching thread runs the models.
+
+    :param socket_path: Path to bind the Unix socket to (any existing file is replaced)
+    :param models: Function returning the ModelBundle to score with, e.g. the `active` bundle of a ModelReloader
+    :param max_batch: Maximum number of records scored in one batch
+    :param max_wait: Maximum seconds to wait for more requests before scoring a batch
+    """
+
+    def __init__(self, socket_path: str, models: Callable[[], registry.ModelBundle], max_batch: int = 256,
+                 max_wait: float = 0.002):
+        self.socket_path = socket_path
+        self._models = models
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._queue: 'queue.Queue[_Pending]' = queue.Queue()
+        self._listener: Optional[socket.socket] = None
+        self.batches = 0
+        self.records = 0
+
+    def start(self):
+        """Bind the socket and start the batching thread"""
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        self._listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._listener.bind(self.socket_path)
+        self._listener.listen(128)
+        threading.Thread(target=self._batch_loop, name='ltss-model-batch', daemon=True).start()
+        LOG.info(f'Model server listening on {self.socket_path}')
+
+    def serve_forever(self):
+        """Accept connections until the server is closed, serving each on its own thread"""
+        if self._listener is None:
+            self.start()
+        while True:
+            try:
+                conn, _ = self._listener.accept()
+            except OSError:
+                # The listener was closed
+                return
+            threading.Thread(target=self._serve_connection, args=(conn,), name='ltss-model-conn', daemon=True).start()
+
+    def close(self):
+        """Stop accepting connections and remove the socket file"""
+        if self._listener is not None:
+            self._listener.close()
+            self._listener = None
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+
+    def _serve_connection(self, conn: socket.socket):
+        """Serve the requests of a single connection in turn, until the client disconnects"""
+        with conn:
+            try:
+                while True:
+                    header = _recv_exactly(conn, REQUEST_HEADER.size)
+                    if header is None:
+                        return
+                    magic, size = REQUEST_HEADER.unpack(header)
+                    if magic != MAGIC:
+                        LOG.warning('Dropping connection sending an unexpected frame')
+                        return
+                    body = _recv_exactly(conn, size * REQUEST_COLUMNS * 8) or b''
+                    pending = self.submit(np.frombuffer(body, dtype='<f8').reshape(size, REQUEST_COLUMNS))
+                    version = pending.version.encode('ascii')
+                    if pending.error is not None:
+                        message = pending.error.encode('utf-8')
+                        conn.sendall(RESPONSE_HEADER.pack(MAGIC, STATUS_ERROR, 0, len(message), version) + message)
+                    else:
+                        flags = FLAG_ENSEMBLE if pending.ensemble else 0
+                        conn.sendall(RESPONSE_HEADER.pack(MAGIC, STATUS_OK, flags, size, version)
+                                     + pending.results.astype('<f8').tobytes())
+            except OSError as e:
+                LOG.warning(f'Model server connection failed: {e}')
+
+    def submit(self, rows: np.ndarray) -> _Pending:
+        """
+        Queue rows for the next batch, and wait for them to be scored
+
+        :param rows: N x REQUEST_COLUMNS array of flattened vectors, each followed by the days in hospital
+        :return: The scored request
+        """
+        pending = _Pending(rows)
+        self._queue.put(pending)
+        pending.done.wait()
+        return pending
+
+    def _batch_loop(self):
+        """Collect queued requests into batches, up to `max_batch` records or `max_wait` seconds, and score them"""
+        while True:
+            batch = [self._queue.get()]
+            size = len(batch[0].rows)
+            deadline = time.monotonic() + self.max_wait
+            while size < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    pending = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                batch.append(pending)
+                size += len(pending.rows)
+            self._score(batch)
+
+    def _score(self, batch: List[_Pending]):
+        """Score a batch of requests together, and release their waiting threads"""
+        version, ensemble, results, error = '', False, None, None
+        # Release every waiting thread whatever fails, so no request waits forever
+        try:
+            # The whole batch is served by one bundle, even if a reload completes part way through
+            models = self._models()
+            version = models.version
+            ensemble = isinstance(models.los_model, los_model.EnsembleLoSPredictor)
+            rows = np.vstack([pending.rows for pending in batch])
+            results = score_matrix(models, rows[:, :-1], rows[:, -1])
+        except ScoringError as e:
+            error = str(e)
+        except Exception as e:
+            LOG.exception(e)
+            error = str(e) or 'Error scoring batch'
+        start = 0
+        for pending in batch:
+            pending.version = version
+            pending.ensemble = ensemble
+            if results is not None:
+                pending.results = results[start:start + len(pending.rows)]
+            pending.error = error
+            start += len(pending.rows)
+            pending.done.set()
+        self.batches += 1
+        self.records += start
+
+
+def from_config(config: Dict) -> Optional[ModelClient]:
+    """
+    Create a client of the model server configured for the app
+
+    :param config: App configuration
+    :return: Model server client, or None if no model server is configured
+    """
+    if not config.get('MODEL_SERVER_SOCKET'):
+        return None
+    return ModelClient(config['MODEL_SERVER_SOCKET'], timeout=config.get('MODEL_SERVER_TIMEOUT', 5.0))
@@ -0,0 +1,270 @@
+"""Optional SQLite store of the patient records file, indexed on the UI fields for server-side filtering, sorting and
+pagination of records
+
+The store is a local SQLite file holding one row per record, keyed on the record's row index in the records file, with
+each UI field in its own indexed column. When the records file changes, only new or changed rows are written, and rows
+beyond the end of the file are deleted. The store persists between restarts, and may be shared by several worker
+processes.
+"""
+import json
+import logging
+import sqlite3
+import threading
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from ltss.records import FileVersion, file_stamp, record_hash
+from ltss.utils import UI_FIELDS, read_records
+
+# Constants to initialise logging
+LOG = logging.getLogger('ltss.record_store')
+
+# Fields stored in their own indexed columns, for filtering and sorting
+STORE_FIELDS = list(dict.fromkeys(field for fields in (UI_FIELDS or {}).values() for field in fields))
+# Sort field for the record ID (row index in the records file)
+ID_FIELD = 'ID'
+# Query parameters that are not record queries: a client's cache-busting `_` parameter, and the site
+RESERVED_PARAMS = {'_', 'site'}
+
+
+def _column(field: str) -> str:
+    """Quote a field name for use as a column name"""
+    return '"' + field.replace('"', '""') + '"'
+
+
+def _value(value: Optional[str]) -> Optional[str]:
+    """Convert a parsed record value to a stored column value, storing missing values as NULL"""
+    return None if value is None or value == 'null' else value
+
+
+def _parse_bound(value: str) -> Any:
+    """Parse a range filter bound, comparing numerically where the bound is a number"""
+    try:
+        return float(value)
+    except ValueError:
+        return value.lower()
+
+
+def parse_query(args: Dict[str, str]) -> Dict:
+    """
+    Parse record query parameters:
+     - `<field>=<value>[,<value>...]`: Records where the UI field has one of the given values
+     - `min_<field>=<value>` / `max_<field>=<value>`: Records where the UI field is within the given range
+     - `sort=[-]<field>`: Sort by a UI field or `id`, descending if prefixed with `-` (default: `id`)
+     - `offset=<n>` / `limit=<n>`: Page of records to return
+    Parameters in RESERVED_PARAMS are ignored.
+
+    :param args: Query parameters
+    :return: Keyword arguments for `RecordStore.query`, empty if no record query parameters were given
+    :raises ValueError: If a parameter is not a UI field, or a page parameter is not a whole number
+    """
+    query = {}
+    for key, value in args.items():
+        name = key.upper()
+        if key in RESERVED_PARAMS:
+            continue
+        if name == 'SORT':
+            field = value.upper().lstrip('-')
+            if field not in STORE_FIELDS and field != ID_FIELD:
+                raise ValueError(f'Unknown sort field: {value}')
+            query['sort'] = field
+            query['descending'] = value.startswith('-')
+        elif name in ('OFFSET', 'LIMIT'):
+            if not value.isdigit():
+                raise ValueError(f'{key} must be a whole number')
+            query[name.lower()] = int(value)
+        elif name.startswith(('MIN_', 'MAX_')) and name[4:] in STORE_FIELDS:
+            query.setdefault('ranges', {}).setdefault(name[4:], [None, None])[name.startswith('MAX_')] = \
+                _parse_bound(value)
+        elif name in STORE_FIELDS:
+            query.setdefault('filters', {})[name] = [v.lower() for v in value.split(',')]
+        else:
+            raise ValueError(f'Unknown record field: {key}')
+    return query
+
+
+class RecordStore:
+    """
+    SQLite store of a records file, refreshed incrementally when the file's modification time or size changes
+
+    :param source: Path to the CSV, Parquet or Arrow IPC records file
+    :param path: Path to the SQLite store file, created if it does not exist
+    """
+
+    def __init__(self, source: str, path: str):
+        self.source = source
+        self.path = path
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._version: Optional[FileVersion] = None
+        # Serialised JSON object of all records, and the records file stamp it was serialised from
+        self._records_json: Optional[Tuple[Tuple[int, int], bytes]] = None
+        self._create()
+
+    def _connect(self) -> sqlite3.Connection:
+        """Get this thread's connection to the store"""
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            # Transactions are managed explicitly, so refreshes can take the write lock before checking the version
+            connection = sqlite3.connect(self.path, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            self._local.connection = connection
+        return connection
+
+    def _create(self):
+        """Create the store's tables and indexes, rebuilding the store if the UI fields have changed"""
+        connection = self._connect()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+            fields = json.dumps(STORE_FIELDS)
+            stored = connection.execute("SELECT value FROM meta WHERE key = 'fields'").fetchone()
+            if stored is not None and stored[0] != fields:
+                LOG.info(f'UI fields have changed, rebuilding record store {self.path}')
+                connection.execute('DROP TABLE IF EXISTS records')
+                connection.execute("DELETE FROM meta WHERE key = 'stamp'")
+            # NUMERIC columns store numeric values as numbers, so they filter and sort numerically
+            columns = ''.join(f', {_column(field)} NUMERIC' for field in STORE_FIELDS)
+            connection.execute(f'CREATE TABLE IF NOT EXISTS records '
+                               f'(id INTEGER PRIMARY KEY, hash BLOB NOT NULL, record TEXT NOT NULL{columns})')
+            for i, field in enumerate(STORE_FIELDS):
+                connection.execute(f'CREATE INDEX IF NOT EXISTS records_field_{i} ON records ({_column(field)})')
+            connection.execute("INSERT OR REPLACE INTO meta VALUES ('fields', ?)", (fields,))
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+
+    def current(self) -> FileVersion:
+        """
+        Get the current version of the records file, refreshing the store if the file has changed since it was last
+        loaded
+
+        :return: FileVersion of the records in the store
+        """
+        stamp = file_stamp(self.source)
+        version = self._version
+        if version is None or version.stamp != stamp:
+            with self._lock:
+                version = self._version
+                if version is None or version.stamp != stamp:
+                    self.refresh(stamp)
+                    version = self._version = FileVersion(stamp)
+        return version
+
+    def refresh(self, stamp: Tuple[int, int]):
+        """
+        Load a version of the records file into the store, writing only new or changed records
+
+        :param stamp: Version stamp of the records file
+        """
+        connection = self._connect()
+        # Take the write lock first, so only one process refreshes the store for each version of the file
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            stored = connection.execute("SELECT value FROM meta WHERE key = 'stamp'").fetchone()
+            if stored is not None and tuple(json.loads(stored[0])) == tuple(stamp):
+                connection.execute('COMMIT')
+                return
+            hashes = dict(connection.execute('SELECT id, hash FROM records'))
+            placeholders = ', '.join('?' * (len(STORE_FIELDS) + 3))
+            insert = f'INSERT OR REPLACE INTO records VALUES ({placeholders})'
+            count = 0
+            changed = 0
+            for index, record in enumerate(read_records(self.source)):
+                count += 1
+                digest = record_hash(record)
+                if hashes.get(index) == digest:
+                    continue
+                changed += 1
+                connection.execute(insert, (index, digest, json.dumps(record, separators=(',', ':')),
+                                            *(_value(record.get(field)) for field in STORE_FIELDS)))
+            connection.execute('DELETE FROM records WHERE id >= ?', (count,))
+            connection.execute("INSERT OR REPLACE INTO meta VALUES ('stamp', ?)", (json.dumps(list(stamp)),))
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        LOG.debug(f'Refreshed record store from {self.source}: {changed} of {count} records written')
+
+    def records_json(self, version: FileVersion, serialise: Callable[[object], bytes]) -> bytes:
+        """
+        Get the serialised JSON object of all records, keyed on record ID, cached until the records file changes
+
+        :param version: Current version of the records file, from `current`
+        :param serialise: Function to serialise an object to JSON bytes
+        :return: Serialised records object
+        """
+        cached = self._records_json
+        if cached is not None and cached[0] == version.stamp:
+            return cached[1]
+        _, rows = self.query()
+        body = serialise({record_id: record for record_id, record in rows})
+        self._records_json = (version.stamp, body)
+        return body
+
+    def query(self, filters: Optional[Dict[str, List[str]]] = None, ranges: Optional[Dict[str, List]] = None,
+              sort: str = ID_FIELD, descending: bool = False, offset: int = 0,
+              limit: Optional[int] = None) -> Tuple[int, List[Tuple[int, Dict[str, str]]]]:
+        """
+        Filter, sort and page the records in the store
+
+        :param filters: Values to match, keyed on UI field
+        :param ranges: [min, max] bounds to match (either may be None), keyed on UI field
+        :param sort: UI field (or `ID`) to sort by
+        :param descending: Sort in descending order
+        :param offset: Number of matching records to skip
+        :param limit: Maximum number of records to return
+        :return: Total number of matching records, and list of (record ID, record) tuples in the requested page
+        """
+        clauses = []
+        params = []
+        for field, values in (filters or {}).items():
+            clauses.append(f'{_column(field)} IN ({", ".join("?" * len(values))})')
+            params.extend(values)
+        for field, (low, high) in (ranges or {}).items():
+            if low is not None:
+                clauses.append(f'{_column(field)} >= ?')
+                params.append(low)
+            if high is not None:
+                clauses.append(f'{_column(field)} <= ?')
+                params.append(high)
+        where = f' WHERE {" AND ".join(clauses)}' if clauses else ''
+        connection = self._connect()
+        total = connection.execute(f'SELECT COUNT(*) FROM records{where}', params).fetchone()[0]
+        direction = 'DESC' if descending else 'ASC'
+        order = 'id' if sort == ID_FIELD else f'{_column(sort)} {direction}, id'
+        rows = connection.execute(f'SELECT id, record FROM records{where} ORDER BY {order} {direction} '
+                                  f'LIMIT ? OFFSET ?', params + [limit if limit is not None else -1, offset])
+        return total, [(record_id, json.loads(record)) for record_id, record in rows]
+
+    def get(self, record_id: int) -> Optional[Dict[str, str]]:
+        """
+        Get a single record by ID
+
+        :param record_id: Row index of the record in the records file
+        :return: Parsed record, or None if there is no record with the ID
+        """
+        row = self._connect().execute('SELECT record FROM records WHERE id = ?', (record_id,)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+
+# Stores for each records file served, keyed on path
+_STORES: Dict[Tuple[str, str], RecordStore] = {}
+_STORES_LOCK = threading.Lock()
+
+
+def get_record_store(source: str, path: str) -> RecordStore:
+    """
+    Get the in-process record store for a records file
+
+    :param source: Path to the records file
+    :param path: Path to the SQLite store file
+    :return: Record store for the records file
+    """
+    store = _STORES.get((source, path))
+    if store is None:
+        with _STORES_LOCK:
+            store = _STORES.get((source, path))
+            if store is None:
+                store = _STORES[(source, path)] = RecordStore(source, path)
+    return store
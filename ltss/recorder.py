@@ -0,0 +1,132 @@
+"""Sampled recording of API requests to a compact log, for replay by the load-test harness
+
+Each recorded request is appended to the log as a single line of unindented JSON:
+ - `t`: Time the request was recorded (seconds since the epoch)
+ - `m`: HTTP method
+ - `p`: Request path
+ - `q`: Query string (omitted if empty)
+ - `c`: Content type of the body (omitted if there is no body)
+ - `j`: JSON body, or `b`: any other body, base64 encoded
+ - `s`: Response status code
+
+Recorded forecast requests contain patient records, so the log must be stored and handled as patient data.
+"""
+import base64
+import json
+import logging
+import os
+import random
+import threading
+import time
+from typing import Dict, Iterator, Optional, Tuple
+
+from flask import Request
+
+# Constants to initialise logging
+LOG = logging.getLogger('ltss.recorder')
+
+# Path prefixes of the requests recorded (admin requests are never recorded)
+RECORDED_PATHS = ('/api/forecast', '/api/record', '/api/census')
+
+
+class RequestRecorder:
+    """Append a random sample of requests to a log file, stopping once the log reaches its maximum size"""
+
+    def __init__(self, path: str, sample_rate: float, max_bytes: Optional[int] = None):
+        """
+        :param path: Path of the log file, appended to if it exists
+        :param sample_rate: Proportion of requests to record, between 0 and 1
+        :param max_bytes: Stop recording once the log file reaches this size (None for no limit)
+        """
+        self.path = path
+        self.sample_rate = sample_rate
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._full = False
+
+    def sampled(self, req: Request) -> bool:
+        """Check whether a request should be recorded"""
+        if self._full or not req.path.startswith(RECORDED_PATHS):
+            return False
+        return random.random() < self.sample_rate
+
+    def record(self, req: Request, status: int):
+        """
+        Record a request, if sampled. Failures to record are logged rather than raised, so recording can never fail a
+        request.
+
+        :param req: Flask request
+        :param status: Response status code
+        """
+        if not self.sampled(req):
+            return
+        try:
+            line = json.dumps(encode_request(req, status), separators=(',', ':')) + '\n'
+            with self._lock:
+                if self.max_bytes is not None and os.path.exists(self.path) and \
+                        os.path.getsize(self.path) >= self.max_bytes:
+                    LOG.info(f'Request log {self.path} is full, recording stopped')
+                    self._full = True
+                    return
+                # Append a whole line per write, so lines from several worker processes do not interleave
+                with open(self.path, 'a') as fp:
+                    fp.write(line)
+        except Exception as e:
+            LOG.exception(e)
+
+
+def encode_request(req: Request, status: int) -> Dict:
+    """
+    Encode a request as a compact log entry
+
+    :param req: Flask request
+    :param status: Response status code
+    :return: Log entry object
+    """
+    entry = dict(t=round(time.time(), 3), m=req.method, p=req.path)
+    if req.query_string:
+        entry['q'] = req.query_string.decode()
+    body = req.get_data()
+    if body:
+        entry['c'] = req.mimetype
+        payload = req.get_json(silent=True) if req.is_json else None
+        if payload is not None:
+            entry['j'] = payload
+        else:
+            entry['b'] = base64.b64encode(body).decode()
+    entry['s'] = status
+    return entry
+
+
+def read_request_log(path: str) -> Iterator[Tuple[str, str, str, Optional[str], Optional[bytes]]]:
+    """
+    Read the requests recorded in a log
+
+    :param path: Path of the log file
+    :return: Iterator of method, path, query string, content type, and body of each request
+    """
+    with open(path) as fp:
+        for line in fp:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            body = None
+            if 'j' in entry:
+                body = json.dumps(entry['j'], separators=(',', ':')).encode()
+            elif 'b' in entry:
+                body = base64.b64decode(entry['b'])
+            yield entry['m'], entry['p'], entry.get('q', ''), entry.get('c'), body
+
+
+def from_config(config: Dict) -> Optional[RequestRecorder]:
+    """
+    Create the recorder configured for the app
+
+    :param config: App configuration
+    :return: Request recorder, or None if recording is disabled
+    """
+    if not config.get('REQUEST_LOG_FILE') or not config.get('REQUEST_LOG_SAMPLE_RATE'):
+        return None
+    LOG.info(f'Recording {config["REQUEST_LOG_SAMPLE_RATE"]:.1%} of requests to {config["REQUEST_LOG_FILE"]}')
+    return RequestRecorder(config['REQUEST_LOG_FILE'], config['REQUEST_LOG_SAMPLE_RATE'],
+                           max_bytes=config.get('REQUEST_LOG_MAX_BYTES'))
@@ -0,0 +1,156 @@
+"""In-process cache of the patient records file, keyed on the file's modification time and size"""
+import hashlib
+import logging
+import os
+import threading
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Callable, Tuple
+
+from ltss.utils import read_records, format_record_for_frontend
+
+# Constants to initialise logging
+LOG = logging.getLogger('ltss.records')
+
+
+def file_stamp(path: str) -> Tuple[int, int]:
+    """
+    Get the version stamp of a file
+
+    :param path: Path to the file
+    :return: (modification time in ns, size in bytes) tuple
+    """
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def record_hash(record: Dict[str, str]) -> bytes:
+    """
+    Hash the content of a record, so unchanged records can be recognised between versions of the records file
+
+    :param record: Parsed record
+    :return: Digest of the record's field names and values
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for key, value in record.items():
+        digest.update(f'{key}\x1f{value}\x1e'.encode())
+    return digest.digest()
+
+
+class FileVersion:
+    """
+    A single version of a records file. The version stamp is used to derive the ETag and Last-Modified values of
+    responses, so unchanged polls can be answered with `304 Not Modified`.
+
+    :param stamp: File version stamp, as a (modification time in ns, size in bytes) tuple
+    """
+
+    def __init__(self, stamp: Tuple[int, int]):
+        self.stamp = stamp
+
+    @property
+    def etag(self) -> str:
+        """Entity tag for the file version"""
+        mtime_ns, size = self.stamp
+        return f'{mtime_ns:x}-{size:x}'
+
+    @property
+    def last_modified(self) -> datetime:
+        """Modification time of the file version"""
+        return datetime.fromtimestamp(self.stamp[0] / 1e9, tz=timezone.utc)
+
+
+class RecordsVersion(FileVersion):
+    """
+    Parsed records from a single version of a records file, along with their serialised JSON responses.
+
+    The serialised responses for the full record list and for each individual record are built at most once per
+    version, so unchanged polls can be answered without re-reading or re-serialising anything.
+
+    :param stamp: File version stamp, as a (modification time in ns, size in bytes) tuple
+    :param records: Parsed records in the file
+    """
+
+    def __init__(self, stamp: Tuple[int, int], records: List[Dict[str, str]]):
+        super().__init__(stamp)
+        self.records = records
+        self._records_json: Optional[bytes] = None
+        self._record_json: Dict[int, bytes] = {}
+
+    def records_json(self, serialise: Callable[[object], bytes]) -> bytes:
+        """
+        Get the serialised JSON object of all records, keyed on row index
+
+        :param serialise: Function to serialise an object to JSON bytes
+        :return: Serialised records object
+        """
+        body = self._records_json
+        if body is None:
+            body = serialise({i: record for i, record in enumerate(self.records)})
+            self._records_json = body
+        return body
+
+    def record_json(self, index: int, serialise: Callable[[object], bytes]) -> Optional[bytes]:
+        """
+        Get the serialised JSON of a single record, formatted for the frontend
+
+        :param index: Row index of the record
+        :param serialise: Function to serialise an object to JSON bytes
+        :return: Serialised record, or None if there is no record at the given index
+        """
+        if not 0 <= index < len(self.records):
+            return
+        body = self._record_json.get(index)
+        if body is None:
+            body = serialise(format_record_for_frontend(self.records[index]))
+            self._record_json[index] = body
+        return body
+
+
+class RecordsCache:
+    """
+    Cache of the current version of a records file, which is only re-read when the file's modification time or size
+    changes
+
+    :param path: Path to the records file
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._version: Optional[RecordsVersion] = None
+
+    def current(self) -> RecordsVersion:
+        """
+        Get the current version of the records file, re-reading the file if it has changed since it was last read
+
+        :return: RecordsVersion for the current file contents
+        """
+        stamp = file_stamp(self.path)
+        version = self._version
+        if version is None or version.stamp != stamp:
+            with self._lock:
+                # Another thread may have re-read the file while this one waited for the lock
+                version = self._version
+                if version is None or version.stamp != stamp:
+                    LOG.debug(f'Reading records from {self.path}')
+                    version = RecordsVersion(stamp, list(read_records(self.path)))
+                    # Swap in the new version; requests holding the old version finish serving from it
+                    self._version = version
+        return version
+
+
+# Caches for each records file served, keyed on path
+_CACHES: Dict[str, RecordsCache] = {}
+
+
+def get_records(path: str) -> RecordsVersion:
+    """
+    Get the current version of a records file from the in-process cache
+
+    :param path: Path to the records file
+    :return: RecordsVersion for the current file contents
+    """
+    cache = _CACHES.get(path)
+    if cache is None:
+        cache = _CACHES.setdefault(path, RecordsCache(path))
+    return cache.current()
@@ -0,0 +1,453 @@
+"""Versioned sets of model artifacts, with zero-downtime reload and per-site model residency"""
+import hashlib
+import logging
+import math
+import os
+import sys
+import threading
+import weakref
+from collections import OrderedDict
+from typing import Optional, List, Tuple, Union, Dict, Callable, Any
+
+import numpy as np
+import torch
+
+from ltss import los_model, risk_model
+from ltss.vectorise import Mapping, vectorise_record
+
+# Constants to initialise logging
+LOG = logging.getLogger('ltss.registry')
+
+
+class ModelBundle:
+    """
+    A set of models and the vector mapping they were trained against, served together as a single version.
+
+    Bundles are never modified once loaded, except to load a deferred LoS model on first use. Reloading builds a new
+    bundle and swaps it in, so a request that has taken a reference to a bundle finishes on that version even if a
+    reload completes part way through.
+
+    :param los_predictor: Initialised LoSPredictor (or Quantised, Ensemble or Student LoSPredictor) instance, or None
+    to defer loading it to `los_loader`
+    :param risk_predictor: Initialised RiskCDFModel instance
+    :param mapping: Vectorisation mapping for records scored against the models
+    :param version: Version identifier derived from the content of the model artifacts
+    :param los_loader: Function to load the LoS model the first time it is used, if `los_predictor` is None
+    """
+
+    def __init__(self, los_predictor: Optional[Union[los_model.LoSPredictor, los_model.QuantisedLoSPredictor,
+                                                     los_model.EnsembleLoSPredictor, los_model.StudentLoSPredictor]],
+                 risk_predictor: risk_model.RiskCDFModel, mapping: Mapping, version: str,
+                 los_loader: Optional[Callable[[], Any]] = None):
+        self._los_model = los_predictor
+        self._los_loader = los_loader
+        self._los_lock = threading.Lock()
+        self.risk_model = risk_predictor
+        self.mapping = mapping
+        self.version = version
+
+    @property
+    def los_model(self) -> Union[los_model.LoSPredictor, los_model.QuantisedLoSPredictor,
+                                 los_model.EnsembleLoSPredictor, los_model.StudentLoSPredictor]:
+        """LoS model of the bundle, loaded on first use if its loading was deferred"""
+        if self._los_model is None:
+            with self._los_lock:
+                # Another thread may have loaded the model while this one waited for the lock
+                if self._los_model is None:
+                    LOG.info(f'Loading deferred LoS model of version {self.version}')
+                    self._los_model = self._los_loader()
+        return self._los_model
+
+    @property
+    def los_loaded(self) -> bool:
+        """Whether the LoS model is resident in this process"""
+        return self._los_model is not None
+
+
+def artifact_version(paths: List[Optional[str]]) -> str:
+    """
+    Derive a version identifier from the content of a set of artifact files
+
+    :param paths: Paths to the artifact files (missing or None paths are skipped)
+    :return: Short hex digest of the file contents
+    """
+    digest = hashlib.sha256()
+    for path in paths:
+        if path is None or not os.path.exists(path):
+            continue
+        with open(path, 'rb') as fp:
+            for block in iter(lambda: fp.read(1 << 20), b''):
+                digest.update(block)
+    return digest.hexdigest()[:12]
+
+
+def file_stamps(paths: List[Optional[str]]) -> Tuple:
+    """
+    Get the modification time and size of each of a set of files, for cheap change detection
+
+    :param paths: Paths to the files (missing or None paths are stamped as None)
+    :return: Tuple of (modification time in ns, size in bytes) tuples
+    """
+    stamps = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            stamps.append((stat.st_mtime_ns, stat.st_size))
+        except (OSError, TypeError):
+            stamps.append(None)
+    return tuple(stamps)
+
+
+def validate_bundle(bundle: ModelBundle, warmup_passes: int = 3):
+    """
+    Check a bundle produces a sane forecast end-to-end, warming up the models in the process. A deferred LoS model is
+    not loaded, and only the risk model is checked.
+
+    :param bundle: Bundle to validate
+    :param warmup_passes: Number of forecasts to run
+    """
+    # Vectorise an empty record to exercise the mapping, then fill each selector with a category known to the risk
+    # model so every stage of the forecast is run
+    vector = vectorise_record({}, bundle.mapping)
+    for selector, categories in bundle.risk_model.distributions.items():
+        if len(categories) > 0:
+            vector[selector] = next(iter(categories))
+    forecast = {}
+    for _ in range(warmup_passes):
+        if bundle.los_loaded:
+            forecast = los_model.get_prediction(bundle.los_model, vector)
+        risk_predictions = risk_model.get_prediction(bundle.risk_model, vector,
+                                                     ai_day_prediction=forecast.get('PREDICTED_LOS'))
+    if not math.isfinite(forecast.get('PREDICTED_LOS', 0.0)):
+        raise ValueError(f'LoS model produced a non-finite prediction: {forecast["PREDICTED_LOS"]}')
+    if not 1 <= risk_predictions['RISK_STRATIFICATION'] <= 5:
+        raise ValueError(f'Risk model produced an invalid risk band: {risk_predictions["RISK_STRATIFICATION"]}')
+
+
+def load_los_predictor(los_model_file: str, quantised_model_file: Optional[str] = None,
+                       quantised_tolerance: float = 0.5, ensemble_files: Optional[List[str]] = None) \
+        -> Union[los_model.LoSPredictor, los_model.QuantisedLoSPredictor, los_model.EnsembleLoSPredictor,
+                 los_model.StudentLoSPredictor]:
+    """
+    Load the LoS model to serve: an ensemble of checkpoints if configured, else a distilled student model in the LoS
+    model file, else the quantised model if within tolerance, else the float model
+
+    :param los_model_file: Path to LoS model state file
+    :param quantised_model_file: Optional path to quantised LoS model state file
+    :param quantised_tolerance: Maximum increase in validation MSE of the quantised model over the float model
+    :param ensemble_files: Optional paths to LoS model checkpoints to serve as an ensemble
+    :return: Initialised LoS predictor
+    """
+    if ensemble_files:
+        LOG.info(f'Serving ensemble of {len(ensemble_files)} LoS models')
+        return los_model.init_ensemble_model(ensemble_files)
+    los_predictor = None
+    # A quantised model is built from a LoSPredictor, so never serve one in place of a distilled student model
+    if quantised_model_file is not None and os.path.exists(quantised_model_file):
+        if los_model.is_student_model(los_model_file):
+            LOG.info(f'Not serving quantised LoS model {quantised_model_file} in place of the student LoS model')
+        else:
+            los_predictor = los_model.init_quantised_model(model_file=quantised_model_file,
+                                                           tolerance=quantised_tolerance)
+    if los_predictor is None:
+        los_predictor = los_model.init_model(model_file=los_model_file)
+        if isinstance(los_predictor, los_model.StudentLoSPredictor):
+            LOG.info(f'Serving distilled {los_predictor.config["arch"]} student LoS model')
+        return los_predictor
+    LOG.info('Serving int8 quantised LoS model')
+    return los_predictor
+
+
+def load_bundle(los_model_file: str, risk_model_file: str, mapping_file: str,
+                quantised_model_file: Optional[str] = None, quantised_tolerance: float = 0.5,
+                ensemble_files: Optional[List[str]] = None, defer_los: bool = False) -> ModelBundle:
+    """
+    Load, validate and warm up a set of model artifacts
+
+    :param los_model_file: Path to LoS model state file
+    :param risk_model_file: Path to risk model saved state pickle file
+    :param mapping_file: Path to vectorisation mapping file
+    :param quantised_model_file: Optional path to quantised LoS model state file, used in place of the float model
+    if within tolerance
+    :param quantised_tolerance: Maximum increase in validation MSE of the quantised model over the float model
+    :param ensemble_files: Optional paths to LoS model checkpoints, served as an ensemble in place of the other LoS
+    models
+    :param defer_los: Load the LoS model on first use rather than now, e.g. when forecasts are normally scored by a
+    model server, so the process only holds it if it has to score in-process
+    :return: Validated ModelBundle
+    """
+    # Identify the version by file content, so every forecast can be traced back to the exact artifacts served
+    version = artifact_version([los_model_file, quantised_model_file, risk_model_file, mapping_file,
+                                *(ensemble_files or [])])
+
+    def load_los():
+        return load_los_predictor(los_model_file, quantised_model_file, quantised_tolerance, ensemble_files)
+    bundle = ModelBundle(None if defer_los else load_los(), risk_model.init_model(model_file=risk_model_file),
+                         Mapping(mapping_file), version, los_loader=load_los)
+    validate_bundle(bundle)
+    return bundle
+
+
+class ModelReloader:
+    """
+    Holds the active ModelBundle, and replaces it with a newly loaded bundle on request or when the artifact files
+    change on disk. New bundles are loaded, validated and warmed up in a background thread before being swapped in,
+    so requests are never served by a partially loaded model. If loading fails, the active bundle is kept.
+
+    :param loader: Function to load and validate a new bundle
+    :param paths: Artifact files to watch for changes
+    """
+
+    def __init__(self, loader: Callable[[], ModelBundle], paths: List[Optional[str]]):
+        self._loader = loader
+        self._paths = paths
+        self._reload_lock = threading.Lock()
+        self._watch_thread: Optional[threading.Thread] = None
+        self.last_error: Optional[str] = None
+        # Load the initial bundle synchronously: there is nothing to serve until it is ready
+        self._stamps = file_stamps(paths)
+        self.active: ModelBundle = loader()
+
+    def reload(self, background: bool = True) -> bool:
+        """
+        Load a new bundle and swap it in once validated
+
+        :param background: If true, load in a background thread and return immediately
+        :return: False if a reload was already in progress, otherwise True. Whether the reload succeeded is given
+        by `last_error`.
+        """
+        if not self._reload_lock.acquire(blocking=False):
+            return False
+        if background:
+            threading.Thread(target=self._reload, name='ltss-model-reload', daemon=True).start()
+        else:
+            self._reload()
+        return True
+
+    def _reload(self) -> bool:
+        """Load a new bundle and swap it in, releasing the reload lock once done"""
+        # Record the file stamps whether or not the load succeeds, so a bad artifact is not retried until it changes
+        self._stamps = file_stamps(self._paths)
+        try:
+            bundle = self._loader()
+        except Exception as e:
+            LOG.exception(e)
+            self.last_error = str(e)
+            return False
+        else:
+            self.last_error = None
+            if bundle.version != self.active.version:
+                LOG.info(f'Swapping model version {self.active.version} for {bundle.version}')
+            # Single reference assignment, so requests see either the old or the new bundle in full
+            self.active = bundle
+            return True
+        finally:
+            self._reload_lock.release()
+
+    def watch(self, interval: float):
+        """
+        Start a background thread polling the artifact files for changes, reloading once a change has settled
+
+        :param interval: Polling interval in seconds
+        """
+        if self._watch_thread is not None:
+            return
+        self._watch_thread = threading.Thread(target=self._watch, args=(interval,), name='ltss-model-watch',
+                                              daemon=True)
+        self._watch_thread.start()
+
+    def _watch(self, interval: float):
+        """Poll the artifact files, reloading when their stamps change and then stay unchanged for one interval"""
+        previous = self._stamps
+        stop = threading.Event()
+        while not stop.wait(interval):
+            stamps = file_stamps(self._paths)
+            # Require the same stamps on two consecutive polls, to avoid loading a file that is still being copied
+            if stamps != self._stamps and stamps == previous:
+                self.reload(background=False)
+            previous = stamps
+
+    def status(self) -> Dict:
+        """Summary of the active bundle and reload state"""
+        return dict(
+            model_version=self.active.version,
+            reloading=self._reload_lock.locked(),
+            last_error=self.last_error,
+        )
+
+
+def estimate_bytes(obj: Any, seen: Optional[set] = None) -> int:
+    """
+    Estimate the memory held by a model or mapping object, counting shared objects once
+
+    :param obj: Object to measure
+    :param seen: IDs of objects already counted
+    :return: Approximate size in bytes
+    """
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    if isinstance(obj, torch.nn.Module):
+        return sum(t.numel() * t.element_size() for t in obj.state_dict().values() if isinstance(t, torch.Tensor))
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if isinstance(obj, dict):
+        return sys.getsizeof(obj) + sum(estimate_bytes(k, seen) + estimate_bytes(v, seen) for k, v in obj.items())
+    if isinstance(obj, (list, tuple, set)):
+        return sys.getsizeof(obj) + sum(estimate_bytes(v, seen) for v in obj)
+    if hasattr(obj, '__dict__') and not isinstance(obj, type):
+        return sys.getsizeof(obj) + estimate_bytes(vars(obj), seen)
+    return sys.getsizeof(obj)
+
+
+class UnknownSite(KeyError):
+    """Raised when models are requested for a site that is not configured"""
+
+
+class SiteEntry:
+    """
+    Models resident for a site, along with the artifact stamps they were loaded from and the shared components they
+    use
+
+    :param bundle: Loaded models
+    :param stamps: Artifact file stamps at load time
+    :param components: Keys of the shared components in the bundle
+    """
+
+    def __init__(self, bundle: ModelBundle, stamps: Tuple, components: List[Tuple[str, str]]):
+        self.bundle = bundle
+        self.stamps = stamps
+        self.components = components
+
+
+class ModelRegistry:
+    """
+    Models for several sites, each with their own artifacts, served from a single process.
+
+    Each site's models are loaded on first use, and reloaded when its artifact files change. Model components with
+    identical artifact content (e.g. a vector mapping shared by every site) are loaded once and shared between sites.
+    When the estimated memory of the resident models exceeds the budget, the least recently used sites are evicted,
+    to be loaded again on their next request.
+
+    :param sites: Artifact paths for each site, keyed on site ID. Each is a dict of LOS_MODEL_FILE, RISK_MODEL_FILE,
+    VECTOR_MAPPING_FILE, and optionally LOS_QUANTISED_MODEL_FILE, LOS_QUANTISED_TOLERANCE and LOS_ENSEMBLE_FILES.
+    :param memory_budget: Maximum estimated memory of resident models in bytes (None for no limit). The most recently
+    used site is always kept, even if it alone exceeds the budget.
+    """
+
+    def __init__(self, sites: Dict[str, Dict[str, Any]], memory_budget: Optional[int] = None):
+        self.sites = sites
+        self.memory_budget = memory_budget
+        self._lock = threading.Lock()
+        self._site_locks: Dict[str, threading.Lock] = {site: threading.Lock() for site in sites}
+        self._resident: 'OrderedDict[str, SiteEntry]' = OrderedDict()
+        # Loaded components, kept alive only while a resident site uses them
+        self._shared: 'weakref.WeakValueDictionary[Tuple[str, str], Any]' = weakref.WeakValueDictionary()
+        self._sizes: Dict[Tuple[str, str], int] = {}
+        self.evictions = 0
+
+    @staticmethod
+    def _paths(config: Dict[str, Any]) -> List[Optional[str]]:
+        """Artifact paths of a site, in the order they are versioned"""
+        return [config['LOS_MODEL_FILE'], config.get('LOS_QUANTISED_MODEL_FILE'), config['RISK_MODEL_FILE'],
+                config['VECTOR_MAPPING_FILE'], *(config.get('LOS_ENSEMBLE_FILES') or [])]
+
+    def get(self, site: str) -> ModelBundle:
+        """
+        Get the models for a site, loading them if they are not resident or their artifacts have changed
+
+        :param site: Site ID
+        :return: The site's models
+        :raises UnknownSite: If the site is not configured
+        """
+        config = self.sites.get(site)
+        if config is None:
+            raise UnknownSite(site)
+        stamps = file_stamps(self._paths(config))
+        entry = self._resident.get(site)
+        if entry is None or entry.stamps != stamps:
+            # Load each site once, without blocking requests for other sites
+            with self._site_locks[site]:
+                entry = self._resident.get(site)
+                if entry is None or entry.stamps != stamps:
+                    return self._load(site, config, stamps).bundle
+        with self._lock:
+            # Unless the site has since been reloaded or evicted, mark it as most recently used
+            if self._resident.get(site) is entry:
+                self._resident.move_to_end(site)
+        return entry.bundle
+
+    def _component(self, key: Tuple[str, str], load: Callable[[], Any], components: List[Tuple[str, str]]) -> Any:
+        """Get a shared component by content key, loading it if no resident site has it"""
+        component = self._shared.get(key)
+        if component is None:
+            component = load()
+            self._shared[key] = component
+            self._sizes[key] = estimate_bytes(component)
+        components.append(key)
+        return component
+
+    def _load(self, site: str, config: Dict[str, Any], stamps: Tuple) -> SiteEntry:
+        """Load a site's models with its lock held, sharing components loaded for other sites, and make them resident"""
+        LOG.info(f'Loading models for site {site}')
+        components = []
+        los_file, quantised_file = config['LOS_MODEL_FILE'], config.get('LOS_QUANTISED_MODEL_FILE')
+        tolerance = config.get('LOS_QUANTISED_TOLERANCE', 0.5)
+        ensemble_files = config.get('LOS_ENSEMBLE_FILES') or []
+        los_predictor = self._component(
+            ('los', f'{artifact_version([los_file, quantised_file, *ensemble_files])}-{tolerance}'),
+            lambda: load_los_predictor(los_file, quantised_file, tolerance, ensemble_files), components)
+        risk_predictor = self._component(
+            ('risk', artifact_version([config['RISK_MODEL_FILE']])),
+            lambda: risk_model.init_model(model_file=config['RISK_MODEL_FILE']), components)
+        mapping = self._component(
+            ('mapping', artifact_version([config['VECTOR_MAPPING_FILE']])),
+            lambda: Mapping(config['VECTOR_MAPPING_FILE']), components)
+        bundle = ModelBundle(los_predictor, risk_predictor, mapping, artifact_version(self._paths(config)))
+        validate_bundle(bundle)
+        entry = SiteEntry(bundle, stamps, components)
+        with self._lock:
+            # Replace any previous version of the site's models while the site lock is held, so other requests for the
+            # site find the new models as soon as the old ones are gone
+            self._resident.pop(site, None)
+            self._resident[site] = entry
+            self._evict()
+        return entry
+
+    def resident_bytes(self) -> int:
+        """Estimated memory of the resident models, counting shared components once"""
+        keys = {key for entry in self._resident.values() for key in entry.components}
+        return sum(self._sizes.get(key, 0) for key in keys)
+
+    def _evict(self):
+        """Evict least recently used sites until the resident models are within the memory budget"""
+        if self.memory_budget is None:
+            return
+        while len(self._resident) > 1 and self.resident_bytes() > self.memory_budget:
+            site, _ = self._resident.popitem(last=False)
+            self.evictions += 1
+            LOG.info(f'Evicted models for site {site} to stay within the memory budget')
+        # Forget the sizes of components no longer in use
+        self._sizes = {key: size for key, size in self._sizes.items() if key in self._shared}
+
+    def evict(self, site: str) -> bool:
+        """
+        Evict a site's models, so they are reloaded on the site's next request
+
+        :param site: Site ID
+        :return: True if the site's models were resident
+        """
+        with self._lock:
+            return self._resident.pop(site, None) is not None
+
+    def status(self) -> Dict:
+        """Summary of the resident sites and memory use"""
+        with self._lock:
+            return dict(
+                sites=sorted(self.sites),
+                resident={site: entry.bundle.version for site, entry in self._resident.items()},
+                resident_bytes=self.resident_bytes(),
+                memory_budget=self.memory_budget,
+                evictions=self.evictions,
+            )
@@ -0,0 +1,189 @@
+"""CPU thread budgets for inference workers and training
+
+By default torch sizes its intra-op thread pool to every core of the host, in every process. With several uwsgi
+workers per host (or several training processes) the pools oversubscribe the cores, and tail latency suffers. This
+module detects the cores actually available to the process, including container (cgroup) CPU limits and CPU affinity,
+divides them between worker processes, and sizes the torch, OpenMP and BLAS thread pools to each worker's share,
+optionally pinning each worker to its own cores.
+"""
+import logging
+import math
+import os
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import torch
+
+# Constants to initialise logging
+LOG = logging.getLogger('ltss.resources')
+
+# cgroup v2 CPU limit, as "<quota> <period>" or "max <period>"
+CGROUP_V2_CPU_MAX = '/sys/fs/cgroup/cpu.max'
+# cgroup v1 CPU limit, as a quota (-1 for no limit) and period in microseconds
+CGROUP_V1_CPU_QUOTA = '/sys/fs/cgroup/cpu/cpu.cfs_quota_us'
+CGROUP_V1_CPU_PERIOD = '/sys/fs/cgroup/cpu/cpu.cfs_period_us'
+# Environment variables read by OpenMP and BLAS libraries (and inherited by child processes)
+THREAD_ENV_VARS = ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'NUMEXPR_NUM_THREADS',
+                   'VECLIB_MAXIMUM_THREADS']
+
+
+class ThreadPlan(NamedTuple):
+    """
+    Thread budget of a single worker process
+
+    :param cores: Number of cores available to all workers
+    :param workers: Number of worker processes sharing the cores
+    :param threads: Number of threads for the worker's torch, OpenMP and BLAS pools
+    :param cpus: CPUs the worker is pinned to (None to leave affinity unchanged)
+    """
+    cores: int
+    workers: int
+    threads: int
+    cpus: Optional[List[int]]
+
+
+def _read(path: str) -> Optional[str]:
+    """Read a small system file, returning None if it cannot be read"""
+    try:
+        with open(path, 'r') as fp:
+            return fp.read().strip()
+    except OSError:
+        return None
+
+
+def cgroup_cpu_limit() -> Optional[float]:
+    """
+    Get the CPU limit of the process's container, from the cgroup v2 or v1 CPU controller
+
+    :return: Number of cores the container may use (possibly fractional), or None if unlimited
+    """
+    cpu_max = _read(CGROUP_V2_CPU_MAX)
+    if cpu_max is not None:
+        quota, _, period = cpu_max.partition(' ')
+        if quota != 'max' and period:
+            return int(quota) / int(period)
+        return None
+    quota, period = _read(CGROUP_V1_CPU_QUOTA), _read(CGROUP_V1_CPU_PERIOD)
+    if quota is not None and period is not None and int(quota) > 0:
+        return int(quota) / int(period)
+    return None
+
+
+def available_cpus() -> List[int]:
+    """Get the CPUs the process may run on"""
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def available_cores() -> Tuple[int, List[int]]:
+    """
+    Detect the number of cores available to the process: the CPUs it may run on, capped by any container CPU limit
+
+    :return: Number of whole cores available (at least 1), and the CPUs the process may run on
+    """
+    cpus = available_cpus()
+    cores = len(cpus)
+    limit = cgroup_cpu_limit()
+    if limit is not None:
+        cores = min(cores, max(1, math.floor(limit)))
+    return max(1, cores), cpus
+
+
+def plan_threads(workers: int = 1, worker_index: int = 0, threads: Optional[int] = None,
+                 affinity: bool = False) -> ThreadPlan:
+    """
+    Divide the available cores between worker processes
+
+    :param workers: Number of worker processes sharing the host
+    :param worker_index: Index of this worker, from 0, used to choose its CPUs when pinning
+    :param threads: Number of threads per worker (by default, the available cores divided between the workers)
+    :param affinity: Pin the worker to its own share of the CPUs
+    :return: ThreadPlan for the worker
+    """
+    cores, cpus = available_cores()
+    workers = max(1, workers)
+    if threads is None:
+        threads = max(1, cores // workers)
+    pinned = None
+    if affinity:
+        # Give each worker a contiguous block of CPUs, wrapping round if the workers oversubscribe the CPUs
+        start = worker_index * threads
+        pinned = sorted({cpus[(start + i) % len(cpus)] for i in range(threads)})
+    return ThreadPlan(cores, workers, threads, pinned)
+
+
+def apply_plan(plan: ThreadPlan):
+    """
+    Size the process's thread pools to a plan, and pin it to the plan's CPUs
+
+    :param plan: ThreadPlan for the process
+    """
+    # Environment variables only affect libraries loaded (and processes started) after this point
+    for name in THREAD_ENV_VARS:
+        os.environ[name] = str(plan.threads)
+    # Sets torch's intra-op pool, and the OpenMP and MKL pools it uses
+    torch.set_num_threads(plan.threads)
+    try:
+        # Requests run on their own threads, so inter-op parallelism only adds contention
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        # The inter-op pool can only be sized before it is first used
+        pass
+    try:
+        # Limit BLAS pools that are already loaded (e.g. numpy's) if threadpoolctl is installed
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(plan.threads)
+    except ImportError:
+        pass
+    if plan.cpus is not None:
+        if hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, plan.cpus)
+        else:
+            LOG.warning('CPU affinity is not supported on this platform')
+
+
+def configure(workers: int = 1, worker_index: int = 0, threads: Optional[int] = None,
+              affinity: bool = False) -> ThreadPlan:
+    """
+    Plan and apply the thread budget of this process
+
+    :param workers: Number of worker processes sharing the host
+    :param worker_index: Index of this worker, from 0
+    :param threads: Number of threads per worker (by default, the available cores divided between the workers)
+    :param affinity: Pin the worker to its own share of the CPUs
+    :return: Applied ThreadPlan
+    """
+    plan = plan_threads(workers, worker_index, threads=threads, affinity=affinity)
+    apply_plan(plan)
+    LOG.info(f'Worker {worker_index + 1} of {plan.workers} using {plan.threads} threads of {plan.cores} cores'
+             + (f', pinned to CPUs {plan.cpus}' if plan.cpus is not None else ''))
+    return plan
+
+
+def uwsgi_worker() -> Tuple[int, int]:
+    """
+    Get the number of uwsgi worker processes and this worker's index, when running under uwsgi
+
+    :return: Number of workers, and the index of this worker from 0 (1 and 0 when not running under uwsgi)
+    """
+    try:
+        import uwsgi
+        return max(1, uwsgi.numproc), max(0, uwsgi.worker_id() - 1)
+    except (ImportError, AttributeError):
+        return 1, 0
+
+
+def from_config(config: Dict) -> Optional[ThreadPlan]:
+    """
+    Apply the thread budget configured for the app, dividing the available cores between the uwsgi workers
+
+    :param config: App configuration
+    :return: Applied ThreadPlan, or None if thread planning is disabled
+    """
+    if not config.get('WORKER_THREAD_PLAN'):
+        return None
+    workers, worker_index = uwsgi_worker()
+    if config.get('WORKER_COUNT'):
+        workers = config['WORKER_COUNT']
+    return configure(workers, worker_index, threads=config.get('WORKER_THREADS'),
+                     affinity=config.get('WORKER_CPU_AFFINITY', False))
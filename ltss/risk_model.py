@@ -1,6 +1,6 @@
 """Risk stratification CDF model"""
 import logging
-from typing import Optional, Dict, Tuple
+from typing import Optional, Dict, Tuple, Sequence
 
 import numpy as np
 import pickle
@@ -31,6 +31,12 @@ class RiskCDFModel:
         self.distributions = None
         self.base_distribution = None
         self.cumulative = None
+        # Conditional CDF tables for patients already in hospital for each day, built by `build_conditional_tables`
+        self.conditional_tables = None
+        self.conditional_base = None
+        self.conditional_confidence = None
+        # Conditional tables of each selector stacked for lookups of many records at once, keyed on confidence level
+        self._stacked_tables = {}
 
     def load_state_dict(self, filename: str):
         """Load model distributions from file
@@ -46,10 +52,134 @@ class RiskCDFModel:
         self.distributions = state.get("distributions")
         self.base_distribution = state.get("base_distribution")
         self.cumulative = state.get("cumulative")
+        self._stacked_tables = {}
         # Check all distributions have been read successfully
         if any(a is None for a in [self.distributions, self.base_distribution, self.cumulative]):
             LOG.error('Distribution required by CDF model is None')
             raise ValueError
+        # Precompute forecasts for patients already in hospital, so they are lookups at prediction time
+        if self.cumulative:
+            self.build_conditional_tables()
+
+    @staticmethod
+    def conditional_cdfs(cdf: np.array) -> np.array:
+        """
+        Condition a CDF on the patient having already stayed each number of days, truncating the CDF before that day
+        and renormalising it by the probability of staying at least that long
+
+        :param cdf: Array of CDF probabilities from 0 - 30 days
+        :return: 30 x 30 array, where row k is the CDF given a stay of at least k days (row 0 is the CDF itself)
+        """
+        # Probability of a stay of at least k days, for each k
+        previous = np.concatenate([[0], cdf[:-1]])
+        survival = 1 - previous
+        table = np.zeros((len(cdf), len(cdf)))
+        # If no patients stayed k days or more, there is no data to condition on and the CDF is left at zero
+        valid = survival > 0
+        table[valid] = (cdf[None, :] - previous[valid, None]) / survival[valid, None]
+        # Discharge before the day the patient has already reached is impossible
+        return np.triu(table)
+
+    def build_conditional_tables(self, confidence: float = 0.95):
+        """
+        Precompute the conditional CDF, day prediction, risk category and risk per band of every category of every
+        selector, for patients already in hospital for each of 0 - 29 days
+
+        :param confidence: Confidence level of the day predictions
+        """
+        self.conditional_tables = {
+            selector: {key: self.conditional_table(cdf, confidence) for key, cdf in categories.items()}
+            for selector, categories in self.distributions.items()
+        }
+        self.conditional_base = self.conditional_cdfs(self.base_distribution)
+        self.conditional_confidence = confidence
+        self._stacked_tables = {}
+
+    @classmethod
+    def conditional_table(cls, cdf: np.array, confidence: float) -> Dict[str, np.ndarray]:
+        """
+        Compute the conditional CDF, day prediction, risk category and risk per band of a category, for patients
+        already in hospital for each of 0 - 29 days
+
+        :param cdf: Array of CDF probabilities from 0 - 30 days
+        :param confidence: Confidence level of the day predictions
+        :return: Dict of 30 x 30 conditional CDFs, 30 days, 30 risks and 30 x 5 risks per band
+        """
+        table = cls.conditional_cdfs(cdf)
+        # A patient already in hospital cannot be discharged before today, even if we are not confident
+        days = np.maximum(cls.days_from_cdfs(table, [confidence])[:, 0], np.arange(len(cdf)))
+        return dict(
+            cdf=table,
+            day=days,
+            risk=cls.risks_from_days(days),
+            risk_pdf=np.vstack([cls.risk_by_cdf(row) for row in table]),
+        )
+
+    def stacked_tables(self, confidence: float) -> Dict[str, Tuple[np.ndarray, Dict[str, np.ndarray]]]:
+        """
+        Stack the conditional tables of the categories of each selector, sorted by category, so a category can be
+        looked up for many records at once. Uses the precomputed tables where available, and is cached per confidence
+        level.
+
+        :param confidence: Confidence level of the day predictions
+        :return: Dict keyed on selector of the sorted categories, and dict of their stacked tables (as given by
+        `conditional_table`)
+        """
+        stacked = self._stacked_tables.get(confidence)
+        if stacked is not None:
+            return stacked
+        precomputed = self.conditional_tables is not None and confidence == self.conditional_confidence
+        stacked = {}
+        for selector, categories in self.distributions.items():
+            if not categories:
+                continue
+            keys = np.array(list(categories.keys()), dtype=float)
+            order = np.argsort(keys)
+            tables = [self.conditional_tables[selector][key] if precomputed else
+                      self.conditional_table(cdf, confidence) for key, cdf in categories.items()]
+            stacked[selector] = keys[order], {name: np.stack([table[name] for table in tables])[order]
+                                              for name in ('cdf', 'day', 'risk', 'risk_pdf')}
+        self._stacked_tables[confidence] = stacked
+        return stacked
+
+    def conditional_factor(self, selector: str, key, days_in_hospital: int, confidence: float) -> Optional[Dict]:
+        """
+        Get the conditional CDF, day prediction, risk category and risk per band of a selector category, for a patient
+        already in hospital for the given number of days. Uses the precomputed tables where available.
+
+        :param selector: Selector name
+        :param key: Category of the selector
+        :param days_in_hospital: Number of days the patient has already stayed
+        :param confidence: Confidence level
+        :return: Dict of conditional CDF, day, risk and risk_pdf, or None if the category is not known to the model
+        """
+        cdf = self.distributions.get(selector, dict()).get(key)
+        if cdf is None:
+            return None
+        k = min(days_in_hospital, len(cdf) - 1)
+        if self.conditional_tables is not None and confidence == self.conditional_confidence:
+            table = self.conditional_tables[selector][key]
+            return dict(cdf=table['cdf'][k], day=int(table['day'][k]), risk=int(table['risk'][k]),
+                        risk_pdf=table['risk_pdf'][k])
+        row = self.conditional_cdfs(cdf)[k]
+        day = max(self.day_from_cdf(row, confidence), k)
+        return dict(cdf=row, day=day, risk=self.risk_from_day(day), risk_pdf=self.risk_by_cdf(row))
+
+    def conditional_cdf(self, selector: str, key, days_in_hospital: int) -> np.ndarray:
+        """
+        Get the CDF of a selector category known to the model, conditioned on the patient having already stayed the
+        given number of days. Uses the precomputed tables where available.
+
+        :param selector: Selector name
+        :param key: Category of the selector
+        :param days_in_hospital: Number of days the patient has already stayed
+        :return: Conditional CDF
+        """
+        cdf = self.distributions[selector][key]
+        k = min(days_in_hospital, len(cdf) - 1)
+        if self.conditional_tables is not None:
+            return self.conditional_tables[selector][key]['cdf'][k]
+        return self.conditional_cdfs(cdf)[k]
 
     @staticmethod
     def day_from_pdf(pdf: np.array) -> int:
@@ -79,6 +209,45 @@ class RiskCDFModel:
             return 20
         return day[0][0].item()  # first day > conf
 
+    @staticmethod
+    def days_from_cdfs(cdfs: np.array, confidences: np.array) -> np.array:
+        """
+        Get day estimates from a stack of CDFs for many confidence levels at once. Equivalent to calling
+        `day_from_cdf` for every CDF and confidence level, but with a single vectorised search.
+
+        :param cdfs: M x 30 array of CDF probabilities from 0 - 30 days
+        :param confidences: Array of K confidence levels
+        :return: M x K array of day estimates
+        """
+        cdfs = np.atleast_2d(cdfs)
+        confidences = np.asarray(confidences, dtype=float)
+        n_rows, n_days = cdfs.shape
+        # The first day where the CDF exceeds the confidence level is also the first day where its running maximum
+        # does, and the running maximum is sorted, so it can be searched
+        running_max = np.maximum.accumulate(cdfs, axis=1)
+        # Offset each row by more than the range of all values, so the rows concatenate into one sorted array and
+        # every row and confidence level can be searched at once
+        low = min(running_max.min(), confidences.min())
+        high = max(running_max.max(), confidences.max())
+        offsets = np.arange(n_rows) * (high - low + 1)
+        positions = np.searchsorted((running_max + offsets[:, None]).ravel(),
+                                    (confidences[None, :] + offsets[:, None]).ravel(), side='right')
+        days = positions.reshape(n_rows, len(confidences)) - (np.arange(n_rows) * n_days)[:, None]
+        # If we are not confident, set to the last day before long stay
+        days[days >= n_days] = 20
+        return days
+
+    @staticmethod
+    def risks_from_days(days: np.array) -> np.array:
+        """
+        Vectorised `risk_from_day`, producing a stratified risk score for each of an array of day predictions
+        :param days: Array of predicted stays in days
+        :return: Array of risk categories in the range 1 - 5
+        """
+        days = np.asarray(days)
+        # Categories based on a 95% confidence interval, based on the training data
+        return 1 + (days > 6).astype(int) + (days >= 11) + (days > 13) + (days > 15)
+
     @staticmethod
     def risk_from_day(day: float) -> int:
         """
@@ -144,16 +313,23 @@ class RiskCDFModel:
         ]
         return np.array(risk_pdf)
 
-    def risk_and_day_from_record(self, record: Dict, confidence: float) -> Dict:
+    def risk_and_day_from_record(self, record: Dict, confidence: float, days_in_hospital: int = 0) -> Dict:
         """
         Takes record as input and produced a risk score and day prediction based on a confidence by factor
         :param record: Patient record
         :param confidence: Confidence level
+        :param days_in_hospital: Number of days the patient has already stayed
         :return: Dict of day predictions and risk scores per factor
         """
         factors_labels = {}
         for selector in self.selectors:
             key = record[selector]
+            if days_in_hospital > 0:
+                factor = self.conditional_factor(selector, key, days_in_hospital, confidence)
+                if factor is not None:
+                    factors_labels[selector] = dict(day=factor['day'], risk=factor['risk'],
+                                                    risk_pdf=factor['risk_pdf'])
+                continue
             cdf = self.distributions.get(selector, dict()).get(key)
             if cdf is not None:
                 day = self.day_from_cdf(cdf, confidence)
@@ -165,12 +341,14 @@ class RiskCDFModel:
                     risk_pdf=risk_pdf)
         return factors_labels
 
-    def compute_from_record(self, record: Dict, confidence: float, use_max=True) -> Tuple[int, np.ndarray]:
+    def compute_from_record(self, record: Dict, confidence: float, use_max=True,
+                            days_in_hospital: int = 0) -> Tuple[int, np.ndarray]:
         """
         Return a risk profile based on the patient record
         :param record: Patient record
         :param confidence: Confidence level
         :param use_max: Flag to indicate peak probability should be used
+        :param days_in_hospital: Number of days the patient has already stayed
         :return: day and probability based on population
         """
         # The model excludes non-major patients so a standard fallback prediction is issued for these patients.
@@ -182,6 +360,9 @@ class RiskCDFModel:
             pdf[2] = 0.01
             return 0, pdf
 
+        if days_in_hospital > 0 and self.cumulative:
+            return self.conditional_from_record(record, confidence, days_in_hospital)
+
         # Create a blank PDF
         pdf = np.zeros(30)
         count = 0
@@ -213,16 +394,158 @@ class RiskCDFModel:
             # actual probability should be the area to that point.
             return np.where(pdf == np.max(pdf)).item(), pdf
 
-    def risk_and_cat_by_record(self, record: Dict, confidence: float) -> Tuple[int, np.ndarray, Dict, str]:
+    def conditional_from_record(self, record: Dict, confidence: float, days_in_hospital: int) -> Tuple[int, np.ndarray]:
+        """
+        As `compute_from_record`, for a patient already in hospital for the given number of days, combining the
+        conditional CDFs of each factor
+        :param record: Patient record
+        :param confidence: Confidence level
+        :param days_in_hospital: Number of days the patient has already stayed
+        :return: day and conditional CDF based on population
+        """
+        cdf = np.zeros(30)
+        count = 0
+        for selector in self.selectors:
+            factor = self.conditional_factor(selector, record.get(selector), days_in_hospital, confidence)
+            if factor is not None:
+                cdf += factor['cdf']
+                count += 1
+        k = min(days_in_hospital, len(cdf) - 1)
+        if count > 0:
+            cdf = cdf / count
+        elif self.conditional_base is not None:
+            cdf = self.conditional_base[k]
+        else:
+            cdf = self.conditional_cdfs(self.base_distribution)[k]
+        # A patient already in hospital cannot be discharged before today, even if we are not confident
+        return max(self.day_from_cdf(cdf, confidence=confidence), k), cdf
+
+    def confidence_curve_from_record(self, record: Dict, confidences: Sequence[float],
+                                     days_in_hospital: int = 0) -> Tuple[np.ndarray, Dict]:
+        """
+        Compute the predicted discharge day for many confidence levels at once, from the combined CDF used by
+        `compute_from_record` and from the CDF of each contributing selector, with a single vectorised search
+        :param record: Patient record
+        :param confidences: Confidence levels
+        :param days_in_hospital: Number of days the patient has already stayed, to use the conditional CDFs of
+        `conditional_from_record`
+        :return: Array of days per confidence level, and dict of arrays of days per confidence level keyed on
+        contributing selector
+        """
+        confidences = np.asarray(confidences, dtype=float)
+        conditional = days_in_hospital > 0 and self.cumulative
+        k = min(days_in_hospital, len(self.base_distribution) - 1) if conditional else 0
+        selectors = []
+        cdfs = []
+        for selector in self.selectors:
+            cdf = self.distributions.get(selector, dict()).get(record.get(selector))
+            if cdf is not None:
+                selectors.append(selector)
+                cdfs.append(self.conditional_cdf(selector, record.get(selector), k) if conditional else cdf)
+        # Combine the CDFs as in `compute_from_record`, using the base PDF when no other data is available
+        if len(cdfs) > 0:
+            combined = np.mean(cdfs, axis=0)
+        elif conditional:
+            combined = self.conditional_base[k] if self.conditional_base is not None else \
+                self.conditional_cdfs(self.base_distribution)[k]
+        else:
+            combined = self.base_distribution
+        # A patient already in hospital cannot be discharged before today, even if we are not confident
+        days = np.maximum(self.days_from_cdfs(np.vstack([combined] + cdfs), confidences), k)
+        days_by_selector = dict(zip(selectors, days[1:]))
+        # Match the day given by `compute_from_record` where it does not depend on the confidence level
+        if record.get("IS_MAJOR", 1) == 0:
+            return np.zeros(len(confidences), dtype=int), days_by_selector
+        if not self.cumulative:
+            return np.full(len(confidences), self.day_from_pdf(combined)), days_by_selector
+        return days[0], days_by_selector
+
+    def risk_and_day_from_matrix(self, matrix: np.ndarray, confidence: float,
+                                 days_in_hospital: Optional[np.ndarray] = None) -> Tuple[np.ndarray, ...]:
+        """
+        Vectorised `compute_from_record` and `risk_and_cat_by_record` over a matrix of major patient records. Each
+        selector's categories are looked up for every record at once, rather than record by record.
+        :param matrix: N x len(selectors) array of flattened vectors, as produced by `flatten_columns`
+        :param confidence: Confidence level
+        :param days_in_hospital: Optional array of N numbers of days each patient has already stayed, as for the
+        per-record methods
+        :return: Arrays of day predictions, risk categories and risk per band for each record, a mask of the records
+        with at least one factor known to the model (for which `risk_and_cat_by_record` succeeds), an N x
+        len(selectors) array of the risk category of each factor (NaN where the factor is not known), and the index in
+        selectors of each record's biggest risk factor (-1 for none)
+        """
+        matrix = np.atleast_2d(matrix)
+        n = len(matrix)
+        n_days = len(self.base_distribution)
+        # Row of the conditional tables for each record, where row 0 holds the unconditioned values
+        if days_in_hospital is None:
+            k = np.zeros(n, dtype=int)
+        else:
+            k = np.minimum(np.asarray(days_in_hospital).astype(int), n_days - 1)
+        # As in `compute_from_record`, only CDF models combine the conditional CDFs of each factor
+        combined_k = k if self.cumulative else np.zeros(n, dtype=int)
+        pdf = np.zeros((n, n_days))
+        count = np.zeros(n, dtype=int)
+        risk_pdf = np.zeros((n, 5))
+        # Start above the highest risk category, so the first known factor always sets the minimum
+        risk = np.full(n, 6)
+        risk_by_selector = np.full((n, len(self.selectors)), np.nan)
+        biggest = np.full(n, -1)
+        biggest_value = np.zeros(n)
+        tables = self.stacked_tables(confidence)
+        for column, selector in enumerate(self.selectors):
+            if selector not in tables:
+                continue
+            keys, table = tables[selector]
+            # Find each record's category among the sorted keys, ignoring values unknown to the model
+            values = matrix[:, column]
+            index = np.minimum(np.searchsorted(keys, values), len(keys) - 1)
+            matched = keys[index] == values
+            rows = np.flatnonzero(matched)
+            index = index[rows]
+            factor_risk = table['risk'][index, k[rows]]
+            # As in `risk_and_cat_by_record`, the biggest risk factor is the first at which the running risk of the
+            # highest band (before adding the factor's own) is greatest
+            bigger = rows[risk_pdf[rows, 4] > biggest_value[rows]]
+            biggest[bigger] = column
+            biggest_value[bigger] = risk_pdf[bigger, 4]
+            # Accumulate in selector order, as the per-record methods do
+            pdf[rows] += table['cdf'][index, combined_k[rows]]
+            count += matched
+            risk[rows] = np.minimum(risk[rows], factor_risk)
+            risk_by_selector[rows, column] = factor_risk
+            risk_pdf[rows] += table['risk_pdf'][index, k[rows]]
+
+        known = count > 0
+        conditional = combined_k > 0
+        # Normalise, using the base PDF (or its conditional CDF) as our best guess when no other data is available
+        pdf[known] = pdf[known] / count[known, None]
+        if not known.all():
+            base = self.conditional_base if self.conditional_base is not None else \
+                self.conditional_cdfs(self.base_distribution)
+            pdf[~known] = base[combined_k[~known]]
+        if self.cumulative:
+            # A patient already in hospital cannot be discharged before today, even if we are not confident
+            days = self.days_from_cdfs(pdf, [confidence])[:, 0]
+            days[conditional] = np.maximum(days[conditional], combined_k[conditional])
+        else:
+            days = np.sum(np.arange(0, n_days) * pdf, axis=1)
+        risk_pdf[known] = risk_pdf[known] / count[known, None]
+        return days, risk, risk_pdf, known, risk_by_selector, biggest
+
+    def risk_and_cat_by_record(self, record: Dict, confidence: float,
+                               days_in_hospital: int = 0) -> Tuple[int, np.ndarray, Dict, str]:
         """
         Produce risk category by record with confidence
         :param record: patient record
         :param confidence: Confidence level
+        :param days_in_hospital: Number of days the patient has already stayed
         :return: risk, risk_cat, risk_factors, highest_risk_factor (Biggest Risk as seen in the input data)
         """
 
         # Start by getting the risk by day for each key
-        risk_per_factor = self.risk_and_day_from_record(record, confidence=confidence)
+        risk_per_factor = self.risk_and_day_from_record(record, confidence=confidence,
+                                                        days_in_hospital=days_in_hospital)
 
         # Init variables for calculating the risks and factors
         scores = []
@@ -265,7 +588,7 @@ def init_model(model_file: str = 'config/risk_model.pickle') -> Optional[RiskCDF
 
 
 def get_prediction(predictor: RiskCDFModel, vector: Dict, confidence: float = 0.95,
-                   ai_day_prediction: float = None) -> Dict:
+                   ai_day_prediction: float = None, days_in_hospital: int = 0) -> Dict:
     """
     Interrogate the DistributionBuilder model for a set of predictions
 
@@ -273,14 +596,20 @@ def get_prediction(predictor: RiskCDFModel, vector: Dict, confidence: float = 0.
     :param vector: Vectorised patient record
     :param confidence: Confidence level
     :param ai_day_prediction: Length of stay days prediction from AI model
+    :param days_in_hospital: Number of days the patient has already stayed, to forecast from today rather than from
+    admission
     :return: Dict of predicted results
     """
-    day, pdf = predictor.compute_from_record(vector, confidence=confidence, use_max=False)
-    risk, risk_category, risk_factor, biggest_risk = predictor.risk_and_cat_by_record(vector, confidence=confidence)
+    day, pdf = predictor.compute_from_record(vector, confidence=confidence, use_max=False,
+                                             days_in_hospital=days_in_hospital)
+    risk, risk_category, risk_factor, biggest_risk = predictor.risk_and_cat_by_record(
+        vector, confidence=confidence, days_in_hospital=days_in_hospital)
     percentage_risk = predictor.risk_of_long_stay_by_category(risk)
 
     risk_ceiling = risk
     if ai_day_prediction is not None:
+        # The AI model predicts from admission, so its prediction is at least the stay so far
+        ai_day_prediction = max(ai_day_prediction, days_in_hospital)
         # Using LoS day prediction from AI model, calculate a risk level
         ai_risk = predictor.risk_from_day(ai_day_prediction)
         # Carry forward the higher of the two risk scores
@@ -300,3 +629,88 @@ def get_prediction(predictor: RiskCDFModel, vector: Dict, confidence: float = 0.
     )
 
     return prediction
+
+
+def get_predictions(predictor: RiskCDFModel, matrix: np.ndarray, confidence: float = 0.95,
+                    ai_day_predictions: np.ndarray = None,
+                    days_in_hospital: np.ndarray = None) -> Tuple[Dict[str, np.ndarray], np.ndarray]:
+    """
+    Interrogate the DistributionBuilder model for predictions for a matrix of major patient records at once, giving
+    the same values as `get_prediction` for each record. BIGGEST_RISK_FACTOR is given as an index into the model's
+    selectors (-1 for none), and RISK_BY_CATEGORY as an N x len(selectors) array of the risk of each factor (NaN where
+    the factor is not known to the model).
+
+    :param predictor: Initialised DistributionBuilder instance
+    :param matrix: N x len(MODEL_SELECTORS) array of flattened vectors, as produced by `flatten_columns`
+    :param confidence: Confidence level
+    :param ai_day_predictions: Array of N length of stay days predictions from AI model
+    :param days_in_hospital: Optional array of N numbers of days each patient has already stayed, to forecast from
+    today rather than from admission
+    :return: Dict of arrays of predicted results, and a mask of the records with valid predictions (those with at
+    least one factor known to the model)
+    """
+    days, risk, risk_category, known, risk_by_selector, biggest = predictor.risk_and_day_from_matrix(
+        matrix, confidence=confidence, days_in_hospital=days_in_hospital)
+    risk_ceiling = risk
+    if ai_day_predictions is not None:
+        # The AI model predicts from admission, so its prediction is at least the stay so far
+        if days_in_hospital is not None:
+            ai_day_predictions = np.maximum(ai_day_predictions, days_in_hospital)
+        # Carry forward the higher of the AI model and CDF model risk scores
+        risk_ceiling = np.maximum(risk, predictor.risks_from_days(ai_day_predictions))
+    percentage_risk = np.array([predictor.risk_of_long_stay_by_category(c) for c in range(6)] + [0])[risk]
+
+    predictions = dict(
+        RISK_STRATIFICATION=risk_ceiling,
+        RISK_CAT_PROB_GENERAL_1=risk_category[:, 0],
+        RISK_CAT_PROB_GENERAL_2=risk_category[:, 1],
+        RISK_CAT_PROB_GENERAL_3=risk_category[:, 2],
+        RISK_CAT_PROB_GENERAL_4=risk_category[:, 3],
+        RISK_CAT_PROB_GENERAL_5=risk_category[:, 4],
+        BIGGEST_RISK_FACTOR=biggest,
+        RISK_BY_CATEGORY=risk_by_selector,
+        PERCENTAGE_RISK_CAT=percentage_risk,
+        MOT_DAYS=days.astype(int),
+    )
+
+    return predictions, known
+
+
+def get_confidence_curve(predictor: RiskCDFModel, vector: Dict, confidences: Sequence[float],
+                         ai_day_prediction: float = None, days_in_hospital: int = 0) -> Dict:
+    """
+    Interrogate the RiskCDFModel model for a discharge-confidence curve, giving the predictions made by
+    `get_prediction` at each of a set of confidence levels for roughly the cost of a single level
+
+    :param predictor: Initialised RiskCDFModel instance
+    :param vector: Vectorised patient record
+    :param confidences: Confidence levels
+    :param ai_day_prediction: Length of stay days prediction from AI model
+    :param days_in_hospital: Number of days the patient has already stayed, to forecast from today rather than from
+    admission, as in `get_prediction`
+    :return: Dict of predicted results, with one list element per confidence level
+    """
+    days, days_by_selector = predictor.confidence_curve_from_record(vector, confidences,
+                                                                    days_in_hospital=days_in_hospital)
+    risks_by_selector = {selector: predictor.risks_from_days(selector_days)
+                         for selector, selector_days in days_by_selector.items()}
+    # Take the minimum of the per-factor risks at each level, as in `risk_and_cat_by_record`
+    if len(risks_by_selector) > 0:
+        risks = np.min(np.vstack(list(risks_by_selector.values())), axis=0)
+    else:
+        risks = predictor.risks_from_days(days)
+    if ai_day_prediction is not None:
+        # The AI model predicts from admission, so its prediction is at least the stay so far
+        ai_day_prediction = max(ai_day_prediction, days_in_hospital)
+        # Carry forward the higher of the risk scores from the AI model and the CDF model at each level
+        risks = np.maximum(risks, predictor.risk_from_day(ai_day_prediction))
+
+    curve = dict(
+        CONFIDENCE=[float(c) for c in confidences],
+        MOT_DAYS=[int(d) for d in days],
+        RISK_STRATIFICATION=[int(r) for r in risks],
+        MOT_DAYS_BY_CATEGORY={selector: [int(d) for d in selector_days]
+                              for selector, selector_days in days_by_selector.items()},
+    )
+
+    return curve
@@ -0,0 +1,238 @@
+"""Offline bulk scoring of patient record files
+
+Usage: `python -m ltss.score in.csv out.csv`
+
+Parquet and Arrow IPC inputs (e.g. `in.parquet`) are read as batches of columns, covering only the fields used by the
+vectoriser, and are vectorised a batch at a time without building per-row record dicts.
+"""
+import argparse
+import csv
+import logging
+import multiprocessing
+import sys
+import time
+from collections import deque
+from itertools import islice
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Any
+
+import numpy as np
+import torch
+
+from ltss import los_model, risk_model
+from ltss.utils import read_records_csv, is_columnar_file, read_columnar_batches, flatten_columns, flatten_vector
+from ltss.vectorise import vectorise_record, vectorise_columns, FIELD_MANIPULATIONS
+
+# Constants to initialise logging
+LOG = logging.getLogger('ltss.score')
+
+# Columns written to the output file for each scored record
+SCORE_FIELDS = [
+    'RECORD_ID',
+    'STATUS',
+    'PREDICTED_LOS',
+    'RISK_STRATIFICATION',
+    'RISK_CAT_PROB_GENERAL_1',
+    'RISK_CAT_PROB_GENERAL_2',
+    'RISK_CAT_PROB_GENERAL_3',
+    'RISK_CAT_PROB_GENERAL_4',
+    'RISK_CAT_PROB_GENERAL_5',
+    'PERCENTAGE_RISK_CAT',
+    'MOT_DAYS',
+]
+
+# Per-process model instances, set by `init_worker` so each worker process loads the models only once
+_LOS_MODEL: Optional[los_model.LoSPredictor] = None
+_RISK_MODEL: Optional[risk_model.RiskCDFModel] = None
+
+
+def init_worker(los_model_file: str, risk_model_file: str, threads: Optional[int] = None):
+    """
+    Load both predictive models into the current process
+
+    :param los_model_file: Path to LoS model state file
+    :param risk_model_file: Path to risk model saved state pickle file
+    :param threads: Optionally limit the number of torch threads used by this process
+    """
+    global _LOS_MODEL, _RISK_MODEL
+    if threads is not None:
+        torch.set_num_threads(threads)
+    _LOS_MODEL = los_model.init_model(model_file=los_model_file)
+    _RISK_MODEL = risk_model.init_model(model_file=risk_model_file)
+
+
+def chunk_records(records: Iterable[Dict[str, str]], chunk_size: int) -> Iterator[List[Tuple[int, Dict[str, str]]]]:
+    """
+    Group a stream of records into lists of (row index, record) tuples, holding only one chunk in memory at a time
+
+    :param records: Stream of record dicts
+    :param chunk_size: Maximum number of records per chunk
+    :return: Generator of record chunks
+    """
+    indexed = enumerate(records)
+    while True:
+        chunk = list(islice(indexed, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def chunk_columns(path: str, chunk_size: int) -> Iterator[Tuple[int, Dict[str, List[Any]]]]:
+    """
+    Read a Parquet or Arrow IPC file as batches of the columns used by the vectoriser
+
+    :param path: Path to the Parquet or Arrow IPC file to read
+    :param chunk_size: Maximum number of records per chunk
+    :return: Generator of (index of first row, dict of column value lists) tuples
+    """
+    offset = 0
+    for columns in read_columnar_batches(path, fields=FIELD_MANIPULATIONS.fields(), batch_size=chunk_size):
+        yield offset, columns
+        offset += len(next(iter(columns.values()))) if columns else 0
+
+
+def score_matrix(rows: List[Dict], matrix: np.ndarray):
+    """
+    Score a matrix of flattened major record vectors against both models, each in a single batch, updating the
+    corresponding output rows in place
+
+    :param rows: Output rows for each record in the matrix
+    :param matrix: N x len(MODEL_SELECTORS) array of flattened vectors
+    """
+    predicted_los = los_model.predict_matrix(_LOS_MODEL, matrix)
+    risk_predictions, known = risk_model.get_predictions(_RISK_MODEL, matrix, ai_day_predictions=predicted_los)
+    for i, row in enumerate(rows):
+        # Records with no factors known to the risk model cannot be stratified
+        if not known[i]:
+            LOG.error(f'No risk factors known to the risk model for record {row["RECORD_ID"]}')
+            row['STATUS'] = 'error'
+            continue
+        row.update({k: v[i].item() for k, v in risk_predictions.items() if k in SCORE_FIELDS})
+        row['PREDICTED_LOS'] = predicted_los[i].item()
+        row['STATUS'] = 'ok'
+
+
+def score_column_chunk(chunk: Tuple[int, Dict[str, List[Any]]]) -> List[Dict]:
+    """
+    Vectorise and score a chunk of records held as columns, running each model over the whole chunk in a single
+    batch
+
+    :param chunk: Tuple of index of the first row in the chunk, and dict of column value lists
+    :return: List of output rows keyed on `SCORE_FIELDS`
+    """
+    offset, columns = chunk
+    n = len(next(iter(columns.values()))) if columns else 0
+    vectorised = vectorise_columns(columns)
+    matrix = flatten_columns(vectorised, n)
+    # Non-major cases are out of scope for the models, as in the forecast endpoint
+    is_major = vectorised.get('IS_MAJOR', np.ones(n)) != 0
+    rows = [dict(RECORD_ID=offset + i, STATUS='non_major') for i in range(n)]
+    score_matrix([rows[i] for i in np.flatnonzero(is_major)], matrix[is_major])
+    return rows
+
+
+def score_chunk(chunk: List[Tuple[int, Dict[str, str]]]) -> List[Dict]:
+    """
+    Vectorise and score a chunk of records, running each model over the whole chunk in a single batch
+
+    :param chunk: List of (row index, record) tuples
+    :return: List of output rows keyed on `SCORE_FIELDS`
+    """
+    rows = []
+    to_predict = []
+    for index, record in chunk:
+        row = dict(RECORD_ID=index)
+        try:
+            vector = vectorise_record(record)
+        except Exception as e:
+            LOG.exception(e)
+            row['STATUS'] = 'error'
+            rows.append(row)
+            continue
+        # Non-major cases are out of scope for the models, as in the forecast endpoint
+        if vector.get('IS_MAJOR', 1) == 0:
+            row['STATUS'] = 'non_major'
+        else:
+            to_predict.append((row, flatten_vector(vector)))
+        rows.append(row)
+
+    if to_predict:
+        score_matrix([row for row, _ in to_predict], np.vstack([vector for _, vector in to_predict]))
+    return rows
+
+
+def run_scoring(input_path: str, output_path: str, chunk_size: int = 1000, workers: int = 1,
+                los_model_file: str = 'config/los_model.state',
+                risk_model_file: str = 'config/risk_model.pickle') -> Dict[str, float]:
+    """
+    Stream a records file through the vectoriser and both models, writing one row of predictions per record.
+
+    Records are read and scored a chunk at a time. With multiple workers, at most two chunks per worker are in flight
+    at once, so memory use is bounded by the chunk size rather than the size of the input file. Output rows are
+    written in input order.
+
+    :param input_path: Path to the CSV, Parquet or Arrow IPC file of records to score
+    :param output_path: Path to write the CSV file of predictions to
+    :param chunk_size: Number of records to vectorise and predict per batch
+    :param workers: Number of worker processes to score with
+    :param los_model_file: Path to LoS model state file
+    :param risk_model_file: Path to risk model saved state pickle file
+    :return: Dict of scoring statistics
+    """
+    if is_columnar_file(input_path):
+        chunks, score = chunk_columns(input_path, chunk_size), score_column_chunk
+    else:
+        chunks, score = chunk_records(read_records_csv(input_path), chunk_size), score_chunk
+    start = time.perf_counter()
+    n_records = 0
+    with open(output_path, 'w', newline='') as fp:
+        writer = csv.DictWriter(fp, fieldnames=SCORE_FIELDS)
+        writer.writeheader()
+        if workers <= 1:
+            init_worker(los_model_file, risk_model_file)
+            for chunk in chunks:
+                rows = score(chunk)
+                writer.writerows(rows)
+                n_records += len(rows)
+        else:
+            # Split the available cores between the workers rather than letting each use them all
+            threads = max(1, torch.get_num_threads() // workers)
+            with multiprocessing.Pool(workers, initializer=init_worker,
+                                      initargs=(los_model_file, risk_model_file, threads)) as pool:
+                pending = deque()
+                for chunk in chunks:
+                    pending.append(pool.apply_async(score, (chunk,)))
+                    # Bound the number of chunks in flight, writing results as the oldest chunk completes
+                    while len(pending) >= 2 * workers:
+                        rows = pending.popleft().get()
+                        writer.writerows(rows)
+                        n_records += len(rows)
+                while pending:
+                    rows = pending.popleft().get()
+                    writer.writerows(rows)
+                    n_records += len(rows)
+    elapsed = time.perf_counter() - start
+    return dict(records=n_records, seconds=elapsed, records_per_second=n_records / elapsed if elapsed > 0 else 0.0)
+
+
+def parse_args(override_args: Optional[List[str]] = None) -> argparse.Namespace:
+    """
+    Parse command-line arguments. By default, parses sys.argv - if supplied, uses `args` as an override
+    :param override_args: Optional override for command-line arguments
+    :return: An argparse.Namespace containing the parsed argument set
+    """
+    parser = argparse.ArgumentParser(description='Score a file of patient records against the LTSS models')
+    parser.add_argument('input', type=str, help='Input CSV, Parquet or Arrow IPC records file')
+    parser.add_argument('output', type=str, help='Output CSV predictions file')
+    parser.add_argument('--chunk-size', type=int, help='Number of records to score per batch', default=1000)
+    parser.add_argument('--workers', '-w', type=int, help='Number of worker processes', default=1)
+    parser.add_argument('--los-model', type=str, help='LoS model state file', default='config/los_model.state')
+    parser.add_argument('--risk-model', type=str, help='Risk model pickle file', default='config/risk_model.pickle')
+    return parser.parse_args(args=override_args)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    stats = run_scoring(args.input, args.output, chunk_size=args.chunk_size, workers=args.workers,
+                        los_model_file=args.los_model, risk_model_file=args.risk_model)
+    print(f'Scored {stats["records"]} records in {stats["seconds"]:.2f}s '
+          f'({stats["records_per_second"]:.1f} records/s)', file=sys.stderr)
@@ -0,0 +1,80 @@
+"""In-process cache of the vectorised records of spells in progress, updated field by field"""
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional
+
+from ltss.vectorise import IncrementalVector, Mapping
+
+# Constants to initialise logging
+LOG = logging.getLogger('ltss.spells')
+
+
+class SpellCache:
+    """
+    Vectorised records of spells in progress, keyed on spell ID. Records are vectorised in full when a spell is first
+    stored, and then only the changed fields are re-vectorised on each update. The least recently updated spells are
+    dropped once the cache is full.
+
+    :param max_spells: Maximum number of spells to hold
+    """
+
+    def __init__(self, max_spells: int):
+        self.max_spells = max_spells
+        self._lock = threading.Lock()
+        self._spells: 'OrderedDict[Hashable, IncrementalVector]' = OrderedDict()
+
+    def _store(self, key: Hashable, spell: IncrementalVector):
+        """Store a spell as the most recently updated, dropping the least recently updated if the cache is full"""
+        self._spells[key] = spell
+        self._spells.move_to_end(key)
+        while len(self._spells) > self.max_spells:
+            self._spells.popitem(last=False)
+
+    def put(self, key: Hashable, record: Dict[str, Any], mapping: Mapping) -> Dict[str, Any]:
+        """
+        Store the full record of a spell, replacing any previous record
+
+        :param key: Spell ID
+        :param record: Dict of record fields
+        :param mapping: Vectorisation mapping of the models scoring the spell
+        :return: Snapshot of the spell's vectorised record
+        """
+        spell = IncrementalVector(mapping)
+        spell.update(record)
+        with self._lock:
+            self._store(key, spell)
+            return dict(spell.vector)
+
+    def patch(self, key: Hashable, changes: Dict[str, Any], mapping: Mapping) -> Optional[Dict[str, Any]]:
+        """
+        Update fields of a stored spell's record, re-vectorising only the changed fields
+
+        :param key: Spell ID
+        :param changes: Dict of new field values
+        :param mapping: Vectorisation mapping of the models scoring the spell
+        :return: Snapshot of the spell's vectorised record, or None if the spell is not stored
+        """
+        with self._lock:
+            spell = self._spells.get(key)
+            if spell is None:
+                return None
+            if spell.mapping is not mapping:
+                # The models have changed since the spell was vectorised
+                spell = spell.remap(mapping)
+            spell.update(changes)
+            self._store(key, spell)
+            return dict(spell.vector)
+
+    def delete(self, key: Hashable) -> bool:
+        """
+        Drop a spell (e.g. on discharge)
+
+        :param key: Spell ID
+        :return: True if the spell was stored
+        """
+        with self._lock:
+            return self._spells.pop(key, None) is not None
+
+    def __len__(self) -> int:
+        return len(self._spells)
@@ -2,7 +2,7 @@
 import csv
 import logging
 import os
-from typing import Dict, Optional, List, Union, Iterable, Any
+from typing import Dict, Optional, List, Union, Iterable, Any, Iterator
 
 import numpy as np
 import json
@@ -38,6 +38,9 @@ MODEL_SELECTORS = read_data_descriptors('Model_Selectors')
 UI_FIELDS = read_data_descriptors('UI_Fields')
 # Data scale factor for vector preparation
 VECTOR_SCALE = 25
+# File extensions read as columnar Parquet/Arrow IPC files rather than CSV
+PARQUET_EXTENSIONS = ('.parquet', '.pq')
+ARROW_EXTENSIONS = ('.arrow', '.feather', '.ipc')
 
 
 def flatten_vector(vector: Dict[str, Any]) -> np.array:
@@ -59,10 +62,34 @@ def reshape_vector(vector: Dict) -> np.array:
     :param vector: Dict of vectorised field values keyed on field name
     :return: An 8x8 numpy array of the fields expected by the prediction model
     """
-    value_array = flatten_vector(vector)
-    # Pad to 64 elements
-    padded = np.zeros(64)
-    padded[:value_array.shape[0]] = value_array
+    return reshape_matrix(np.expand_dims(flatten_vector(vector), 0))
+
+
+def flatten_columns(columns: Dict[str, np.ndarray], n: int) -> np.array:
+    """
+    Flatten a dict of vectorised columns into a matrix using `MODEL_SELECTORS` to define the columns
+    :param columns: Dict of vectorised column arrays keyed on field name, as produced by `vectorise_columns`
+    :param n: Number of rows in the columns
+    :return: An N x len(MODEL_SELECTORS) numpy array of the fields used in the models
+    """
+    # Fill in -1 for missing fields, as in `flatten_vector`
+    matrix = np.full((n, len(MODEL_SELECTORS)), -1.0)
+    for i, key in enumerate(MODEL_SELECTORS):
+        if key in columns:
+            matrix[:, i] = columns[key]
+    return matrix
+
+
+def reshape_matrix(matrix: np.array) -> np.array:
+    """
+    Take a matrix of flattened vectors (one row per record) and format to match expected model input shape
+
+    :param matrix: N x len(MODEL_SELECTORS) numpy array, as produced by `flatten_vector` or `flatten_columns`
+    :return: An N x 1 x 8 x 8 numpy array of the fields expected by the prediction model
+    """
+    # Pad each row to 64 elements
+    padded = np.zeros((matrix.shape[0], 64))
+    padded[:, :matrix.shape[1]] = matrix
     # Reshape to 8x8
     reshaped = np.reshape(padded, (-1, 1, 8, 8))
     # Scale the data for convolution reasons
@@ -128,3 +155,97 @@ def read_records_csv(path: str) -> Iterable[Dict[str, str]]:
         for row in reader:
             # Standardise row key and value formats and set 'null' default for missing values
             yield {format_field_header(k): v.lower() if v is not None else 'null' for k, v in row.items()}
+
+
+def read_records(path: str) -> Iterable[Dict[str, str]]:
+    """
+    Parse a CSV, Parquet or Arrow IPC record file into a generator of well-formatted record dictionaries
+    :param path: Path to the file to parse, with the file type determined by its extension
+    :return: Generator of record dicts
+    """
+    if is_columnar_file(path):
+        return read_records_columnar(path)
+    return read_records_csv(path)
+
+
+def is_columnar_file(path: str) -> bool:
+    """Check whether the file at the given path should be read as a columnar Parquet/Arrow IPC file"""
+    return path.lower().endswith(PARQUET_EXTENSIONS + ARROW_EXTENSIONS)
+
+
+def _iter_record_batches(path: str, fields: Optional[Iterable[str]], batch_size: int) -> Iterator:
+    """
+    Iterate over the record batches of a Parquet or Arrow IPC file, reading only the columns whose formatted headers
+    are in `fields`. Parquet files are read a row group at a time; Arrow IPC files are memory mapped.
+    """
+    # pyarrow is only required for columnar input, so import it on first use
+    import pyarrow as pa
+    if path.lower().endswith(PARQUET_EXTENSIONS):
+        import pyarrow.parquet as pq
+        parquet_file = pq.ParquetFile(path)
+        columns = _select_columns(parquet_file.schema_arrow.names, fields)
+        yield from parquet_file.iter_batches(batch_size=batch_size, columns=columns)
+        return
+    import pyarrow.ipc as ipc
+    with pa.memory_map(path, 'r') as source:
+        try:
+            reader = ipc.open_file(source)
+            batches = (reader.get_batch(i) for i in range(reader.num_record_batches))
+        except pa.ArrowInvalid:
+            # Not in the random-access file format, so read as an IPC stream
+            source.seek(0)
+            reader = ipc.open_stream(source)
+            batches = iter(reader)
+        columns = _select_columns(reader.schema.names, fields)
+        for batch in batches:
+            batch = batch.select(columns) if columns is not None else batch
+            # Re-slice to the requested batch size, which is zero-copy for Arrow data
+            for offset in range(0, batch.num_rows, batch_size):
+                yield batch.slice(offset, batch_size)
+
+
+def _select_columns(names: List[str], fields: Optional[Iterable[str]]) -> Optional[List[str]]:
+    """Select the raw column names whose formatted headers are in `fields` (all columns if `fields` is None)"""
+    if fields is None:
+        return None
+    fields = set(fields)
+    return [name for name in names if format_field_header(name) in fields]
+
+
+def read_columnar_batches(path: str, fields: Optional[Iterable[str]] = None,
+                          batch_size: int = 65536) -> Iterator[Dict[str, List[Any]]]:
+    """
+    Read a Parquet or Arrow IPC record file in batches of columns, suitable for use in `vectorise_columns`.
+    Only the columns whose formatted headers are named in `fields` are read from the file. String values are
+    lowercased, as in `read_records_csv`, and missing values are returned as None.
+
+    :param path: Path to the Parquet or Arrow IPC file to read
+    :param fields: Formatted field names to read (all fields if None)
+    :param batch_size: Maximum number of rows per batch
+    :return: Generator of dicts of column value lists keyed on formatted field name
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    for batch in _iter_record_batches(path, fields, batch_size):
+        columns = {}
+        for name, column in zip(batch.schema.names, batch.columns):
+            if pa.types.is_string(column.type) or pa.types.is_large_string(column.type):
+                column = pc.utf8_lower(column)
+            columns[format_field_header(name)] = column.to_pylist()
+        yield columns
+
+
+def read_records_columnar(path: str) -> Iterable[Dict[str, str]]:
+    """
+    Parse a Parquet or Arrow IPC record file into a generator of record dictionaries, formatted as by
+    `read_records_csv` (lowercase string values with a 'null' default for missing values)
+    :param path: Path to the Parquet or Arrow IPC file to parse
+    :return: Generator of record dicts
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    for batch in _iter_record_batches(path, None, 65536):
+        headers = [format_field_header(name) for name in batch.schema.names]
+        columns = [pc.utf8_lower(column.cast(pa.string())).to_pylist() for column in batch.columns]
+        for row in zip(*columns):
+            yield {k: v if v is not None else 'null' for k, v in zip(headers, row)}
@@ -5,6 +5,8 @@ import os.path
 from enum import Enum
 from typing import Dict, Optional, Iterator, Tuple, Any, Union, Iterable, List
 
+import numpy as np
+
 from ltss.utils import format_field_header
 
 # Constants to initialise logging
@@ -59,6 +61,13 @@ class Mapping:
         mapped = self._map.get(key)
         return tuple(mapped, )[0] if mapped is not None else None
 
+    def fields(self) -> List[str]:
+        """Get the names of all fields with a vectorisation mapping
+
+        :return: List of field names
+        """
+        return list(self._map.keys())
+
     def get_mapping(self, key: str) -> Tuple[Optional[Union[Dict, List]], Optional[Dict]]:
         """
         Get vectorisation mapping object(s) for the named field.
@@ -120,67 +129,203 @@ def convert_value_type(value: Any) -> Optional[Union[str, int, float]]:
     return value
 
 
-def vectorise_record(record: Dict[str, Any]) -> Dict[str, Any]:
+def vectorise_record(record: Dict[str, Any], mapping: Optional[Mapping] = None) -> Dict[str, Any]:
     """
     Vectorise a patient record.
     Each field is processed to vector format based on a vector configuration specific to the field name and data type.
 
     :param record: Dictionary of record fields
+    :param mapping: Vectorisation mapping to use (defaults to the global FIELD_MANIPULATIONS mapping)
     :return: Vectorised record dict
     """
+    mapping = mapping if mapping is not None else FIELD_MANIPULATIONS
     vectorised_record = {}
     length_of_stay = None
-    # Parse each field from the patient record and apply the manipulation from the FIELD_MANIPULATIONS mapping
+    # Parse each field from the patient record and apply the manipulation from the vectorisation mapping
     for field, value in record.items():
         # Standardise field key format
         field = format_field_header(field)
         # Handle missing values and attempt to correctly type data values
         value = convert_value_type(value)
         # Lookup the type of manipulation required for the field/value
-        manipulation = FIELD_MANIPULATIONS.get_type(field)
+        manipulation = mapping.get_type(field)
         if manipulation is None:
             # No manipulation listed for the field, drop from vectorised record
             continue
-        if manipulation is Field.COPY:
-            # Copy field replacing null values and stripping leading/trailing whitespace
-            if value is None:
-                vectorised_record[field] = -1
-            elif isinstance(value, str):
-                stripped = str(value).strip()
-                vectorised_record[field] = convert_value_type(stripped)
-            else:
-                vectorised_record[field] = value
-        elif manipulation is Field.BINARY:
-            # Convert binary flag to 0/1 value
-            vectorised_record[field] = _binarise_value(value)
-        elif manipulation is Field.AGE_CATEGORISE:
-            # Copy age field as is
-            vectorised_record[field] = value
-            # Create additional age category field for age/10 value
-            vectorised_record[f'{field}_CATEGORY'] = _categorise_age(value)
-        elif manipulation is Field.CATEGORISE:
-            # Convert category to scalar value based on mapping
-            vectorised_record[field] = _categorise_value(value, field)
-        elif manipulation is Field.LENGTH_OF_STAY:
+        if manipulation is Field.LENGTH_OF_STAY:
             # Special case for length of stay - store value to append at the end
             length_of_stay = value
-        elif manipulation is Field.CODE_LIST:
-            # Generate expanded code list
-            field_code_dict = _expand_code_field(value, field)
-            vectorised_record.update(field_code_dict)
-        elif manipulation is Field.TOP_FREQUENCY_COUNT:
-            # Generate expanded code list
-            field_code_dict = _expand_code_field(value, field)
-            vectorised_record.update(field_code_dict)
-            # Generate the binned top N code counts
-            top_n_dict = _generate_top_n_counts(value, field)
-            vectorised_record.update(top_n_dict)
+        else:
+            vectorised_record.update(vectorise_field(field, value, manipulation, mapping))
 
     # Append original length of stay to the end of the vectorised record
     vectorised_record['LENGTH_OF_STAY'] = length_of_stay if length_of_stay is not None else -1
     return vectorised_record
 
 
+def vectorise_field(field: str, value: Any, manipulation: Field, mapping: Optional[Mapping] = None) -> Dict[str, Any]:
+    """
+    Vectorise a single record field, which may expand to several vector elements (e.g. code lists)
+
+    :param field: Standardised field name
+    :param value: Typed field value, as returned by `convert_value_type`
+    :param manipulation: Vectorisation type for the field (other than `Field.LENGTH_OF_STAY`)
+    :param mapping: Vectorisation mapping to use (defaults to the global FIELD_MANIPULATIONS mapping)
+    :return: Dict of vector elements derived from the field
+    """
+    mapping = mapping if mapping is not None else FIELD_MANIPULATIONS
+    vectorised_field = {}
+    if manipulation is Field.COPY:
+        # Copy field replacing null values and stripping leading/trailing whitespace
+        if value is None:
+            vectorised_field[field] = -1
+        elif isinstance(value, str):
+            stripped = str(value).strip()
+            vectorised_field[field] = convert_value_type(stripped)
+        else:
+            vectorised_field[field] = value
+    elif manipulation is Field.BINARY:
+        # Convert binary flag to 0/1 value
+        vectorised_field[field] = _binarise_value(value)
+    elif manipulation is Field.AGE_CATEGORISE:
+        # Copy age field as is
+        vectorised_field[field] = value
+        # Create additional age category field for age/10 value
+        vectorised_field[f'{field}_CATEGORY'] = _categorise_age(value)
+    elif manipulation is Field.CATEGORISE:
+        # Convert category to scalar value based on mapping
+        vectorised_field[field] = _categorise_value(value, field, mapping)
+    elif manipulation is Field.CODE_LIST:
+        # Generate expanded code list
+        field_code_dict = _expand_code_field(value, field, mapping)
+        vectorised_field.update(field_code_dict)
+    elif manipulation is Field.TOP_FREQUENCY_COUNT:
+        # Generate expanded code list
+        field_code_dict = _expand_code_field(value, field, mapping)
+        vectorised_field.update(field_code_dict)
+        # Generate the binned top N code counts
+        top_n_dict = _generate_top_n_counts(value, field, mapping)
+        vectorised_field.update(top_n_dict)
+    return vectorised_field
+
+
+class IncrementalVector:
+    """
+    A vectorised record kept up to date field by field, for records that change during a spell (e.g. new diagnosis
+    codes or a ward move). Only the vector elements derived from a changed field (including the `_CODE_` and `N_TOP_`
+    elements of code fields) are recomputed, so an update costs O(changed fields) rather than O(record). The vector is
+    the same as `vectorise_record` would produce for the updated record.
+
+    :param mapping: Vectorisation mapping to use (defaults to the global FIELD_MANIPULATIONS mapping)
+    """
+
+    def __init__(self, mapping: Optional[Mapping] = None):
+        self.mapping = mapping if mapping is not None else FIELD_MANIPULATIONS
+        self.record: Dict[str, Any] = {}
+        self.vector: Dict[str, Any] = {'LENGTH_OF_STAY': -1}
+        # Vector elements produced by each field's current value
+        self._elements: Dict[str, List[str]] = {}
+
+    def update(self, changes: Dict[str, Any]) -> int:
+        """
+        Update fields of the record, re-vectorising only the fields whose values have changed
+
+        :param changes: Dict of new field values
+        :return: Number of fields whose values changed
+        """
+        changed = 0
+        for field, value in changes.items():
+            # Standardise field key format
+            field = format_field_header(field)
+            if field in self.record and self.record[field] == value:
+                continue
+            self.record[field] = value
+            changed += 1
+            manipulation = self.mapping.get_type(field)
+            if manipulation is None:
+                # No manipulation listed for the field, so it is not in the vector
+                continue
+            value = convert_value_type(value)
+            if manipulation is Field.LENGTH_OF_STAY:
+                self.vector['LENGTH_OF_STAY'] = value if value is not None else -1
+                continue
+            elements = vectorise_field(field, value, manipulation, self.mapping)
+            # Drop elements of the previous value that the new value does not produce (e.g. codes outside the mapped
+            # code list)
+            for key in self._elements.get(field, []):
+                if key not in elements:
+                    self.vector.pop(key, None)
+            self.vector.update(elements)
+            self._elements[field] = list(elements)
+        return changed
+
+    def copy(self) -> 'IncrementalVector':
+        """
+        Copy the vectorised record, so variants of it can be updated without re-vectorising the unchanged fields
+
+        :return: Independent copy of the IncrementalVector
+        """
+        copied = IncrementalVector(self.mapping)
+        copied.record = dict(self.record)
+        copied.vector = dict(self.vector)
+        # Element lists are replaced rather than modified on update, so can be shared
+        copied._elements = dict(self._elements)
+        return copied
+
+    def remap(self, mapping: Mapping) -> 'IncrementalVector':
+        """
+        Re-vectorise the whole record with a different mapping (e.g. after the models are reloaded)
+
+        :param mapping: Vectorisation mapping to use
+        :return: New IncrementalVector for the record
+        """
+        remapped = IncrementalVector(mapping)
+        remapped.update(self.record)
+        return remapped
+
+
+def vectorise_columns(columns: Dict[str, List[Any]], mapping: Optional[Mapping] = None) -> Dict[str, np.ndarray]:
+    """
+    Vectorise a batch of patient records held as columns, as read by `read_columnar_batches`.
+    Each distinct value in a column is vectorised only once and the result broadcast back to every row holding it,
+    so categorical columns cost O(distinct values) rather than O(rows).
+
+    :param columns: Dict of column value lists keyed on field name
+    :param mapping: Vectorisation mapping to use (defaults to the global FIELD_MANIPULATIONS mapping)
+    :return: Dict of vectorised column arrays keyed on vector element name
+    """
+    mapping = mapping if mapping is not None else FIELD_MANIPULATIONS
+    n = len(next(iter(columns.values()))) if columns else 0
+    vectorised_columns = {}
+    length_of_stay = None
+    for field, values in columns.items():
+        # Standardise field key format
+        field = format_field_header(field)
+        # Lookup the type of manipulation required for the field
+        manipulation = mapping.get_type(field)
+        if manipulation is None:
+            # No manipulation listed for the field, drop from vectorised columns
+            continue
+        # Factorise the column into the index of each row's value in a list of distinct values
+        distinct = {}
+        inverse = np.fromiter((distinct.setdefault(value, len(distinct)) for value in values), dtype=np.intp, count=n)
+        distinct_values = [convert_value_type(value) for value in distinct]
+        if manipulation is Field.LENGTH_OF_STAY:
+            length_of_stay = np.array([-1 if v is None else v for v in distinct_values], dtype=float)[inverse]
+            continue
+        distinct_vectors = [vectorise_field(field, value, manipulation, mapping) for value in distinct_values]
+        # Codes outside the mapped code list only appear in some rows' vectors, so take the union of keys and fill in
+        # -1 for rows without them, as `flatten_vector` does for missing values
+        keys = dict.fromkeys(key for vector in distinct_vectors for key in vector)
+        for key in keys:
+            lookup = np.array([vector.get(key, -1) for vector in distinct_vectors], dtype=float)
+            vectorised_columns[key] = lookup[inverse]
+
+    # Append original length of stay to the end of the vectorised columns
+    vectorised_columns['LENGTH_OF_STAY'] = length_of_stay if length_of_stay is not None else np.full(n, -1.0)
+    return vectorised_columns
+
+
 def _binarise_value(value: Optional[str]) -> int:
     """Convert character encodings to a binary integer value"""
     if value is None or value.upper() != 'Y':
@@ -189,10 +334,10 @@ def _binarise_value(value: Optional[str]) -> int:
         return 1
 
 
-def _categorise_value(value: str, field: str) -> Optional[int]:
+def _categorise_value(value: str, field: str, field_mapping: Mapping) -> Optional[int]:
     """Convert a text string category to a scalar category number based on known mapping"""
     try:
-        mapping, _ = FIELD_MANIPULATIONS.get_mapping(field)
+        mapping, _ = field_mapping.get_mapping(field)
     except:
         LOG.error(f'Error getting mapping for field: {field}')
         return
@@ -211,7 +356,7 @@ def _categorise_age(value):
     return int(age / 10)
 
 
-def _expand_code_field(value: str, field: str) -> Optional[Dict]:
+def _expand_code_field(value: str, field: str, field_mapping: Mapping) -> Optional[Dict]:
     """
     Expand field containing single string of codes to a dict keyed on field name + code concatenation.
     The expanded code dict will contain an element for all possible codes in the field and an associated binary flag
@@ -231,7 +376,7 @@ def _expand_code_field(value: str, field: str) -> Optional[Dict]:
     """
     try:
         # Retrieve the full list of potential codes found in the record field
-        code_list, _ = FIELD_MANIPULATIONS.get_mapping(field)
+        code_list, _ = field_mapping.get_mapping(field)
     except:
         LOG.error(f'Error getting mapping for field: {field}')
         return
@@ -260,7 +405,7 @@ def _expand_code_field(value: str, field: str) -> Optional[Dict]:
     return expanded_dict
 
 
-def _generate_top_n_counts(value: str, field: str) -> Optional[Dict]:
+def _generate_top_n_counts(value: str, field: str, field_mapping: Mapping) -> Optional[Dict]:
     """
     Expand field containing single string of codes to a dict of the number of these codes that belong to the
     top X -> X+10 of all possible code values in the dataset.
@@ -278,7 +423,7 @@ def _generate_top_n_counts(value: str, field: str) -> Optional[Dict]:
     """
     try:
         # Retrieve mappings for the codes in each top X -> X+10 range
-        _, top_n_mapping = FIELD_MANIPULATIONS.get_mapping(field)
+        _, top_n_mapping = field_mapping.get_mapping(field)
     except:
         LOG.error(f'Error getting mapping for field: {field}')
         return
@@ -0,0 +1,127 @@
+"""What-if forecasts: the effect of variations of a record's fields on its forecast, with the LoS model scoring every
+variation in a single batch"""
+import logging
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from ltss import los_model, risk_model
+from ltss.registry import ModelBundle
+from ltss.utils import flatten_vector, format_field_header
+from ltss.vectorise import Field, IncrementalVector, convert_value_type
+
+# Constants to initialise logging
+LOG = logging.getLogger('ltss.whatif')
+
+
+def category_options(base: IncrementalVector, field: str) -> List[Dict[str, Any]]:
+    """
+    Vary a categorised field through every category in the vectorisation mapping
+
+    :param base: Vectorised base record
+    :param field: Name of a field vectorised by `Field.CATEGORISE`
+    :return: List of variations, one per category other than the base record's
+    :raises ValueError: If the field is not categorised
+    """
+    field = format_field_header(field)
+    if base.mapping.get_type(field) is not Field.CATEGORISE:
+        raise ValueError(f'{field} is not a categorised field')
+    categories, _ = base.mapping.get_mapping(field)
+    current = convert_value_type(base.record.get(field))
+    return [{field: category} for category in categories if category != 'null' and category != current]
+
+
+def toggle_flag(base: IncrementalVector, field: str) -> Dict[str, Any]:
+    """
+    Toggle a flag field, such as a comorbidity (0/1) or a Y/N flag
+
+    :param base: Vectorised base record
+    :param field: Name of a flag field
+    :return: Variation with the flag toggled
+    :raises ValueError: If the field is not a flag
+    """
+    field = format_field_header(field)
+    manipulation = base.mapping.get_type(field)
+    value = convert_value_type(base.record.get(field))
+    if manipulation is Field.BINARY:
+        return {field: 'N' if value == 'y' else 'Y'}
+    if manipulation is Field.COPY and value in (None, 0, 1):
+        return {field: '0' if value == 1 else '1'}
+    raise ValueError(f'{field} is not a flag field')
+
+
+def expand_variations(base: IncrementalVector, variations: Optional[List[Dict[str, Any]]] = None,
+                      options: Optional[List[str]] = None, toggle: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+    """
+    Build the list of variations to score
+
+    :param base: Vectorised base record
+    :param variations: Explicit variations, each a dict of changed field values
+    :param options: Categorised fields to vary through every category
+    :param toggle: Flag fields to toggle, one at a time
+    :return: List of variations, each a dict of changed field values
+    :raises ValueError: If a variation is not a dict, or a field cannot be varied as requested
+    """
+    expanded = []
+    for variation in variations or []:
+        if not isinstance(variation, dict):
+            raise ValueError('Each variation must be an object of field values')
+        expanded.append(variation)
+    for field in options or []:
+        expanded.extend(category_options(base, field))
+    for field in toggle or []:
+        expanded.append(toggle_flag(base, field))
+    return expanded
+
+
+def score_variants(models: ModelBundle, base: IncrementalVector, variations: List[Dict[str, Any]],
+                   skip_los: bool = False, confidences: Sequence[float] = (),
+                   days_in_hospital: int = 0) -> Tuple[Dict, List[Dict]]:
+    """
+    Score a base record and variations of it, giving the same results as the forecast endpoint for each. Each variant
+    re-vectorises only its changed fields, reusing the base record's vectorisation, and the LoS model scores all the
+    variants in a single batched pass.
+
+    :param models: Models to score with
+    :param base: Vectorised base record
+    :param variations: List of variations, each a dict of changed field values
+    :param skip_los: Skip the LoS model, scoring with the risk model alone
+    :param confidences: Confidence levels for a discharge-confidence curve of each forecast
+    :param days_in_hospital: Number of days the patient has already stayed
+    :return: Forecast of the base record, and list of forecasts of each variation
+    """
+    vectors = [base.vector]
+    for changes in variations:
+        variant = base.copy()
+        variant.update(changes)
+        vectors.append(variant.vector)
+    forecasts = [dict(forecast=False, msg='Proof of concept system does not issue predictions for non-major cases')
+                 for _ in vectors]
+    # Non-major cases are out of scope for the models, as in the forecast endpoint
+    major = [i for i, vector in enumerate(vectors) if vector.get('IS_MAJOR', 1) != 0]
+    if major:
+        matrix = np.vstack([flatten_vector(vectors[i]) for i in major])
+        predicted_los = los_model.predict_matrix(models.los_model, matrix) if not skip_los else None
+        risk = models.risk_model
+        for row, i in enumerate(major):
+            vector = vectors[i]
+            if not any(vector.get(selector) in risk.distributions.get(selector, {}) for selector in risk.selectors):
+                forecasts[i] = dict(forecast=False, msg='No fields of the record are known to the risk model')
+                continue
+            results = {'PREDICTED_LOS': predicted_los[row].item()} if predicted_los is not None else {}
+            # Score the risk model record by record, as the forecast endpoint does, for the full set of its results
+            try:
+                results.update(risk_model.get_prediction(risk, vector, ai_day_prediction=results.get('PREDICTED_LOS'),
+                                                         days_in_hospital=days_in_hospital))
+                if confidences:
+                    results['CONFIDENCE_CURVE'] = risk_model.get_confidence_curve(
+                        risk, vector, confidences, ai_day_prediction=results.get('PREDICTED_LOS'),
+                        days_in_hospital=days_in_hospital)
+            except Exception as e:
+                LOG.exception(e)
+                forecasts[i] = dict(forecast=False, msg='Error predicting against risk model')
+                continue
+            forecasts[i] = dict(forecast=True, results=results)
+    for changes, forecast in zip(variations, forecasts[1:]):
+        forecast['changes'] = changes
+    return forecasts[0], forecasts[1:]
@@ -0,0 +1,167 @@
+"""Content-negotiated wire formats for forecast requests and responses
+
+Forecast requests may be posted as JSON (the default) or msgpack, and responses are returned in the best format the
+client accepts:
+ - `application/json`: the full, named forecast object (the default)
+ - `application/vnd.ltss.compact+json`: a compact forecast, with values as positional arrays, in unindented JSON
+ - `application/msgpack`: the compact forecast, encoded with msgpack
+
+msgpack support requires the optional `msgpack` package (`pip install msgpack`).
+"""
+import json
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from flask import Request, Response, jsonify
+
+from ltss.utils import MODEL_SELECTORS
+
+# Media types for each wire format
+JSON_TYPE = 'application/json'
+COMPACT_JSON_TYPE = 'application/vnd.ltss.compact+json'
+MSGPACK_TYPES = ('application/msgpack', 'application/x-msgpack')
+
+# Positional order of the values in compact forecast results
+FORECAST_FIELDS = [
+    'PREDICTED_LOS',
+    'RISK_STRATIFICATION',
+    'RISK_CAT_PROB_GENERAL_1',
+    'RISK_CAT_PROB_GENERAL_2',
+    'RISK_CAT_PROB_GENERAL_3',
+    'RISK_CAT_PROB_GENERAL_4',
+    'RISK_CAT_PROB_GENERAL_5',
+    'PERCENTAGE_RISK_CAT',
+    'MOT_DAYS',
+    'BIGGEST_RISK_FACTOR',
+    'PREDICTED_LOS_STD',
+]
+
+
+class UnsupportedMediaType(Exception):
+    """Raised when a request or response format cannot be handled"""
+
+
+def _msgpack():
+    """Import msgpack on first use, as it is an optional dependency"""
+    try:
+        import msgpack
+    except ImportError:
+        raise UnsupportedMediaType('msgpack is not installed on the server')
+    return msgpack
+
+
+def _plain(value: Any) -> Any:
+    """Convert NumPy scalars and arrays to plain Python values for serialisation"""
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    raise TypeError(f'Object of type {type(value).__name__} is not serialisable')
+
+
+def decode_request(req: Request) -> Any:
+    """
+    Decode the body of a request according to its content type
+
+    :param req: Flask request
+    :return: Decoded body, or None if the body is empty or not of a supported type
+    """
+    if req.mimetype in MSGPACK_TYPES:
+        body = req.get_data()
+        return _msgpack().unpackb(body, raw=False) if body else None
+    return req.get_json(silent=True)
+
+
+def flatten_record(payload: Any) -> Dict:
+    """
+    Flatten a posted record to a single dict of field values
+
+    :param payload: Flat dict of record fields, or list of dicts of record field groups (as returned by the
+    `/api/record/:id` endpoint)
+    :return: Dict of record fields
+    """
+    if isinstance(payload, list):
+        return {k: v for d in payload for k, v in d.items()}
+    return payload
+
+
+def vector_from_payload(payload: Any) -> Dict:
+    """
+    Build a vector from a pre-vectorised payload, skipping vectorisation of the raw record fields
+
+    :param payload: Positional list of vectorised values in `MODEL_SELECTORS` order, or dict of vectorised values
+    keyed on field name
+    :return: Vectorised patient record
+    """
+    if isinstance(payload, list):
+        if len(payload) != len(MODEL_SELECTORS):
+            raise ValueError(f'Expected {len(MODEL_SELECTORS)} vector values, got {len(payload)}')
+        payload = dict(zip(MODEL_SELECTORS, payload))
+    if not isinstance(payload, dict):
+        raise ValueError('Vector must be a list or object of values')
+    vector = {}
+    for key, value in payload.items():
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise ValueError(f'Vector value for {key} must be a number')
+        vector[key] = value
+    return vector
+
+
+def response_type(req: Request) -> str:
+    """
+    Choose the response media type from the request's Accept header, preferring the full JSON format. msgpack is only
+    offered if it is installed.
+
+    :param req: Flask request
+    :return: Media type to respond with
+    """
+    offered = [JSON_TYPE, COMPACT_JSON_TYPE]
+    try:
+        _msgpack()
+        offered.extend(MSGPACK_TYPES)
+    except UnsupportedMediaType:
+        pass
+    return req.accept_mimetypes.best_match(offered, default=JSON_TYPE)
+
+
+def compact_forecast(response: Dict) -> Dict:
+    """
+    Convert a forecast response to the compact layout, replacing the named results with positional arrays
+
+    :param response: Forecast response object
+    :return: Compact forecast response object
+    """
+    results: Optional[Dict] = response.get('results')
+    if results is None:
+        return response
+    compact = dict(response)
+    compact['results'] = [results.get(field) for field in FORECAST_FIELDS]
+    # Per-selector risk scores in `MODEL_SELECTORS` order, with None for selectors not known to the risk model
+    risk_by_category = results.get('RISK_BY_CATEGORY', {})
+    compact['risk_by_category'] = [risk_by_category.get(selector) for selector in MODEL_SELECTORS]
+    if 'CONFIDENCE_CURVE' in results:
+        compact['confidence_curve'] = results['CONFIDENCE_CURVE']
+    return compact
+
+
+def encode_response(response: Dict, media_type: str) -> Response:
+    """
+    Encode a forecast response in the given media type
+
+    :param response: Forecast response object
+    :param media_type: Media type chosen by `response_type`
+    :return: Flask response
+    """
+    if media_type == JSON_TYPE:
+        return jsonify(response)
+    compact = compact_forecast(response)
+    if media_type in MSGPACK_TYPES:
+        body = _msgpack().packb(compact, default=_plain, use_bin_type=True)
+    else:
+        body = json.dumps(compact, separators=(',', ':'), default=_plain)
+    return Response(body, mimetype=media_type)
+
+
+def wire_fields() -> Dict[str, List[str]]:
+    """Positional field orders used by the compact formats, for clients to bind against"""
+    return dict(vector=MODEL_SELECTORS, results=FORECAST_FIELDS, risk_by_category=MODEL_SELECTORS)
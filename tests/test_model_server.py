@@ -0,0 +1,122 @@
+import os
+import sys
+import tempfile
+import threading
+import unittest
+
+import numpy as np
+import torch
+
+# Adjust sys.path to allow access to ltss module in parent directory
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ltss import los_model, model_server, registry, risk_model  # noqa: E402
+from ltss.utils import MODEL_SELECTORS  # noqa: E402
+from ltss.vectorise import CONFIG_DIR, Mapping  # noqa: E402
+
+
+def make_models(seed: int = 0) -> registry.ModelBundle:
+    """
+    Build a small bundle of untrained models, so the test does not depend on trained model artifacts
+    :param seed: Seed for the model weights and risk distributions
+    :return: ModelBundle of a randomly initialised LoSPredictor and a risk model with random CDFs
+    """
+    torch.manual_seed(seed)
+    rng = np.random.default_rng(seed)
+    predictor = los_model.LoSPredictor(1, features_d=64)
+    predictor.eval()
+
+    def random_cdf():
+        cdf = np.cumsum(rng.random(30))
+        return cdf / cdf[-1]
+    risk = risk_model.RiskCDFModel()
+    risk.distributions = {selector: {category: random_cdf() for category in range(3)} for selector in risk.selectors}
+    risk.base_distribution = random_cdf()
+    risk.cumulative = True
+    risk.build_conditional_tables()
+    return registry.ModelBundle(predictor, risk, Mapping(os.path.join(CONFIG_DIR, 'model_vector_mappings.json')),
+                                'test')
+
+
+class ModelServerTest(unittest.TestCase):
+    """Round trip forecasts through a model server over a temporary socket, against scoring in-process"""
+
+    def setUp(self):
+        self.models = make_models()
+        self.directory = tempfile.TemporaryDirectory()
+        self.server = model_server.ModelServer(os.path.join(self.directory.name, 'models.sock'), lambda: self.models)
+        self.server.start()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.client = model_server.ModelClient(self.server.socket_path)
+        self.local = model_server.LocalScorer(lambda: self.models)
+
+    def tearDown(self):
+        self.server.close()
+        self.directory.cleanup()
+
+    def test_score_matches_local(self):
+        rng = np.random.default_rng(1)
+        # Categories known to the risk model, and some unknown (-1)
+        matrix = rng.integers(-1, 3, size=(32, len(MODEL_SELECTORS))).astype(np.float64)
+        days = rng.integers(0, 40, size=32).astype(np.float64)
+        version, ensemble, results = self.client.score(matrix, days)
+        local_version, local_ensemble, local_results = self.local.score(matrix, days)
+        self.assertEqual(version, local_version)
+        self.assertEqual(ensemble, local_ensemble)
+        np.testing.assert_allclose(results, local_results, rtol=1e-6, equal_nan=True)
+
+    def test_batch_matches_forecast_endpoint(self):
+        rng = np.random.default_rng(2)
+        matrix = rng.integers(-1, 3, size=(32, len(MODEL_SELECTORS))).astype(np.float64)
+        days = rng.integers(0, 40, size=32).astype(np.float64)
+        _, ensemble, results = self.local.score(matrix, days)
+        for row, vector_row, days_in_hospital in zip(results, matrix, days):
+            # Score one record as the forecast endpoint does
+            vector = dict(zip(MODEL_SELECTORS, vector_row))
+            forecast = los_model.get_prediction(self.models.los_model, vector)
+            forecast.update(risk_model.get_prediction(self.models.risk_model, vector,
+                                                      ai_day_prediction=forecast['PREDICTED_LOS'],
+                                                      days_in_hospital=int(days_in_hospital)))
+            batched = model_server.forecast_from_row(row, ensemble)
+            self.assertEqual(batched.keys(), forecast.keys())
+            for key, value in forecast.items():
+                if isinstance(value, float):
+                    self.assertAlmostEqual(batched[key], value, places=5)
+                else:
+                    self.assertEqual(batched[key], value)
+
+    def test_failed_batch_releases_waiters(self):
+        def fail():
+            raise RuntimeError('models unavailable')
+        self.server._models = fail
+        with self.assertRaises(model_server.ScoringError):
+            self.client.forecast({selector: 0 for selector in MODEL_SELECTORS})
+        # The batching thread survives, and serves the next batch
+        self.server._models = lambda: self.models
+        self.assertEqual(self.client.forecast({selector: 0 for selector in MODEL_SELECTORS})[0], 'test')
+
+    def test_forecast_matches_local(self):
+        vector = {selector: i % 3 for i, selector in enumerate(MODEL_SELECTORS)}
+        for days in (0, 5, 40):
+            version, forecast = self.client.forecast(vector, days)
+            local_version, local_forecast = self.local.forecast(vector, days)
+            self.assertEqual(version, local_version)
+            self.assertEqual(forecast.keys(), local_forecast.keys())
+            for key, value in local_forecast.items():
+                if isinstance(value, float):
+                    self.assertAlmostEqual(forecast[key], value, places=5)
+                else:
+                    self.assertEqual(forecast[key], value)
+
+    def test_unavailable_server(self):
+        self.server.close()
+        client = model_server.ModelClient(self.server.socket_path, timeout=0.5)
+        with self.assertRaises(model_server.ServerUnavailable):
+            client.forecast({selector: 0 for selector in MODEL_SELECTORS})
+
+    def test_scorer_is_abstract(self):
+        with self.assertRaises(TypeError):
+            model_server.Scorer()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,241 @@
+import argparse
+import os.path
+import time
+from typing import Optional, List, Dict, Tuple
+from tqdm import tqdm
+from datetime import datetime
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.optim as optim
+from torch.utils.tensorboard import SummaryWriter
+from loader import DataHandler
+from quantise_los import evaluate_predictions
+# Adjust sys.path to allow access to ltss module in parent directory
+import sys
+sys.path.append('..')
+from ltss.los_model import LoSPredictor, StudentLoSPredictor, init_model, save_student_model
+from ltss import resources
+
+
+def measure_latency(model: nn.Module, data: torch.Tensor, batch_size: int, repeats: int = 50) -> float:
+    """
+    Measure the median time for a CPU forward pass over a batch of records, as in serving
+    :param model: Model to time, on the CPU and in eval mode
+    :param data: Records to take the batch from
+    :param batch_size: Number of records per forward pass
+    :param repeats: Number of forward passes to time
+    :return: Median latency in milliseconds
+    """
+    batch = data[:batch_size]
+    latencies = []
+    with torch.no_grad():
+        # Warm up, so one-off costs are not measured
+        for _ in range(5):
+            model(batch)
+        for _ in range(repeats):
+            start = time.perf_counter()
+            model(batch)
+            latencies.append(time.perf_counter() - start)
+    return float(np.median(latencies) * 1000)
+
+
+def run_distillation(loader: DataHandler, use_device: torch.device, teacher_file: str, save_path: str,
+                     arch: str = 'mlp', width: int = 64, layers: int = 2, number_epochs: int = 100,
+                     batches_per_epoch: int = 100, batch_size: int = 512, learning_rate: float = 1e-3,
+                     alpha: float = 0.0, validation_size: int = 10000, latency_batch_size: int = 256,
+                     threads: Optional[int] = None,
+                     sync_timing: bool = False) -> Tuple[StudentLoSPredictor, Dict[str, float]]:
+    """
+    Train a compact student model to reproduce the predictions of a trained LoSPredictor (the teacher), and compare
+    the accuracy and CPU latency of the two models on the validation split
+    :param loader: The DataHandler to use to load train and test data splits
+    :param use_device: The torch device to use (specifying GPU/CPU)
+    :param teacher_file: Path to the trained LoSPredictor model state
+    :param save_path: Path to save the student model state and its metrics to
+    :param arch: Student architecture, 'mlp' or 'cnn'
+    :param width: Number of units (MLP) or first layer filters (CNN) of the student
+    :param layers: Number of hidden layers of an MLP student
+    :param number_epochs: The number of training epochs to run
+    :param batches_per_epoch: The number of batch iterations to use per training epoch
+    :param batch_size: The number of training samples to use per batch
+    :param learning_rate: The learning rate used in the optimiser
+    :param alpha: Weight of the loss against the ground-truth lengths of stay, with the loss against the teacher's
+    predictions weighted 1 - alpha
+    :param validation_size: The number of validation samples to use
+    :param latency_batch_size: Number of records per forward pass when timing batched scoring
+    :param threads: If non-none, the number of threads torch, OpenMP and BLAS use for CPU operations
+    :param sync_timing: On a GPU, wait for the queued GPU work at the start and end of each timed phase, so phase times
+    are accurate at some cost in throughput (otherwise GPU phase times are approximate)
+    :return: The trained student model, and a dict of its validation and latency metrics
+    """
+    if threads is not None:
+        resources.configure(threads=threads)
+    # Time each phase of the run with the loader's timer, which has already timed loading the data
+    timer = loader.timer
+    if sync_timing and use_device.type == 'cuda':
+        # Wait for queued GPU work, so it is counted in the phase that queued it
+        timer.synchronize = torch.cuda.synchronize
+    # Get the time at the start of the run, and start a logging session using Tensorboard
+    now = datetime.now()
+    run_dir = os.path.abspath(f'runs/distil_{now.strftime("%d_%m_%Y_%H_%M_%S")}')
+    print(f'Saving tensorboard output to {run_dir}')
+    writer = SummaryWriter(run_dir)
+    teacher = init_model(model_file=teacher_file)
+    if not isinstance(teacher, LoSPredictor):
+        raise ValueError(f'{teacher_file} is not a LoSPredictor checkpoint, and cannot be used as a teacher')
+    teacher = teacher.to(device=use_device)
+    student = StudentLoSPredictor(arch, width=width, layers=layers).to(device=use_device)
+    # Standardise the student's inputs with the statistics of the training split
+    normalisation_data, _ = loader.get_training_n(validation_size)
+    student.set_normalisation(normalisation_data)
+    opt_student = optim.Adam(student.parameters(), lr=learning_rate)
+    criterion = nn.MSELoss().to(device=use_device)
+    student.train()
+    # Get a subset of validation data and move to GPU once, with the teacher's predictions for it
+    validation_data, validation_los = loader.get_validation(validation_size)
+    with torch.no_grad():
+        teacher_validation = teacher(validation_data).reshape(-1)
+    teacher_stats = evaluate_predictions(teacher_validation, validation_los)
+    student_stats = dict(mse=float('nan'), mean_error=float('nan'), loa=float('nan'))
+    agreement_stats = dict(student_stats)
+
+    with tqdm(range(number_epochs)) as progress:
+        for epoch in progress:
+            running_loss = 0.0
+            for _ in np.arange(0, batches_per_epoch):
+                # Get sample data (timed by the loader)
+                sample, los_pdf = loader.get_training_n(batch_size)
+                with timer.phase('teacher', items=len(los_pdf)):
+                    # The teacher's predictions are the student's soft targets
+                    with torch.no_grad():
+                        target = teacher(sample).reshape(-1)
+                with timer.phase('forward', items=len(los_pdf)):
+                    opt_student.zero_grad()
+                    pdf = student(sample).reshape(-1)
+                    loss = alpha * criterion(pdf, los_pdf) + (1 - alpha) * criterion(pdf, target)
+                    running_loss += loss.item()
+                with timer.phase('backward', items=len(los_pdf)):
+                    loss.backward()
+                with timer.phase('step'):
+                    opt_student.step()
+
+            mse = running_loss / batches_per_epoch
+            writer.add_scalar('Distillation Loss', mse, epoch)
+
+            with timer.phase('validation', items=len(validation_los)):
+                student.eval()
+                with torch.no_grad():
+                    pdf = student(validation_data).reshape(-1)
+                student.train()
+                student_stats = evaluate_predictions(pdf, validation_los)
+                agreement_stats = evaluate_predictions(pdf, teacher_validation)
+            writer.add_scalar('Validation MSE', student_stats['mse'], epoch)
+            writer.add_scalar('Validation Limits of Agreement', student_stats['loa'], epoch)
+            writer.add_scalar('Teacher Agreement MSE', agreement_stats['mse'], epoch)
+
+            # Write the time spent in each phase during the epoch to tensorboard
+            timer.write_scalars(writer, epoch)
+
+            progress.set_postfix_str(f'Loss: {mse:.2f}. MSE: {student_stats["mse"]:.2f} days '
+                                     f'(teacher {teacher_stats["mse"]:.2f}). Agreement MSE: '
+                                     f'{agreement_stats["mse"]:.2f}')
+    writer.close()
+
+    # Both models are served on the CPU, so compare their latency there
+    student = student.cpu().eval()
+    teacher = teacher.cpu()
+    validation_data = validation_data.cpu()
+    metrics = dict(
+        teacher_mse=teacher_stats['mse'],
+        teacher_mean_error=teacher_stats['mean_error'],
+        teacher_loa=teacher_stats['loa'],
+        student_mse=student_stats['mse'],
+        student_mean_error=student_stats['mean_error'],
+        student_loa=student_stats['loa'],
+        agreement_mse=agreement_stats['mse'],
+        agreement_mean_error=agreement_stats['mean_error'],
+        agreement_loa=agreement_stats['loa'],
+        validation_n=len(validation_los),
+        teacher_parameters=sum(p.numel() for p in teacher.parameters()),
+        student_parameters=sum(p.numel() for p in student.parameters()),
+    )
+    for batch in sorted({1, min(latency_batch_size, len(validation_data))}):
+        metrics[f'teacher_latency_ms_{batch}'] = measure_latency(teacher, validation_data, batch)
+        metrics[f'student_latency_ms_{batch}'] = measure_latency(student, validation_data, batch)
+
+    print(f'Teacher MSE: {metrics["teacher_mse"]:.2f} days. '
+          f'LoA: {metrics["teacher_mean_error"]:.2f} ± {metrics["teacher_loa"]:.2f}')
+    print(f'Student MSE: {metrics["student_mse"]:.2f} days. '
+          f'LoA: {metrics["student_mean_error"]:.2f} ± {metrics["student_loa"]:.2f}')
+    print(f'Student vs teacher MSE: {metrics["agreement_mse"]:.4f} days. '
+          f'LoA: {metrics["agreement_mean_error"]:.4f} ± {metrics["agreement_loa"]:.4f}')
+    print(f'Parameters: {metrics["teacher_parameters"]} teacher, {metrics["student_parameters"]} student')
+    for batch in sorted({1, min(latency_batch_size, len(validation_data))}):
+        print(f'Latency (batch of {batch}): {metrics[f"teacher_latency_ms_{batch}"]:.3f} ms teacher, '
+              f'{metrics[f"student_latency_ms_{batch}"]:.3f} ms student')
+    save_path = os.path.abspath(save_path)
+    print(f'Saving student model to {save_path}')
+    save_student_model(student, save_path, metrics)
+    # Summarise where the run's time went
+    print(timer)
+    summary_file = os.path.join(run_dir, 'timings.json')
+    timer.save(summary_file, teacher=teacher_file, arch=arch, width=width, layers=layers,
+               number_epochs=number_epochs, batches_per_epoch=batches_per_epoch, batch_size=batch_size,
+               alpha=alpha, validation_size=validation_size, device=str(use_device),
+               threads=torch.get_num_threads(), sync_timing=timer.synchronize is not None)
+    print(f'Saved timings to {summary_file}')
+    return student, metrics
+
+
+def parse_args(override_args: Optional[List[str]] = None) -> argparse.Namespace:
+    """
+    Parse command-line arguments. By default, parses sys.argv - if supplied, uses `args` as an override
+    :param override_args: Optional override for command-line arguments
+    :return: An argparse.Namespace containing the parsed argument set
+    """
+    parser = argparse.ArgumentParser(description='Distil a trained LoS model into a compact student model')
+    parser.add_argument('--data', '-d', type=str, help='Input CSV data file', required=True)
+    parser.add_argument('--teacher', '-t', type=str, help='Trained LoS model state to distil', required=True)
+    parser.add_argument('--save-path', '-p', type=str, help='Path to save the student model to',
+                        default='los_student.state')
+    parser.add_argument('--arch', type=str, help='Student architecture', default='mlp', choices=['mlp', 'cnn'])
+    parser.add_argument('--width', type=int, help='Units per hidden layer (MLP) or first layer filters (CNN)',
+                        default=64)
+    parser.add_argument('--layers', type=int, help='Number of hidden layers of an MLP student', default=2)
+    parser.add_argument('--cpu', action='store_true', help='Disable CUDA, running all training on the CPU')
+    parser.add_argument('--epochs', '-e', type=int, help='Number of epochs to run for', default=100)
+    parser.add_argument('--batches-per-epoch', '-b', type=int, help='Number of batches per epoch', default=100)
+    parser.add_argument('--batch-size', '-s', type=int, help='Batch size (number of samples per batch)', default=512)
+    parser.add_argument('--learning-rate', type=float, help='Learning rate of the optimiser', default=1e-3)
+    parser.add_argument('--alpha', type=float, default=0.0,
+                        help='Weight of the loss against the true lengths of stay (the rest is against the teacher)')
+    parser.add_argument('--validation-size', '-v', type=int, help='Number of validation samples to use', default=10000)
+    parser.add_argument('--latency-batch-size', type=int, help='Records per forward pass when timing batched scoring',
+                        default=256)
+    parser.add_argument('--shuffle-data', action='store_true', help='Whether to shuffle data before sampling')
+    parser.add_argument('--shuffle-seed', type=int, help='Optionally seed the PRNG for consistent shuffling')
+    parser.add_argument('--max-samples', type=int, help='Maximum number of records to use for train/test splits')
+    parser.add_argument('--threads', type=int,
+                        help='Number of threads to use for CPU operations (by default, the available cores)')
+    parser.add_argument('--sync-timing', action='store_true',
+                        help='Synchronise the GPU around each timed phase, for accurate (but slower) phase times')
+    return parser.parse_args(args=override_args)
+
+
+if __name__ == '__main__':
+    # Parse command-line arguments
+    args = parse_args()
+    # Size the thread pools to the cores available (including container CPU limits) before loading any data
+    resources.configure(threads=args.threads)
+    use_cuda = not args.cpu
+    device = torch.device('cuda' if use_cuda and torch.cuda.is_available() else 'cpu')
+    # Use the same shuffle settings as the teacher's training run to reproduce its validation split
+    data_loader = DataHandler(args.data, device=device, shuffle=args.shuffle_data, fixed_seed=args.shuffle_seed,
+                              max_samples=args.max_samples, reshape=True)
+    print(f'Loaded {data_loader}')
+    run_distillation(data_loader, device, args.teacher, args.save_path, arch=args.arch, width=args.width,
+                     layers=args.layers, number_epochs=args.epochs, batches_per_epoch=args.batches_per_epoch,
+                     batch_size=args.batch_size, learning_rate=args.learning_rate, alpha=args.alpha,
+                     validation_size=args.validation_size, latency_batch_size=args.latency_batch_size,
+                     sync_timing=args.sync_timing)
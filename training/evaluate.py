@@ -0,0 +1,240 @@
+import argparse
+import hashlib
+import json
+import os.path
+from typing import Optional, List, Dict
+
+import numpy as np
+from tqdm import tqdm
+from loader import DataHandler
+# Adjust sys.path to allow access to ltss module in parent directory
+import sys
+sys.path.append('..')
+from ltss import los_model, risk_model
+from ltss.registry import artifact_version
+
+# Confidence levels to report limits of agreement at, and the normal quantiles they correspond to
+LOA_LEVELS = {0.5: 0.674, 0.75: 1.150, 0.9: 1.645, 0.95: 1.960}
+
+
+def predict_split(data: np.ndarray, los_model_file: str, risk_model_file: str, batch_size: int = 65536,
+                  use_tqdm: bool = True) -> Dict[str, np.ndarray]:
+    """
+    Score a split of flattened vectors against both models, a batch at a time
+    :param data: N x len(MODEL_SELECTORS) array of flattened vectors, as sampled by a `DataHandler` with
+    `reshape=False`
+    :param los_model_file: Path to LoS model state file
+    :param risk_model_file: Path to risk model saved state pickle file
+    :param batch_size: Number of records to score per batch
+    :param use_tqdm: If true, display TQDM progress info
+    :return: Dict of arrays of predicted LoS, risk stratification and MOT days, and a mask of valid risk predictions
+    """
+    los_predictor = los_model.init_model(model_file=los_model_file)
+    risk_predictor = risk_model.init_model(model_file=risk_model_file)
+    predicted_los = np.zeros(len(data), dtype=np.float32)
+    risk = np.zeros(len(data), dtype=np.int8)
+    mot_days = np.zeros(len(data), dtype=np.int8)
+    known = np.zeros(len(data), dtype=bool)
+    batches = range(0, len(data), batch_size)
+    if use_tqdm:
+        batches = tqdm(batches, desc='Scoring', unit=' batches')
+    for start in batches:
+        batch = data[start:start + batch_size]
+        batch_los = los_model.predict_matrix(los_predictor, batch)
+        predictions, batch_known = risk_model.get_predictions(risk_predictor, batch, ai_day_predictions=batch_los)
+        predicted_los[start:start + len(batch)] = batch_los
+        risk[start:start + len(batch)] = predictions['RISK_STRATIFICATION']
+        mot_days[start:start + len(batch)] = predictions['MOT_DAYS']
+        known[start:start + len(batch)] = batch_known
+    return dict(predicted_los=predicted_los, risk=risk, mot_days=mot_days, known=known)
+
+
+def cached_predictions(data: np.ndarray, los: np.ndarray, los_model_file: str, risk_model_file: str,
+                       cache_dir: Optional[str] = None, batch_size: int = 65536) -> Dict[str, np.ndarray]:
+    """
+    Score a split against both models, reusing predictions cached on disk for the same models and data
+    :param data: N x len(MODEL_SELECTORS) array of flattened vectors
+    :param los: Ground-truth lengths of stay for the vectors
+    :param los_model_file: Path to LoS model state file
+    :param risk_model_file: Path to risk model saved state pickle file
+    :param cache_dir: Directory to cache predictions in (no caching, if None)
+    :param batch_size: Number of records to score per batch
+    :return: Dict of arrays of predictions, as returned by `predict_split`
+    """
+    if cache_dir is None:
+        return predict_split(data, los_model_file, risk_model_file, batch_size=batch_size)
+    # Key the cache on the content of the models and of the split, so retrained models or a different split are
+    # never served stale predictions
+    data_digest = hashlib.sha256(np.ascontiguousarray(data).tobytes())
+    data_digest.update(np.ascontiguousarray(los).tobytes())
+    key = f'{artifact_version([los_model_file, risk_model_file])}-{data_digest.hexdigest()[:12]}'
+    cache_file = os.path.join(cache_dir, f'predictions_{key}.npz')
+    if os.path.exists(cache_file):
+        print(f'Loading cached predictions from {cache_file}')
+        with np.load(cache_file) as cached:
+            return {k: cached[k] for k in cached.files}
+    predictions = predict_split(data, los_model_file, risk_model_file, batch_size=batch_size)
+    os.makedirs(cache_dir, exist_ok=True)
+    # Write to a temporary file first, so an interrupted run never leaves a truncated cache entry
+    np.savez(f'{cache_file}.tmp.npz', **predictions)
+    os.replace(f'{cache_file}.tmp.npz', cache_file)
+    return predictions
+
+
+def los_metrics(los: np.ndarray, predicted_los: np.ndarray) -> Dict[str, float]:
+    """
+    Compute agreement statistics between true and predicted lengths of stay
+    :param los: Ground-truth lengths of stay
+    :param predicted_los: Predicted lengths of stay
+    :return: Dict of mean absolute error, median absolute error, mean error, and limits of agreement
+    """
+    if len(los) == 0:
+        return dict(n=0)
+    errors = los - predicted_los
+    metrics = dict(
+        n=len(los),
+        mae=float(np.mean(np.abs(errors))),
+        median_error=float(np.median(np.abs(errors))),
+        mean_error=float(np.mean(errors)),
+    )
+    for level, sds in LOA_LEVELS.items():
+        metrics[f'loa_{int(100 * level)}'] = float(sds * np.std(errors))
+    return metrics
+
+
+def risk_metrics(los: np.ndarray, risk: np.ndarray, long_stay: int = 21) -> Dict:
+    """
+    Compute risk-band calibration and confusion tables
+    :param los: Ground-truth lengths of stay
+    :param risk: Predicted risk stratification, in the range 1 - 5
+    :param long_stay: Length of stay in days at which a patient is considered a long stayer
+    :return: Dict of calibration rows per band and 5 x 5 confusion table of true band (rows) by predicted band
+    """
+    true_risk = risk_model.RiskCDFModel.risks_from_days(los)
+    # Count of each (true band, predicted band) pair in a single pass
+    confusion = np.bincount((true_risk - 1) * 5 + (risk.astype(int) - 1), minlength=25).reshape(5, 5)
+    long_stayers = los >= long_stay
+    calibration = []
+    for band in range(1, 6):
+        in_band = risk == band
+        count = int(np.count_nonzero(in_band))
+        calibration.append(dict(
+            band=band,
+            n=count,
+            proportion=count / len(risk) if len(risk) > 0 else 0.0,
+            mean_los=float(np.mean(los[in_band])) if count > 0 else None,
+            # Observed long stay rate in the band, against the rate the model reports for the band
+            observed_long_stay=float(np.mean(long_stayers[in_band])) if count > 0 else None,
+            expected_long_stay=risk_model.RiskCDFModel.risk_of_long_stay_by_category(band) / 100,
+            long_stay_share=float(np.count_nonzero(in_band & long_stayers) / max(1, np.count_nonzero(long_stayers))),
+        ))
+    return dict(
+        long_stay=long_stay,
+        accuracy=float(np.trace(confusion) / max(1, len(risk))),
+        calibration=calibration,
+        confusion=confusion.tolist(),
+    )
+
+
+def run_evaluation(loader: DataHandler, los_model_file: str, risk_model_file: str, cache_dir: Optional[str] = None,
+                   long_stay: int = 21, batch_size: int = 65536) -> Dict:
+    """
+    Evaluate both models on the test split of the given loader
+    :param loader: The DataHandler to use to load the test split (must be constructed with `reshape=False`)
+    :param los_model_file: Path to LoS model state file
+    :param risk_model_file: Path to risk model saved state pickle file
+    :param cache_dir: Directory to cache predictions in
+    :param long_stay: Length of stay in days at which a patient is considered a long stayer
+    :param batch_size: Number of records to score per batch
+    :return: Dict of LoS and risk metrics
+    """
+    if loader.reshape:
+        raise ValueError('Evaluation requires flattened vectors: construct the DataHandler with reshape=False')
+    data, los = loader.get_validation()
+    data = data.cpu().numpy()
+    los = los.cpu().numpy()
+    predictions = cached_predictions(data, los, los_model_file, risk_model_file, cache_dir=cache_dir,
+                                     batch_size=batch_size)
+    known = predictions['known']
+    if not np.all(known):
+        print(f'Warning: {np.count_nonzero(~known)} records have no factors known to the risk model, excluding them '
+              f'from risk metrics')
+    long_stayers = los >= long_stay
+    return dict(
+        model_version=artifact_version([los_model_file, risk_model_file]),
+        los=los_metrics(los, predictions['predicted_los']),
+        los_short=los_metrics(los[~long_stayers], predictions['predicted_los'][~long_stayers]),
+        los_long=los_metrics(los[long_stayers], predictions['predicted_los'][long_stayers]),
+        risk=risk_metrics(los[known], predictions['risk'][known], long_stay=long_stay),
+    )
+
+
+def print_report(metrics: Dict):
+    """
+    Print a human-readable summary of evaluation metrics
+    :param metrics: Metrics returned by `run_evaluation`
+    """
+    for key, title in [('los', 'All'), ('los_short', 'Short stay'), ('los_long', 'Long stay')]:
+        los = metrics[key]
+        if los['n'] == 0:
+            continue
+        print(f'{title} ({los["n"]} records): MAE {los["mae"]:.2f} days, median error {los["median_error"]:.2f} '
+              f'days. LoA: {los["mean_error"]:.2f} ± {los["loa_95"]:.2f}')
+    risk = metrics['risk']
+    print(f'\nRisk band calibration (long stay >= {risk["long_stay"]} days):')
+    print('Band       N  Share  Mean LoS  Long stay (observed/expected)  Share of long stayers')
+    for row in risk['calibration']:
+        mean_los = f'{row["mean_los"]:8.2f}' if row['mean_los'] is not None else '       -'
+        observed = f'{row["observed_long_stay"]:.2f}' if row['observed_long_stay'] is not None else '   -'
+        print(f'{row["band"]:4d} {row["n"]:7d}  {row["proportion"]:5.2f}  {mean_los}  '
+              f'{observed} / {row["expected_long_stay"]:.2f}                    {row["long_stay_share"]:.2f}')
+    print(f'\nRisk band confusion (true band by row, predicted band by column), accuracy {risk["accuracy"]:.2f}:')
+    print('       ' + ''.join(f'{band:>9d}' for band in range(1, 6)))
+    for band, row in enumerate(risk['confusion'], start=1):
+        print(f'{band:>7d}' + ''.join(f'{count:>9d}' for count in row))
+
+
+def parse_args(override_args: Optional[List[str]] = None) -> argparse.Namespace:
+    """
+    Parse command-line arguments. By default, parses sys.argv - if supplied, uses `args` as an override
+    :param override_args: Optional override for command-line arguments
+    :return: An argparse.Namespace containing the parsed argument set
+    """
+    parser = argparse.ArgumentParser(description='Evaluate trained LoS and risk models on the test split')
+    parser.add_argument('--data', '-d', type=str, help='Input CSV data file', required=True)
+    parser.add_argument('--los-model', type=str, help='LoS model state file', required=True)
+    parser.add_argument('--risk-model', type=str, help='Risk model pickle file', required=True)
+    parser.add_argument('--cache-dir', type=str, help='Directory to cache predictions in')
+    parser.add_argument('--long-stay', type=int, help='Length of stay in days of a long stayer', default=21)
+    parser.add_argument('--batch-size', type=int, help='Number of records to score per batch', default=65536)
+    parser.add_argument('--output', '-o', type=str, help='Optional path to write metrics JSON to')
+    parser.add_argument('--max-mae', type=float, help='Fail if the LoS mean absolute error exceeds this value')
+    parser.add_argument('--max-loa', type=float, help='Fail if the LoS 95%% limits of agreement exceed this value')
+    parser.add_argument('--shuffle-data', action='store_true', help='Whether to shuffle data before sampling')
+    parser.add_argument('--shuffle-seed', type=int, help='Optionally seed the PRNG for consistent shuffling')
+    parser.add_argument('--max-samples', type=int, help='Maximum number of records to use for train/test splits')
+    return parser.parse_args(args=override_args)
+
+
+if __name__ == '__main__':
+    # Parse command-line arguments
+    args = parse_args()
+    # Use the same shuffle settings as the training run to reproduce its test split
+    data_loader = DataHandler(args.data, shuffle=args.shuffle_data, fixed_seed=args.shuffle_seed,
+                              max_samples=args.max_samples, reshape=False)
+    print(f'Loaded {data_loader}')
+    results = run_evaluation(data_loader, args.los_model, args.risk_model, cache_dir=args.cache_dir,
+                             long_stay=args.long_stay, batch_size=args.batch_size)
+    print_report(results)
+    if args.output is not None:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=2)
+    # Gate on the LoS agreement, for use in a retraining pipeline
+    failures = []
+    if args.max_mae is not None and results['los']['mae'] > args.max_mae:
+        failures.append(f'MAE {results["los"]["mae"]:.2f} exceeds {args.max_mae:.2f}')
+    if args.max_loa is not None and results['los']['loa_95'] > args.max_loa:
+        failures.append(f'95% LoA {results["los"]["loa_95"]:.2f} exceeds {args.max_loa:.2f}')
+    if failures:
+        print(f'Evaluation failed: {"; ".join(failures)}')
+        sys.exit(1)
@@ -1,4 +1,5 @@
-from typing import Iterable, Tuple, Optional
+import time
+from typing import Iterable, Tuple, Optional, Union, Dict
 
 import torch
 import numpy as np
@@ -7,22 +8,79 @@ from tqdm import tqdm
 import sys
 
 sys.path.append('..')
-from ltss.utils import read_records_csv, reshape_vector, flatten_vector
-from ltss.vectorise import vectorise_record
+from ltss.utils import read_records_csv, flatten_vector, is_columnar_file, read_columnar_batches, flatten_columns, \
+    reshape_matrix, MODEL_SELECTORS
+from ltss.vectorise import vectorise_record, vectorise_columns, FIELD_MANIPULATIONS
+try:
+    from timing import PhaseTimer, peak_rss
+except ImportError:
+    # Imported as `training.loader`, e.g. from the evaluation notebooks
+    from training.timing import PhaseTimer, peak_rss
 
 
 class DataHandler(object):
     """
-    Contains logic for loading data from the provided NHS CSV, filtering out non-major cases, and vectorising the
-    resulting records for training (depending heavily on the parsing and vectorising logic in the `ltss` module).
+    Contains logic for loading data from the provided NHS CSV (or a Parquet/Arrow IPC export of it), filtering out
+    non-major cases, and vectorising the resulting records for training (depending heavily on the parsing and
+    vectorising logic in the `ltss` module).
 
     Additionally contains logic for consistently sampling the training and test splits.
+
+    The dataset is held once, as a flat N x len(MODEL_SELECTORS) matrix of the smallest integer type that holds every
+    vectorised value (falling back to single precision floats). The train/test splits are index arrays (or slices,
+    when not shuffled) into that matrix, and samples are converted to float and optionally reshaped as they are drawn.
+
+    The time spent parsing, vectorising and collecting the data, and sampling it, is counted by the handler's `timer`.
     """
 
     def __init__(self, filename: str, max_samples=None, filter_minor=True, max_los_clip=30,
                  shuffle=False, fixed_seed=None, train_proportion=0.8, reshape=False, use_tqdm=True,
-                 device: torch.device = torch.device('cpu')):
+                 device: torch.device = torch.device('cpu'), timer: Optional[PhaseTimer] = None):
+        self.__configure(max_samples, filter_minor, max_los_clip, shuffle, fixed_seed, train_proportion, reshape,
+                         device, timer)
+        with self.timer.phase('load'):
+            if is_columnar_file(filename):
+                # Stream batches of columns from Parquet/Arrow and vectorise
+                stream = self.__stream_columns(filename, use_tqdm, filter_minor, max_los_clip, max_samples, self.timer)
+            else:
+                # Stream the records from CSV and vectorise
+                stream = self.__stream_records(filename, use_tqdm, filter_minor, max_los_clip, max_samples, self.timer)
+            # Store in a single compact matrix
+            self.data, self.los = self.__collect(stream, self.timer)
+            self.__split()
+        # Count the records loaded, for the loader's records per second
+        self.timer.count('load', len(self.data))
+
+    @classmethod
+    def from_arrays(cls, data: np.ndarray, los: np.ndarray, max_los_clip=30, shuffle=False, fixed_seed=None,
+                    train_proportion=0.8, reshape=False, device: torch.device = torch.device('cpu'),
+                    timer: Optional[PhaseTimer] = None) -> 'DataHandler':
+        """
+        Construct a DataHandler from already vectorised (and filtered) data, for example a memory map of the data
+        loaded by another DataHandler, without re-reading or re-vectorising the source file
+        :param data: N x len(MODEL_SELECTORS) array of flattened feature vectors, which is sampled without copying
+        :param los: Array of the associated ground-truth lengths of stay
+        :param max_los_clip: If non-none, clip the maximum LoS to this value
+        :param shuffle: Whether to shuffle data before sampling
+        :param fixed_seed: Optionally seed the PRNG for consistent shuffling
+        :param train_proportion: Proportion of the data used for training
+        :param reshape: Whether to reshape samples for the LoS model, or only flatten them
+        :param device: The torch device to move samples to
+        :param timer: Optional PhaseTimer to count sampling time in (by default, a new timer)
+        :return: DataHandler sampling from the given data
+        """
+        handler = cls.__new__(cls)
+        handler.__configure(None, True, max_los_clip, shuffle, fixed_seed, train_proportion, reshape, device, timer)
+        handler.data = data
+        handler.los = np.minimum(los, max_los_clip) if max_los_clip is not None else los
+        handler.__split()
+        return handler
+
+    def __configure(self, max_samples, filter_minor, max_los_clip, shuffle, fixed_seed, train_proportion, reshape,
+                    device, timer):
+        """Store the handler configuration and seed the PRNG"""
         self.device = device
+        self.timer = timer if timer is not None else PhaseTimer()
         self.train_proportion = train_proportion
         self.max_samples = max_samples
         self.shuffle = shuffle
@@ -34,23 +92,78 @@ class DataHandler(object):
         # consistent sampling throughout the lifetime of the handler
         if self.fixed_seed is not None:
             np.random.seed(self.fixed_seed)
-        # Stream the records from CSV, vectorise, and store in a stack
-        data, los = zip(*self.__stream_records(filename, use_tqdm, filter_minor, max_los_clip, max_samples, reshape))
-        # Stack data and los for storage
-        self.data = np.vstack(data)
-        self.los = np.vstack(los)
-        # Drop the extra dimension from the LoS array
-        self.los = self.los.reshape(-1)
-        # Carve data into train/test sets
-        training_indices, test_indices = self.__train_test_splits()
-        self.train_data = self.data[training_indices]
-        self.train_los = self.los[training_indices]
-        self.test_data = self.data[test_indices]
-        self.test_los = self.los[test_indices]
+
+    def __split(self):
+        """Carve data into train/test sets, as indices into the data rather than copies of it"""
+        self.train_indices, self.test_indices = self.__train_test_splits()
+
+    @staticmethod
+    def __collect(stream: Iterable[Tuple[np.array, np.array]], timer: PhaseTimer,
+                  initial_capacity: int = 65536) -> Tuple[np.array, np.array]:
+        """
+        Collect a stream of flattened vectors into a single matrix, growing a preallocated buffer rather than holding
+        every row as a separate array before stacking, then store it in the most compact type that holds its values
+        :param stream: Generator of tuples of flattened feature vectors (or batches of them), and their lengths of stay
+        :param timer: PhaseTimer to count the time spent collecting (excluding the stream) and compacting in
+        :param initial_capacity: Number of rows to allocate before the first resize
+        :return: Tuple of N x len(MODEL_SELECTORS) data matrix and array of lengths of stay
+        """
+        data = np.empty((initial_capacity, len(MODEL_SELECTORS)), dtype=np.float32)
+        los = np.empty(initial_capacity, dtype=np.float32)
+        n = 0
+        collecting = 0.0
+        # Memory is only allocated as the buffer grows, so only resizes can raise the peak RSS
+        growth = 0 if peak_rss() is not None else None
+        for rows, row_los in stream:
+            start = time.perf_counter()
+            rows = np.atleast_2d(rows)
+            row_los = np.atleast_1d(row_los)
+            if n + len(rows) > len(data):
+                before = peak_rss()
+                # Double the capacity, so the cost of copying is amortised over the rows loaded
+                capacity = max(2 * len(data), n + len(rows))
+                grown_data = np.empty((capacity, data.shape[1]), dtype=data.dtype)
+                grown_data[:n] = data[:n]
+                grown_los = np.empty(capacity, dtype=los.dtype)
+                grown_los[:n] = los[:n]
+                data, los = grown_data, grown_los
+                if growth is not None:
+                    growth += peak_rss() - before
+            data[n:n + len(rows)] = rows
+            los[n:n + len(rows)] = row_los
+            n += len(rows)
+            collecting += time.perf_counter() - start
+        timer.add('load/collect', collecting, items=n, rss_growth=growth)
+        with timer.phase('load/compact'):
+            # Trim to size (copying, so the excess capacity is released) in the compact type
+            data = data[:n].astype(DataHandler.compact_dtype(data[:n]))
+            return data, los[:n].copy()
+
+    @staticmethod
+    def compact_dtype(matrix: np.array, chunk_size: int = 1 << 20) -> np.dtype:
+        """
+        Find the smallest signed integer type that holds every value of a matrix, or single precision float if any
+        value is non-integral
+        :param matrix: Matrix of values to store
+        :param chunk_size: Number of rows to check at once, bounding temporary memory use
+        :return: Compact numpy dtype for the matrix
+        """
+        if matrix.size == 0:
+            return np.dtype(np.int8)
+        low, high = 0, 0
+        for start in range(0, len(matrix), chunk_size):
+            chunk = matrix[start:start + chunk_size]
+            if not np.all(np.mod(chunk, 1) == 0):
+                return np.dtype(np.float32)
+            low, high = min(low, chunk.min()), max(high, chunk.max())
+        for dtype in (np.int8, np.int16, np.int32):
+            if np.iinfo(dtype).min <= low and high <= np.iinfo(dtype).max:
+                return np.dtype(dtype)
+        return np.dtype(np.float32)
 
     @staticmethod
     def __stream_records(filename: str, use_tqdm: bool, filter_minor: bool, max_los_clip: Optional[int],
-                         max_samples: Optional[int], reshape: bool) -> Iterable[Tuple[np.array, int]]:
+                         max_samples: Optional[int], timer: PhaseTimer) -> Iterable[Tuple[np.array, int]]:
         """
         Stream records off disk, vectorise them, and optionally filter out "minor" records from the data
         :param filename: The filename of raw CSV data to parse
@@ -58,97 +171,204 @@ class DataHandler(object):
         :param filter_minor: If true, discard entries for the IS_MAJOR is not true
         :param max_los_clip: If non-none, clip the maximum LoS to this value
         :param max_samples: If non-none, limit the number of records emitted
-        :param reshape: Whether to flatten and reshape the vector, or only flatten it (impacts output data shape)
-        :return: Generator of tuples of 8x8 feature vectors, and their ground-truth length of stay
+        :param timer: PhaseTimer to count the time spent parsing and vectorising in
+        :return: Generator of tuples of flattened feature vectors, and their ground-truth length of stay
         """
         stream = read_records_csv(filename)
         if use_tqdm:
             stream = tqdm(stream, desc='Loading data', unit=' records')
         emitted_samples = 0
-        for record in stream:
-            vector = vectorise_record(record)
-            los = vector['LENGTH_OF_STAY']
-            # Discard obviously bad data (negative LoS is impossible)
-            if los < 0:
-                continue
-            # Filter out "minor" records
-            if filter_minor and vector['IS_MAJOR'] != 1:
-                continue
-            # Clip LoS to a maximum value
-            if max_los_clip is not None:
-                los = min(los, max_los_clip)
-            if reshape:
-                yield reshape_vector(vector), los
-            else:
+        # Accumulate times locally, as a timer call per record would cost more than the timing itself
+        parsing, vectorising, read_records = 0.0, 0.0, 0
+        records = iter(stream)
+        try:
+            while True:
+                start = time.perf_counter()
+                record = next(records, None)
+                parsed = time.perf_counter()
+                parsing += parsed - start
+                if record is None:
+                    return
+                read_records += 1
+                vector = vectorise_record(record)
+                los = vector['LENGTH_OF_STAY']
+                vectorising += time.perf_counter() - parsed
+                # Discard obviously bad data (negative LoS is impossible)
+                if los < 0:
+                    continue
+                # Filter out "minor" records
+                if filter_minor and vector['IS_MAJOR'] != 1:
+                    continue
+                # Clip LoS to a maximum value
+                if max_los_clip is not None:
+                    los = min(los, max_los_clip)
                 yield flatten_vector(vector), los
+                # Update stats
+                emitted_samples += 1
+                if use_tqdm:
+                    stream.set_postfix_str(f'generated {emitted_samples} good records', refresh=False)
+                # If we've emitted enough samples, finish fast
+                if max_samples is not None and emitted_samples >= max_samples:
+                    return
+        finally:
+            timer.add('load/parse', parsing, items=read_records)
+            timer.add('load/vectorise', vectorising, items=read_records)
+
+    @staticmethod
+    def __stream_columns(filename: str, use_tqdm: bool, filter_minor: bool, max_los_clip: Optional[int],
+                         max_samples: Optional[int], timer: PhaseTimer) -> Iterable[Tuple[np.array, np.array]]:
+        """
+        Stream batches of records off a Parquet or Arrow IPC file, reading only the columns used by the vectoriser,
+        and vectorise and filter each batch as a whole, as `__stream_records` does for each CSV row
+        :param filename: The filename of raw Parquet/Arrow data to parse
+        :param use_tqdm: If true, display TQDM progress info (useful when there is a lot of data to load and vectorise)
+        :param filter_minor: If true, discard entries for the IS_MAJOR is not true
+        :param max_los_clip: If non-none, clip the maximum LoS to this value
+        :param max_samples: If non-none, limit the number of records emitted
+        :param timer: PhaseTimer to count the time spent parsing and vectorising in
+        :return: Generator of tuples of batches of flattened feature vectors, and their ground-truth lengths of stay
+        """
+        stream = iter(read_columnar_batches(filename, fields=FIELD_MANIPULATIONS.fields()))
+        progress = tqdm(desc='Loading data', unit=' records') if use_tqdm else None
+        emitted_samples = 0
+        while True:
+            with timer.phase('load/parse'):
+                columns = next(stream, None)
+            if columns is None:
+                break
+            n = len(next(iter(columns.values()))) if columns else 0
+            with timer.phase('load/vectorise', items=n):
+                vectorised = vectorise_columns(columns)
+                los = vectorised['LENGTH_OF_STAY']
+                # Discard obviously bad data (negative LoS is impossible)
+                keep = los >= 0
+                # Filter out "minor" records
+                if filter_minor:
+                    keep &= vectorised.get('IS_MAJOR', np.ones(n)) == 1
+                data = flatten_columns(vectorised, n)[keep]
+                los = los[keep]
+                # Clip LoS to a maximum value
+                if max_los_clip is not None:
+                    los = np.minimum(los, max_los_clip)
+            # If we've emitted enough samples, truncate the final batch
+            if max_samples is not None:
+                data = data[:max_samples - emitted_samples]
+                los = los[:max_samples - emitted_samples]
+            timer.count('load/parse', n)
+            yield data, los
             # Update stats
-            emitted_samples += 1
+            emitted_samples += len(los)
             if use_tqdm:
-                stream.set_postfix_str(f'generated {emitted_samples} good records', refresh=False)
-            # If we've emitted enough samples, finish fast
+                progress.update(n)
+                progress.set_postfix_str(f'generated {emitted_samples} good records', refresh=False)
             if max_samples is not None and emitted_samples >= max_samples:
-                return
+                break
+        if use_tqdm:
+            progress.close()
 
-    def __train_test_splits(self):
+    def __train_test_splits(self) -> Tuple[Union[slice, np.array], Union[slice, np.array]]:
         """
         Make reproducible train/test splits of the data. Optionally, shuffle (reproducibly, controlled by
         `self.shuffle` and `self.fixed_seed`) the data for train/test.
-        :return:
+        :return: Tuple of training and test indices: slices if not shuffling, otherwise arrays of row indices
         """
-        # By default, our indices are just 0-n
-        split_indices = list(range(len(self.data)))
-        # If shuffling, use our shared Random instance to shuffle our indices before slicing
-        if self.shuffle:
-            np.random.shuffle(split_indices)
         # Regardless of shuffle, take the first self.train_proportion for training, and the last
         # 1 - self.train_proportion records as test
         train_n = int(self.train_proportion * len(self.data))
-        training_indices = split_indices[:train_n]
-        test_indices = split_indices[train_n:]
-        return training_indices, test_indices
+        if not self.shuffle:
+            return slice(0, train_n), slice(train_n, len(self.data))
+        # If shuffling, use our shared Random instance to shuffle our indices before slicing
+        split_indices = np.random.permutation(len(self.data))
+        # Use the smallest index type that can address the data
+        split_indices = split_indices.astype(np.int32 if len(self.data) < np.iinfo(np.int32).max else np.int64)
+        return split_indices[:train_n], split_indices[train_n:]
+
+    @staticmethod
+    def __split_size(split: Union[slice, np.array]) -> int:
+        """Number of records in a split"""
+        return split.stop - split.start if isinstance(split, slice) else len(split)
 
-    def __sample(self, data, los, n: Optional[int], random: bool):
+    def __sample(self, split: Union[slice, np.array], n: Optional[int], random: bool, phase: str):
         """
-        Sample the given data/los distribution, selecting the given N and optionally randomising the sample.
-        :param data: Dataset of vectors to sample
-        :param los: Dataset of lengths of stay to sample
+        Sample the given split of the data, selecting the given N and optionally randomising the sample.
+        :param split: Slice or array of row indices of the split to sample
         :param n: The number of samples to generate
         :param random: When true, randomise samples
+        :param phase: Name of the phase to count the sampling time in
         :return: Torch tensors for the sampled data and los distributions, moved to the relevant Torch device.
         """
+        size = self.__split_size(split)
         if n is None:
-            n = len(data)
+            n = size
         else:
-            n = min(len(data), n)
-        # Uniform random sampling from our data array
-        indices = list(range(len(data)))
-        if random:
-            np.random.shuffle(indices)
-        indices = indices[:n]
-        data = torch.Tensor(data[indices])
-        los = torch.Tensor(los[indices])
-        if self.device != 'cpu' and 'cuda' in self.device.type:
-            data = data.cuda()
-            los = los.cuda()
-        return data, los
+            n = min(size, n)
+        with self.timer.phase(phase, items=n):
+            # Uniform random sampling from our split
+            chosen = np.random.permutation(size)[:n] if random else np.arange(n)
+            rows = split.start + chosen if isinstance(split, slice) else split[chosen]
+            data = torch.Tensor(self.__convert(self.data[rows]))
+            los = torch.Tensor(self.los[rows])
+            if self.device != 'cpu' and 'cuda' in self.device.type:
+                data = data.cuda()
+                los = los.cuda()
+            return data, los
+
+    def __convert(self, data: np.array) -> np.array:
+        """Convert rows from the compact storage type, and reshape them for the LoS model if required"""
+        data = data.astype(np.float32)
+        return reshape_matrix(data) if self.reshape else data
+
+    @property
+    def train_data(self) -> np.array:
+        """Training data, converted to float and reshaped as samples are (a copy of the data)"""
+        return self.__convert(self.data[self.train_indices])
+
+    @property
+    def train_los(self) -> np.array:
+        """Training lengths of stay (a view if not shuffled, otherwise a copy)"""
+        return self.los[self.train_indices]
+
+    @property
+    def test_data(self) -> np.array:
+        """Test data, converted to float and reshaped as samples are (a copy of the data)"""
+        return self.__convert(self.data[self.test_indices])
+
+    @property
+    def test_los(self) -> np.array:
+        """Test lengths of stay (a view if not shuffled, otherwise a copy)"""
+        return self.los[self.test_indices]
+
+    def memory_report(self) -> Dict[str, int]:
+        """
+        Break down the memory held by the handler
+        :return: Dict of bytes held by each component, and in total
+        """
+        report = dict(
+            data=self.data.nbytes,
+            los=self.los.nbytes,
+            train_indices=0 if isinstance(self.train_indices, slice) else self.train_indices.nbytes,
+            test_indices=0 if isinstance(self.test_indices, slice) else self.test_indices.nbytes,
+        )
+        report['total'] = sum(report.values())
+        return report
 
     def get_training_n(self, n: Optional[int] = None, random: bool = True) -> Tuple[torch.Tensor, torch.Tensor]:
         """
         Sample n records from the training data, optionally at random
-        :param n: Number of samples to retrieve. Must be <= len(self.train_data)
+        :param n: Number of samples to retrieve. Must be <= the size of the training split
         :param random: When true, randomise the retrieved samples
         :return: Tuple of training data and associated lengths of stay
         """
-        return self.__sample(self.train_data, self.train_los, n, random)
+        return self.__sample(self.train_indices, n, random, 'sample')
 
     def get_validation(self, n: Optional[int] = None, random: bool = False) -> Tuple[torch.Tensor, torch.Tensor]:
         """
         Sample n records from the test data, optionally at random
-        :param n: Number of samples to retrieve. Must be <= len(self.test_data)
+        :param n: Number of samples to retrieve. Must be <= the size of the test split
         :param random: When true, randomise the retrieved samples
         :return: Tuple of test data and associated lengths of stay
         """
-        return self.__sample(self.test_data, self.test_los, n, random)
+        return self.__sample(self.test_indices, n, random, 'validation/sample')
 
     def __str__(self):
         config = dict(
@@ -161,6 +381,7 @@ class DataHandler(object):
             max_los_clip=self.max_los_clip,
             reshape=self.reshape,
         )
-        return f'DataHandler: {len(self.data)} records, with {len(self.train_data)} training and ' \
-               f'{len(self.test_data)} test records with configuration: ' \
+        return f'DataHandler: {len(self.data)} records, with {self.__split_size(self.train_indices)} training and ' \
+               f'{self.__split_size(self.test_indices)} test records ({self.data.dtype}, ' \
+               f'{self.memory_report()["total"] / 2 ** 20:.1f} MiB) with configuration: ' \
                f'{{{", ".join([f"{k}={v}" for k, v in sorted(config.items())])}}}'
@@ -0,0 +1,112 @@
+import argparse
+import os.path
+from typing import Optional, List, Dict
+
+import numpy as np
+import torch
+from loader import DataHandler
+# Adjust sys.path to allow access to ltss module in parent directory
+import sys
+sys.path.append('..')
+from ltss.los_model import LoSPredictor, init_model, quantise_model, save_quantised_model
+
+
+def evaluate_predictions(predictions: torch.Tensor, los: torch.Tensor) -> Dict[str, float]:
+    """
+    Compute the validation statistics reported by `train_los.py` for a set of predictions
+    :param predictions: Predicted lengths of stay
+    :param los: Ground-truth lengths of stay
+    :return: Dict of MSE, mean error and limits of agreement
+    """
+    errors = (los - predictions.reshape(-1)).cpu().detach().numpy()
+    return dict(
+        mse=float(np.mean(np.power(errors, 2))),
+        mean_error=float(np.mean(errors)),
+        loa=float(np.std(errors) * 1.96),
+    )
+
+
+def run_quantisation(loader: DataHandler, checkpoint: str, save_path: str, calibration_size: int = 2000,
+                     validation_size: Optional[int] = None, backend: str = 'fbgemm') -> Dict[str, float]:
+    """
+    Quantise a trained LoSPredictor checkpoint, calibrating on the training split, and compare the float and
+    quantised predictions on the validation split
+    :param loader: The DataHandler to use to load train and test data splits
+    :param checkpoint: Path to the trained float model state
+    :param save_path: Path to save the quantised model state and its validation metrics to
+    :param calibration_size: The number of training samples used to calibrate activation ranges
+    :param validation_size: The number of validation samples to compare on (all, if None)
+    :param backend: Quantisation engine to target
+    :return: Dict of validation metrics for the float and quantised models
+    """
+    predictor = init_model(model_file=checkpoint)
+    if not isinstance(predictor, LoSPredictor):
+        raise ValueError(f'{checkpoint} is not a LoSPredictor checkpoint, and cannot be quantised')
+    # Calibrate on a random sample of the training split, never on the validation split we report against
+    calibration_data, _ = loader.get_training_n(calibration_size)
+    quantised = quantise_model(predictor, calibration_data.cpu(), backend=backend)
+    validation_data, validation_los = loader.get_validation(validation_size)
+    validation_data = validation_data.cpu()
+    validation_los = validation_los.cpu()
+    with torch.no_grad():
+        float_predictions = predictor(validation_data).reshape(-1)
+        quantised_predictions = quantised(validation_data).reshape(-1)
+    float_stats = evaluate_predictions(float_predictions, validation_los)
+    quantised_stats = evaluate_predictions(quantised_predictions, validation_los)
+    # Agreement between the two models, treating the float predictions as the reference
+    agreement_stats = evaluate_predictions(quantised_predictions, float_predictions)
+    metrics = dict(
+        float_mse=float_stats['mse'],
+        float_mean_error=float_stats['mean_error'],
+        float_loa=float_stats['loa'],
+        quantised_mse=quantised_stats['mse'],
+        quantised_mean_error=quantised_stats['mean_error'],
+        quantised_loa=quantised_stats['loa'],
+        agreement_mse=agreement_stats['mse'],
+        agreement_mean_error=agreement_stats['mean_error'],
+        agreement_loa=agreement_stats['loa'],
+        validation_n=len(validation_los),
+    )
+    print(f'Float MSE: {metrics["float_mse"]:.2f} days. '
+          f'LoA: {metrics["float_mean_error"]:.2f} ± {metrics["float_loa"]:.2f}')
+    print(f'Int8 MSE: {metrics["quantised_mse"]:.2f} days. '
+          f'LoA: {metrics["quantised_mean_error"]:.2f} ± {metrics["quantised_loa"]:.2f}')
+    print(f'Int8 vs float MSE: {metrics["agreement_mse"]:.4f} days. '
+          f'LoA: {metrics["agreement_mean_error"]:.4f} ± {metrics["agreement_loa"]:.4f}')
+    save_path = os.path.abspath(save_path)
+    print(f'Saving quantised model to {save_path}')
+    save_quantised_model(quantised, save_path, backend, metrics)
+    return metrics
+
+
+def parse_args(override_args: Optional[List[str]] = None) -> argparse.Namespace:
+    """
+    Parse command-line arguments. By default, parses sys.argv - if supplied, uses `args` as an override
+    :param override_args: Optional override for command-line arguments
+    :return: An argparse.Namespace containing the parsed argument set
+    """
+    parser = argparse.ArgumentParser(description='Quantise a trained LoS model to int8 and evaluate it')
+    parser.add_argument('--data', '-d', type=str, help='Input CSV data file', required=True)
+    parser.add_argument('--checkpoint', '-c', type=str, help='Trained float model state to quantise', required=True)
+    parser.add_argument('--save-path', '-s', type=str, help='Path to save the quantised model to', required=True)
+    parser.add_argument('--calibration-size', type=int, help='Number of training samples to calibrate with',
+                        default=2000)
+    parser.add_argument('--validation-size', '-v', type=int, help='Number of validation samples to compare on')
+    parser.add_argument('--backend', type=str, help='Quantisation engine to target', default='fbgemm',
+                        choices=['fbgemm', 'qnnpack'])
+    parser.add_argument('--shuffle-data', action='store_true', help='Whether to shuffle data before sampling')
+    parser.add_argument('--shuffle-seed', type=int, help='Optionally seed the PRNG for consistent shuffling')
+    parser.add_argument('--max-samples', type=int, help='Maximum number of records to use for train/test splits')
+    return parser.parse_args(args=override_args)
+
+
+if __name__ == '__main__':
+    # Parse command-line arguments
+    args = parse_args()
+    # Quantised inference is CPU-only, so load the data straight onto the CPU. Use the same shuffle settings as the
+    # training run to reproduce its validation split.
+    data_loader = DataHandler(args.data, shuffle=args.shuffle_data, fixed_seed=args.shuffle_seed,
+                              max_samples=args.max_samples, reshape=True)
+    print(f'Loaded {data_loader}')
+    run_quantisation(data_loader, args.checkpoint, args.save_path, calibration_size=args.calibration_size,
+                     validation_size=args.validation_size, backend=args.backend)
@@ -0,0 +1,230 @@
+import argparse
+import csv
+import itertools
+import multiprocessing
+import os.path
+import time
+from contextlib import redirect_stdout, redirect_stderr
+from typing import Optional, List, Dict
+
+import numpy as np
+import torch
+from loader import DataHandler
+from train_los import run_training
+# Adjust sys.path to allow access to ltss module in parent directory
+import sys
+sys.path.append('..')
+from ltss import resources
+
+# Columns written to the sweep results table
+RESULT_FIELDS = [
+    'trial',
+    'features_d',
+    'learning_rate',
+    'batch_size',
+    'max_los_clip',
+    'parameters',
+    'validation_mse',
+    'validation_mean_error',
+    'validation_loa',
+    'latency_ms',
+    'batch_latency_ms',
+    'training_seconds',
+]
+
+
+def cache_dataset(loader: DataHandler, work_dir: str) -> Dict[str, str]:
+    """
+    Write the vectorised data and lengths of stay held by a DataHandler to memory-mappable files, so each trial can
+    map the same pages rather than re-reading and re-vectorising the source data
+    :param loader: DataHandler holding the vectorised data
+    :param work_dir: Directory to write the files to
+    :return: Dict of paths to the data and LoS files
+    """
+    os.makedirs(work_dir, exist_ok=True)
+    paths = dict(data=os.path.join(work_dir, 'data.npy'), los=os.path.join(work_dir, 'los.npy'))
+    # Keep the compact storage type of the loaded data
+    data = np.lib.format.open_memmap(paths['data'], mode='w+', dtype=loader.data.dtype, shape=loader.data.shape)
+    data[:] = loader.data
+    data.flush()
+    del data
+    np.save(paths['los'], loader.los.astype(np.float32))
+    return paths
+
+
+def measure_latency(model: torch.nn.Module, sample: torch.Tensor, repeats: int = 50) -> float:
+    """
+    Measure the median wall-clock time of a forward pass
+    :param model: Model to time, in eval mode
+    :param sample: Input batch
+    :param repeats: Number of forward passes to time
+    :return: Median latency in milliseconds
+    """
+    timings = []
+    with torch.no_grad():
+        # Warm up, so one-off allocation costs are not timed
+        model(sample)
+        for _ in range(repeats):
+            start = time.perf_counter()
+            model(sample)
+            timings.append(time.perf_counter() - start)
+    return float(np.median(timings) * 1000)
+
+
+def run_trial(trial: Dict) -> Dict:
+    """
+    Train and evaluate a single sweep configuration, in its own directory so checkpoints and Tensorboard output of
+    concurrent trials do not collide
+    :param trial: Dict of trial number, hyperparameters, and sweep settings
+    :return: Row of the results table for the trial
+    """
+    trial_dir = os.path.join(trial['work_dir'], f'trial_{trial["trial"]}')
+    os.makedirs(trial_dir, exist_ok=True)
+    os.chdir(trial_dir)
+    resources.configure(threads=trial['threads'])
+    # Map the shared dataset read-only, and split it exactly as the other trials do
+    data = np.load(trial['paths']['data'], mmap_mode='r')
+    los = np.load(trial['paths']['los'], mmap_mode='r')
+    # Evaluate against the unclipped validation LoS, so configurations with different clips are comparable
+    validation_data, validation_los = DataHandler.from_arrays(data, los, max_los_clip=None, shuffle=trial['shuffle'],
+                                                              fixed_seed=trial['shuffle_seed'],
+                                                              reshape=True).get_validation(trial['validation_size'])
+    loader = DataHandler.from_arrays(data, los, max_los_clip=trial['max_los_clip'], shuffle=trial['shuffle'],
+                                     fixed_seed=trial['shuffle_seed'], reshape=True)
+    start = time.perf_counter()
+    # Keep the trial's training progress out of the sweep output
+    with open('train.log', 'w') as log, redirect_stdout(log), redirect_stderr(log):
+        model = run_training(loader, torch.device('cpu'), number_epochs=trial['epochs'],
+                             batches_per_epoch=trial['batches_per_epoch'], batch_size=trial['batch_size'],
+                             features_d=trial['features_d'], learning_rate=trial['learning_rate'],
+                             validation_size=trial['validation_size'], save_frequency=None,
+                             validation_frequency=trial['epochs'], threads=trial['threads'])
+    training_seconds = time.perf_counter() - start
+    model.eval()
+    with torch.no_grad():
+        errors = (validation_los - model(validation_data).reshape(-1)).numpy()
+    return dict(
+        trial=trial['trial'],
+        features_d=trial['features_d'],
+        learning_rate=trial['learning_rate'],
+        batch_size=trial['batch_size'],
+        max_los_clip=trial['max_los_clip'],
+        parameters=sum(p.numel() for p in model.parameters()),
+        validation_mse=float(np.mean(np.power(errors, 2))),
+        validation_mean_error=float(np.mean(errors)),
+        validation_loa=float(np.std(errors) * 1.96),
+        # Latency of a single record, as served by the forecast endpoint, and of a bulk scoring batch
+        latency_ms=measure_latency(model, validation_data[:1]),
+        batch_latency_ms=measure_latency(model, validation_data[:512], repeats=10),
+        training_seconds=training_seconds,
+    )
+
+
+def run_sweep(loader: DataHandler, work_dir: str, results_file: str, features_d: List[int],
+              learning_rates: List[float], batch_sizes: List[int], max_los_clips: List[Optional[int]],
+              epochs: int = 50, batches_per_epoch: int = 100, validation_size: int = 10000, workers: int = 1,
+              threads: Optional[int] = None) -> List[Dict]:
+    """
+    Train and evaluate every combination of the given hyperparameters, running trials in parallel over a single
+    shared copy of the vectorised data
+    :param loader: DataHandler holding the vectorised and unclipped data
+    :param work_dir: Directory for the shared data and per-trial output
+    :param results_file: Path to write the CSV results table to
+    :param features_d: Model feature dimensionalities to try
+    :param learning_rates: Learning rates to try
+    :param batch_sizes: Batch sizes to try
+    :param max_los_clips: LoS clips to try
+    :param epochs: The number of training epochs per trial
+    :param batches_per_epoch: The number of batch iterations per training epoch
+    :param validation_size: The number of validation samples to use
+    :param workers: Number of trials to run at once
+    :param threads: Number of torch threads per trial (by default, the available cores, including container CPU
+    limits, divided between workers)
+    :return: List of results table rows
+    """
+    work_dir = os.path.abspath(work_dir)
+    paths = cache_dataset(loader, work_dir)
+    if threads is None:
+        threads = resources.plan_threads(workers).threads
+    # Every trial must train and validate on the same split, so fix the seed if shuffling without one
+    shuffle_seed = loader.fixed_seed
+    if loader.shuffle and shuffle_seed is None:
+        shuffle_seed = int(np.random.randint(2 ** 31))
+    trials = [dict(trial=i, features_d=f, learning_rate=lr, batch_size=b, max_los_clip=c, epochs=epochs,
+                   batches_per_epoch=batches_per_epoch, validation_size=validation_size, threads=threads,
+                   shuffle=loader.shuffle, shuffle_seed=shuffle_seed, work_dir=work_dir, paths=paths)
+              for i, (f, lr, b, c) in enumerate(itertools.product(features_d, learning_rates, batch_sizes,
+                                                                  max_los_clips))]
+    print(f'Running {len(trials)} trials on {workers} workers with {threads} threads each')
+    results = []
+    with open(results_file, 'w', newline='') as fp:
+        writer = csv.DictWriter(fp, fieldnames=RESULT_FIELDS)
+        writer.writeheader()
+        # Spawn rather than fork workers, as forking a process that has already started torch threads can deadlock
+        with multiprocessing.get_context('spawn').Pool(workers, maxtasksperchild=1) as pool:
+            for result in pool.imap_unordered(run_trial, trials):
+                print(f'Trial {result["trial"]}: features_d={result["features_d"]}, '
+                      f'learning_rate={result["learning_rate"]}, batch_size={result["batch_size"]}, '
+                      f'max_los_clip={result["max_los_clip"]}: MSE {result["validation_mse"]:.2f} days, '
+                      f'latency {result["latency_ms"]:.2f} ms')
+                writer.writerow(result)
+                fp.flush()
+                results.append(result)
+    return sorted(results, key=lambda r: r['trial'])
+
+
+def parse_clip(value: str) -> Optional[int]:
+    """Parse a LoS clip argument, where `none` disables clipping"""
+    return None if value.lower() == 'none' else int(value)
+
+
+def parse_args(override_args: Optional[List[str]] = None) -> argparse.Namespace:
+    """
+    Parse command-line arguments. By default, parses sys.argv - if supplied, uses `args` as an override
+    :param override_args: Optional override for command-line arguments
+    :return: An argparse.Namespace containing the parsed argument set
+    """
+    parser = argparse.ArgumentParser(description='Sweep LoS model hyperparameters over a shared dataset')
+    parser.add_argument('--data', '-d', type=str, help='Input CSV data file', required=True)
+    parser.add_argument('--work-dir', '-w', type=str, help='Directory for shared data and trial output',
+                        default='sweep')
+    parser.add_argument('--output', '-o', type=str, help='Path to write the CSV results table to',
+                        default='sweep_results.csv')
+    parser.add_argument('--features-d', type=int, nargs='+', help='Feature dimensionalities to try', default=[64])
+    parser.add_argument('--learning-rate', type=float, nargs='+', help='Learning rates to try', default=[2e-4])
+    parser.add_argument('--batch-size', type=int, nargs='+', help='Batch sizes to try', default=[512])
+    parser.add_argument('--max-los-clip', type=parse_clip, nargs='+', help='LoS clips to try (or none)',
+                        default=[30])
+    parser.add_argument('--epochs', '-e', type=int, help='Number of epochs per trial', default=50)
+    parser.add_argument('--batches-per-epoch', '-b', type=int, help='Number of batches per epoch', default=100)
+    parser.add_argument('--validation-size', '-v', type=int, help='Number of validation samples to use', default=10000)
+    parser.add_argument('--workers', type=int, help='Number of trials to run at once', default=1)
+    parser.add_argument('--threads', type=int, help='Number of torch threads per trial')
+    parser.add_argument('--target-mse', type=float, help='Report the smallest model within this validation MSE')
+    parser.add_argument('--shuffle-data', action='store_true', help='Whether to shuffle data before sampling')
+    parser.add_argument('--shuffle-seed', type=int, help='Optionally seed the PRNG for consistent shuffling')
+    parser.add_argument('--max-samples', type=int, help='Maximum number of records to use for train/test splits')
+    return parser.parse_args(args=override_args)
+
+
+if __name__ == '__main__':
+    # Parse command-line arguments
+    args = parse_args()
+    # Load and vectorise the data once, without clipping, as the clip is one of the swept parameters
+    data_loader = DataHandler(args.data, shuffle=args.shuffle_data, fixed_seed=args.shuffle_seed,
+                              max_samples=args.max_samples, max_los_clip=None, reshape=True)
+    print(f'Loaded {data_loader}')
+    sweep_results = run_sweep(data_loader, args.work_dir, os.path.abspath(args.output), args.features_d,
+                              args.learning_rate, args.batch_size, args.max_los_clip, epochs=args.epochs,
+                              batches_per_epoch=args.batches_per_epoch, validation_size=args.validation_size,
+                              workers=args.workers, threads=args.threads)
+    print(f'Saved results to {os.path.abspath(args.output)}')
+    if args.target_mse is not None:
+        # Pick the smallest (then fastest) model meeting the accuracy target
+        passing = [r for r in sweep_results if r['validation_mse'] <= args.target_mse]
+        if passing:
+            best = min(passing, key=lambda r: (r['parameters'], r['latency_ms']))
+            print(f'Smallest model within target: trial {best["trial"]} ({best["parameters"]} parameters, '
+                  f'MSE {best["validation_mse"]:.2f} days, latency {best["latency_ms"]:.2f} ms)')
+        else:
+            print(f'No model met the target MSE of {args.target_mse:.2f} days')
@@ -0,0 +1,145 @@
+import json
+import sys
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, Optional
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, where peak memory is not reported
+    resource = None
+
+
+def peak_rss() -> Optional[int]:
+    """
+    Get the peak resident set size of the process so far
+    :return: Peak RSS in bytes, or None if it cannot be measured on this platform
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on macOS, and in kilobytes elsewhere
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class PhaseTimer:
+    """
+    Accumulates the wall-clock time spent in each named phase of a training run (e.g. parsing, vectorisation,
+    sampling, forward and backward passes), the number of records each phase processed, and how much each phase raised
+    the peak memory of the process. Phases may be nested, e.g. `load/parse` within `load`.
+
+    :param synchronize: Optional function to wait for asynchronous work (e.g. `torch.cuda.synchronize`) at the start
+    and end of each timed block, so GPU time is counted in the phase that queued it
+    """
+
+    def __init__(self, synchronize: Optional[Callable[[], None]] = None):
+        self.synchronize = synchronize
+        self.start = time.perf_counter()
+        self.phases: Dict[str, Dict] = {}
+        # Seconds of each phase at the last call to `write_scalars`
+        self.__written: Dict[str, float] = {}
+
+    def add(self, name: str, seconds: float, items: int = 0, calls: int = 1, rss_growth: Optional[int] = None):
+        """
+        Count time spent in a phase, and the growth of the peak memory of the process while it ran
+        :param name: Name of the phase
+        :param seconds: Wall-clock seconds spent
+        :param items: Number of records processed
+        :param calls: Number of times the phase ran
+        :param rss_growth: Bytes the peak RSS of the process grew by while the phase ran, if measured
+        """
+        phase = self.phases.get(name)
+        if phase is None:
+            phase = self.phases[name] = dict(seconds=0.0, calls=0, items=0, peak_rss_growth_bytes=None)
+        phase['seconds'] += seconds
+        phase['calls'] += calls
+        phase['items'] += items
+        if rss_growth is not None:
+            phase['peak_rss_growth_bytes'] = (phase['peak_rss_growth_bytes'] or 0) + rss_growth
+
+    def count(self, name: str, items: int):
+        """
+        Count records processed by a phase, when the number is only known once the phase has run
+        :param name: Name of the phase
+        :param items: Number of records processed
+        """
+        self.add(name, 0.0, items=items, calls=0)
+
+    @contextmanager
+    def phase(self, name: str, items: int = 0) -> Iterator[None]:
+        """
+        Time a block of code as a phase
+        :param name: Name of the phase
+        :param items: Number of records the block processes
+        """
+        if self.synchronize is not None:
+            self.synchronize()
+        # The peak RSS only ever grows, so the phase's own peak shows as growth beyond the peak before it
+        start_peak = peak_rss()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.synchronize is not None:
+                self.synchronize()
+            seconds = time.perf_counter() - start
+            self.add(name, seconds, items, rss_growth=peak_rss() - start_peak if start_peak is not None else None)
+
+    def rate(self, name: str) -> Optional[float]:
+        """
+        Get the throughput of a phase
+        :param name: Name of the phase
+        :return: Records processed per second, or None if the phase has not processed any records
+        """
+        phase = self.phases.get(name)
+        if phase is None or phase['items'] == 0 or phase['seconds'] <= 0:
+            return None
+        return phase['items'] / phase['seconds']
+
+    def summary(self) -> Dict:
+        """
+        Summarise the time spent in each phase
+        :return: Dict of total elapsed seconds, peak RSS, and for each phase its seconds, calls, records processed,
+        records per second, share of the elapsed time and the growth of the peak RSS while it ran
+        """
+        total = time.perf_counter() - self.start
+        phases = {}
+        for name, phase in self.phases.items():
+            phases[name] = dict(phase, records_per_second=self.rate(name),
+                                share=phase['seconds'] / total if total > 0 else 0.0)
+        return dict(total_seconds=total, peak_rss_bytes=peak_rss(), phases=phases)
+
+    def write_scalars(self, writer, step: int):
+        """
+        Write the seconds spent in each phase since the last call, and the peak RSS, to Tensorboard
+        :param writer: Tensorboard SummaryWriter
+        :param step: Global step (e.g. epoch) to record the values at
+        """
+        for name, phase in self.phases.items():
+            seconds = phase['seconds'] - self.__written.get(name, 0.0)
+            if seconds > 0:
+                writer.add_scalar(f'Time/{name}', seconds, step)
+            self.__written[name] = phase['seconds']
+        peak = peak_rss()
+        if peak is not None:
+            writer.add_scalar('Memory/Peak RSS MiB', peak / 2 ** 20, step)
+
+    def save(self, filename: str, **run):
+        """
+        Save the summary of the phases to a JSON file
+        :param filename: File to write the summary to
+        :param run: Any details of the run to save with the summary (e.g. its configuration)
+        """
+        with open(filename, 'w') as f:
+            json.dump(dict(self.summary(), run=run), f, indent=2)
+
+    def __str__(self):
+        summary = self.summary()
+        lines = [f'{"Phase":<20} {"Seconds":>9} {"Share":>6} {"Records/s":>10}']
+        for name, phase in summary['phases'].items():
+            rate = f'{phase["records_per_second"]:.0f}' if phase['records_per_second'] is not None else '-'
+            lines.append(f'{name:<20} {phase["seconds"]:>9.2f} {phase["share"]:>6.1%} {rate:>10}')
+        if summary['peak_rss_bytes'] is not None:
+            lines.append(f'Peak RSS: {summary["peak_rss_bytes"] / 2 ** 20:.1f} MiB')
+        return '\n'.join(lines)
@@ -1,5 +1,8 @@
 import argparse
+import copy
 import os.path
+import queue
+import threading
 from typing import Optional, List
 from tqdm import tqdm
 from datetime import datetime
@@ -13,12 +16,78 @@ from loader import DataHandler
 import sys
 sys.path.append('..')
 from ltss.los_model import LoSPredictor
+from ltss import resources
+
+
+class Checkpointer:
+    """
+    Saves training checkpoints, optionally from a background thread so the training loop does not wait on disk.
+    State is copied in the training thread at the point of saving, so later updates never leak into a checkpoint.
+
+    :param background: If true, write checkpoints from a background thread
+    """
+
+    def __init__(self, background: bool = False):
+        self.queue: Optional[queue.Queue] = None
+        self.thread: Optional[threading.Thread] = None
+        if background:
+            # Bound the queue so a slow disk applies back-pressure rather than accumulating copies of the model
+            self.queue = queue.Queue(maxsize=2)
+            self.thread = threading.Thread(target=self.__run, name='checkpoint-writer', daemon=True)
+            self.thread.start()
+
+    def __run(self):
+        """Write checkpoints from the queue until a None sentinel is received"""
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            torch.save(*item)
+
+    def save(self, state, filename: str):
+        """
+        Save a copy of the given state to file
+        :param state: State dict (or dict of state dicts) to save
+        :param filename: File to save the state to
+        """
+        if self.queue is None:
+            torch.save(state, filename)
+        else:
+            self.queue.put((copy.deepcopy(state), filename))
+
+    def close(self):
+        """Wait for any queued checkpoints to be written"""
+        if self.queue is not None:
+            self.queue.put(None)
+            self.thread.join()
+
+
+def load_checkpoint(checkpoint: str, disc: LoSPredictor, opt_disc: optim.Optimizer) -> int:
+    """
+    Load a checkpoint into the model, and into the optimiser if the checkpoint is a resume file
+    :param checkpoint: Path to either a model state file (`mod_ep_<epoch>`) or a resume file
+    (`mod_ep_<epoch>.resume`) containing the model and optimiser states
+    :param disc: Model to load the state into
+    :param opt_disc: Optimiser to load the state into
+    :return: The epoch to resume training from
+    """
+    state = torch.load(checkpoint, map_location=next(disc.parameters()).device)
+    if 'model' in state and 'optimiser' in state:
+        disc.load_state_dict(state['model'])
+        opt_disc.load_state_dict(state['optimiser'])
+        print(f'Resuming from epoch {state["epoch"] + 1}')
+        return state['epoch'] + 1
+    disc.load_state_dict(state)
+    return 0
 
 
 def run_training(loader: DataHandler, use_device: torch.device, checkpoint: Optional[str] = None,
                  number_epochs: int = 500, batches_per_epoch: int = 100, batch_size: int = 512, vector_d: int = 1,
                  features_d: int = 64, learning_rate: int = 2e-4, validation_size: int = 10000,
-                 save_frequency: Optional[int] = 100):
+                 save_frequency: Optional[int] = 100, validation_frequency: int = 1,
+                 validation_subsample: Optional[int] = None, async_checkpoints: bool = False,
+                 save_optimiser: bool = False, threads: Optional[int] = None,
+                 sync_timing: bool = False) -> LoSPredictor:
     """
     Run the main training loop, on the specific device, using the specified training/test data
     :param loader: The DataHandler to use to load train and test data splits
@@ -32,73 +101,138 @@ def run_training(loader: DataHandler, use_device: torch.device, checkpoint: Opti
     :param learning_rate: The learning rate used in the optimiser
     :param validation_size: The number of validation samples to use
     :param save_frequency: Save a model checkpoint every N epochs
+    :param validation_frequency: Run the validation pass every N epochs (and on the final epoch)
+    :param validation_subsample: If non-none, validate on this many random samples of the validation data each time
+    :param async_checkpoints: Write checkpoints from a background thread
+    :param save_optimiser: Save a resume file, including the optimiser state, alongside each checkpoint
+    :param threads: If non-none, the number of threads torch, OpenMP and BLAS use for CPU operations
+    :param sync_timing: On a GPU, wait for the queued GPU work at the start and end of each timed phase, so phase times
+    are accurate at some cost in throughput (otherwise GPU phase times are approximate)
+    :return: The trained model
     """
+    if threads is not None:
+        resources.configure(threads=threads)
+    # Time each phase of the run with the loader's timer, which has already timed loading the data
+    timer = loader.timer
+    if sync_timing and use_device.type == 'cuda':
+        # Wait for queued GPU work, so it is counted in the phase that queued it
+        timer.synchronize = torch.cuda.synchronize
     # Get the time at the start of the run, and start a logging session using Tensorboard
     now = datetime.now()
     run_dir = os.path.abspath(f'runs/exp_{now.strftime("%d_%m_%Y_%H_%M_%S")}')
     print(f'Saving tensorboard output to {run_dir}')
     writer = SummaryWriter(run_dir)
+    if timer.rate('load') is not None:
+        writer.add_scalar('Loader Records per Second', timer.rate('load'), 0)
     # Create the predictor for our single channel vector, using the number of features in the paper.
     disc = LoSPredictor(vector_d, features_d=features_d).to(device=use_device)
-    # Load the state dict, otherwise torch will randomise
-    if checkpoint is not None:
-        disc.load_state_dict(torch.load(checkpoint))
     # Setup the base params of the optimiser
     opt_disc = optim.Adam(disc.parameters(), lr=learning_rate, betas=(0.5, 0.999))
+    # Load the state dict, otherwise torch will randomise
+    start_epoch = 0
+    if checkpoint is not None:
+        start_epoch = load_checkpoint(checkpoint, disc, opt_disc)
     # We will use MSE as the loss function for the LoS
     criterion = nn.MSELoss().to(device=use_device)
     # Place our model into training mode
     disc.train()
     # Get a subset of validation data and move to GPU once
     validation_data, validation_los = loader.get_validation(validation_size)
+    checkpointer = Checkpointer(background=async_checkpoints)
+
+    def save_checkpoint(epoch_number: int, completed_epoch: int):
+        """
+        Save the model state, and optionally a resume file with the optimiser state
+        :param epoch_number: Epoch to name the checkpoint files after
+        :param completed_epoch: Last epoch completed, from which `load_checkpoint` resumes at the next epoch
+        """
+        # With background checkpoints, this only counts the time to copy the state
+        with timer.phase('checkpoint'):
+            checkpointer.save(disc.state_dict(), f'mod_ep_{epoch_number}')
+            if save_optimiser:
+                checkpointer.save(dict(model=disc.state_dict(), optimiser=opt_disc.state_dict(),
+                                       epoch=completed_epoch), f'mod_ep_{epoch_number}.resume')
+
     # Start training
-    with tqdm(range(number_epochs)) as progress:
+    epoch = start_epoch - 1
+    val_mse, mean_error, loa = float('nan'), float('nan'), float('nan')
+    with tqdm(range(start_epoch, number_epochs)) as progress:
         for epoch in progress:
             # Set our loss to 0, which we will accumulate on every epoch.
-            running_loss = 0
+            running_loss = 0.0
             # Main training batch loop
             for _ in np.arange(0, batches_per_epoch):
-                # Get sample data
+                # Get sample data (timed by the loader)
                 sample, los_pdf = loader.get_training_n(batch_size)
-                # remove the gradients from the optimiser
-                opt_disc.zero_grad()
-                # Get the prediction
-                pdf = disc(sample).reshape(-1)
-                # Compute the loss between are real LoS and and our prediction
-                loss = criterion(pdf, los_pdf)
-                # tick up our loss (accumulated)
-                running_loss += loss
-                # zeroes the gradient buffers of all parameters
-                disc.zero_grad()
-                # back prop of gradients
-                loss.backward()
-                # Actually updates the model
-                opt_disc.step()
+                with timer.phase('forward', items=len(los_pdf)):
+                    # remove the gradients from the optimiser (this zeroes the gradient buffers of all parameters)
+                    opt_disc.zero_grad()
+                    # Get the prediction
+                    pdf = disc(sample).reshape(-1)
+                    # Compute the loss between are real LoS and and our prediction
+                    loss = criterion(pdf, los_pdf)
+                    # tick up our loss (accumulated) as a plain number, so the autograd graph is not kept alive
+                    running_loss += loss.item()
+                with timer.phase('backward', items=len(los_pdf)):
+                    # back prop of gradients
+                    loss.backward()
+                with timer.phase('step'):
+                    # Actually updates the model
+                    opt_disc.step()
                 # The optimiser will now have concluded, and we can push through the next batch
 
             # Periodically save model output
             if save_frequency is not None and epoch % save_frequency == 0:
-                torch.save(disc.state_dict(), f'mod_ep_{epoch}')
+                save_checkpoint(epoch, epoch)
 
             # Compute MSE on training data from running_loss
             mse = running_loss / batches_per_epoch
+            writer.add_scalar('Training MSE', mse, epoch)
 
-            # Compute validation accuracy
-            pdf = disc(validation_data).reshape(-1)
-            errors = (validation_los - pdf).cpu().detach().numpy()
-            mean_error = float(np.mean(errors))
-            loa = float(np.std(errors) * 1.96)
+            # Compute validation accuracy, every validation_frequency epochs
+            if epoch % validation_frequency == 0 or epoch == number_epochs - 1:
+                if validation_subsample is not None:
+                    indices = torch.randperm(len(validation_los))[:validation_subsample].to(validation_los.device)
+                    epoch_data, epoch_los = validation_data[indices], validation_los[indices]
+                else:
+                    epoch_data, epoch_los = validation_data, validation_los
+                with timer.phase('validation', items=len(epoch_los)):
+                    # Validate without tracking gradients, and in eval mode so the batch norm statistics are not
+                    # updated from the validation data
+                    disc.eval()
+                    with torch.no_grad():
+                        pdf = disc(epoch_data).reshape(-1)
+                    disc.train()
+                    errors = (epoch_los - pdf).cpu().numpy()
+                    val_mse = float(np.mean(np.power(errors, 2)))
+                    mean_error = float(np.mean(errors))
+                    loa = float(np.std(errors) * 1.96)
 
-            # Write accuracy data to tensorboard
-            writer.add_scalar('Training MSE', mse, epoch)
-            writer.add_scalar('Validation MSE', np.mean(np.power(errors, 2)), epoch)
-            writer.add_scalar('Validation Mean Error', mean_error, epoch)
-            writer.add_scalar('Validation Limits of Agreement', loa, epoch)
+                # Write accuracy data to tensorboard
+                writer.add_scalar('Validation MSE', val_mse, epoch)
+                writer.add_scalar('Validation Mean Error', mean_error, epoch)
+                writer.add_scalar('Validation Limits of Agreement', loa, epoch)
+
+            # Write the time spent in each phase during the epoch to tensorboard
+            timer.write_scalars(writer, epoch)
 
             # Update tqdm progress bar with accuracy data
-            progress.set_postfix_str(f'MSE: {mse:.2f} days / {mse:.2f} days. LoA: {mean_error:.2f} ± {loa:.2f}')
+            progress.set_postfix_str(f'MSE: {mse:.2f} days / {val_mse:.2f} days. LoA: {mean_error:.2f} ± {loa:.2f}')
         # Save the final discriminator state
-        torch.save(disc.state_dict(), f'mod_ep_{epoch + 1}')
+        save_checkpoint(epoch + 1, epoch)
+    with timer.phase('checkpoint'):
+        # Wait for any background checkpoints to be written
+        checkpointer.close()
+    writer.close()
+    # Summarise where the run's time went
+    print(timer)
+    summary_file = os.path.join(run_dir, 'timings.json')
+    timer.save(summary_file, number_epochs=number_epochs, start_epoch=start_epoch, batches_per_epoch=batches_per_epoch,
+               batch_size=batch_size, validation_size=validation_size, validation_frequency=validation_frequency,
+               validation_subsample=validation_subsample, async_checkpoints=async_checkpoints,
+               device=str(use_device), threads=torch.get_num_threads(), sync_timing=timer.synchronize is not None)
+    print(f'Saved timings to {summary_file}')
+    return disc
 
 
 def parse_args(override_args: Optional[List[str]] = None) -> argparse.Namespace:
@@ -119,12 +253,26 @@ def parse_args(override_args: Optional[List[str]] = None) -> argparse.Namespace:
     parser.add_argument('--shuffle-seed', type=int, help='Optionally seed the PRNG for consistent shuffling')
     parser.add_argument('--max-samples', type=int, help='Maximum number of records to use for train/test splits')
     parser.add_argument('--save-frequency', type=int, help='Save a model checkpoint every N epochs')
+    parser.add_argument('--validation-frequency', type=int, help='Run validation every N epochs', default=1)
+    parser.add_argument('--validation-subsample', type=int,
+                        help='Validate on this many random samples of the validation data each time')
+    parser.add_argument('--async-checkpoints', action='store_true',
+                        help='Write checkpoints from a background thread')
+    parser.add_argument('--save-optimiser', action='store_true',
+                        help='Save a resume file including the optimiser state alongside each checkpoint')
+    parser.add_argument('--threads', type=int,
+                        help='Number of threads to use for CPU operations (by default, the available cores)')
+    parser.add_argument('--pin-cpus', action='store_true', help='Pin training to the threads\' share of the CPUs')
+    parser.add_argument('--sync-timing', action='store_true',
+                        help='Synchronise the GPU around each timed phase, for accurate (but slower) phase times')
     return parser.parse_args(args=override_args)
 
 
 if __name__ == '__main__':
     # Parse command-line arguments
     args = parse_args()
+    # Size the thread pools to the cores available (including container CPU limits) before loading any data
+    resources.configure(threads=args.threads, affinity=args.pin_cpus)
     # Device setup, here we can turn off CUDA manually, or use it if it is available on our hardware
     use_cuda = not args.cpu
     device = torch.device('cuda' if use_cuda and torch.cuda.is_available() else 'cpu')
@@ -135,4 +283,7 @@ if __name__ == '__main__':
     # Run the training loop
     run_training(data_loader, device, checkpoint=args.checkpoint, number_epochs=args.epochs,
                  batches_per_epoch=args.batches_per_epoch, batch_size=args.batch_size,
-                 validation_size=args.validation_size, save_frequency=args.save_frequency)
+                 validation_size=args.validation_size, save_frequency=args.save_frequency,
+                 validation_frequency=args.validation_frequency, validation_subsample=args.validation_subsample,
+                 async_checkpoints=args.async_checkpoints, save_optimiser=args.save_optimiser,
+                 sync_timing=args.sync_timing)
@@ -1,10 +1,12 @@
 import argparse
 import os.path
+from datetime import datetime
 from typing import Optional, List
 
 import numpy as np
 import pandas as pd
 import pickle
+from torch.utils.tensorboard import SummaryWriter
 from loader import DataHandler
 # Adjust sys.path to allow access to ltss module in parent directory
 import sys
@@ -148,14 +150,33 @@ def run_training(loader: DataHandler, save_path: str) -> TrainableCDFModel:
     :param save_path: The path to save the resulting trained model state to
     :return: A fully trained RiskCDFModel
     """
-    # Load our distributions builder
-    dist_builder = TrainableCDFModel(loader)
-    # We want the true probability for each category and the cumulative dist function (the defaults)
-    dist_builder.generate_dists()
+    # Time each phase of the run with the loader's timer, which has already timed loading the data
+    timer = loader.timer
+    # Start a logging session using Tensorboard
+    now = datetime.now()
+    run_dir = os.path.abspath(f'runs/risk_{now.strftime("%d_%m_%Y_%H_%M_%S")}')
+    print(f'Saving tensorboard output to {run_dir}')
+    writer = SummaryWriter(run_dir)
+    with timer.phase('frame'):
+        # Load our distributions builder
+        dist_builder = TrainableCDFModel(loader)
+    with timer.phase('distributions', items=len(dist_builder.data)):
+        # We want the true probability for each category and the cumulative dist function (the defaults)
+        dist_builder.generate_dists()
     # Save trained state
     save_path = os.path.abspath(save_path)
     print(f'Saving distribution data to {save_path}')
-    dist_builder.save_state_dict(save_path)
+    with timer.phase('save'):
+        dist_builder.save_state_dict(save_path)
+    # Summarise where the run's time went
+    if timer.rate('load') is not None:
+        writer.add_scalar('Loader Records per Second', timer.rate('load'), 0)
+    timer.write_scalars(writer, 0)
+    writer.close()
+    print(timer)
+    summary_file = os.path.join(run_dir, 'timings.json')
+    timer.save(summary_file, records=len(dist_builder.data), save_path=save_path)
+    print(f'Saved timings to {summary_file}')
     return dist_builder
 
 